@@ -0,0 +1,211 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Tuple, Union
+import asyncio
+import threading
+
+from db import DataBase, DBField, DBTable, SelectionCriteria
+
+DEFAULT_WORKERS = 4
+DEFAULT_SCAN_WORKERS = 1
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CHUNK_SIZE = 100
+
+
+class AsyncDataBase:
+    """An asyncio front-end to DataBase that runs all storage work on bounded thread pools.
+
+    Point operations and writes share one pool, while scans (queries, index builds) get their own
+    so a large query_table cannot hold up get_record. At most max_pending operations may be in
+    flight; further callers wait for a slot. A cancelled call stops waiting for its result, but
+    work already handed to a thread still completes.
+    """
+
+    def __init__(self, db: DataBase = None, max_workers: int = DEFAULT_WORKERS,
+                 scan_workers: int = DEFAULT_SCAN_WORKERS, max_pending: int = DEFAULT_MAX_PENDING,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        if max_workers < 1 or scan_workers < 1 or max_pending < 1 or batch_size < 1:
+            raise ValueError
+        self.db = db if db is not None else DataBase()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='db')
+        self.scan_executor = ThreadPoolExecutor(scan_workers, thread_name_prefix='db-scan')
+        self.pending = asyncio.Semaphore(max_pending)
+        self.batch_size = batch_size
+        self.tables = {}
+
+    async def __aenter__(self) -> 'AsyncDataBase':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def run(self, function: Callable, *args: Any, scan: bool = False) -> Any:
+        async with self.pending:
+            executor = self.scan_executor if scan else self.executor
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    def wrap(self, table: DBTable) -> 'AsyncDBTable':
+        if self.tables.get(table.name) is None or self.tables[table.name].table is not table:
+            self.tables[table.name] = AsyncDBTable(self, table)
+        return self.tables[table.name]
+
+    async def create_table(self, table_name: str, fields: List[DBField], key_field_name: str,
+                           **options: Any) -> 'AsyncDBTable':
+        return self.wrap(await self.run(lambda: self.db.create_table(table_name, fields, key_field_name, **options)))
+
+    async def num_tables(self) -> int:
+        return await self.run(self.db.num_tables)
+
+    async def get_table(self, table_name: str) -> 'AsyncDBTable':
+        return self.wrap(await self.run(self.db.get_table, table_name))
+
+    async def delete_table(self, table_name: str) -> None:
+        table = self.tables.pop(table_name, None)
+        if table is not None:
+            await table.flush_inserts()
+        await self.run(self.db.delete_table, table_name)
+
+    async def get_tables_names(self) -> List[Any]:
+        return await self.run(self.db.get_tables_names)
+
+    async def query_multiple_tables(self, tables: List[str], fields_and_values_list: List[List[SelectionCriteria]],
+                                    fields_to_join_by: List[str]) -> List[Dict[str, Any]]:
+        return await self.run(self.db.query_multiple_tables, tables, fields_and_values_list, fields_to_join_by,
+                              scan=True)
+
+    async def close(self) -> None:
+        for table in list(self.tables.values()):
+            await table.flush_inserts()
+        await asyncio.to_thread(self.executor.shutdown)
+        await asyncio.to_thread(self.scan_executor.shutdown)
+
+
+class AsyncDBTable:
+    """The async view of one DBTable. Concurrent insert_record calls are coalesced into insert_records batches."""
+
+    def __init__(self, database: AsyncDataBase, table: DBTable):
+        self.database = database
+        self.table = table
+        self.name = table.name
+        self.pending_inserts = []  # (values, future) waiting for the next batch
+        self.flusher = None
+
+    async def count(self) -> int:
+        return await self.database.run(self.table.count)
+
+    async def insert_record(self, values: Dict[str, Any]) -> None:
+        async with self.database.pending:
+            entry = (values, asyncio.get_running_loop().create_future())
+            self.pending_inserts.append(entry)
+            if self.flusher is None:
+                self.flusher = asyncio.ensure_future(self.write_batches())
+            try:
+                await entry[1]
+            except asyncio.CancelledError:
+                if entry in self.pending_inserts:  # not handed to a thread yet, so never written
+                    self.pending_inserts.remove(entry)
+                raise
+
+    async def write_batches(self) -> None:
+        try:
+            await asyncio.sleep(0)  # let the writers scheduled alongside this one join the first batch
+            while self.pending_inserts:
+                batch = self.pending_inserts[:self.database.batch_size]
+                del self.pending_inserts[:self.database.batch_size]
+                try:
+                    failures = dict(await asyncio.get_running_loop().run_in_executor(
+                        self.database.executor, self.table.insert_records, [values for values, future in batch]))
+                except Exception as error:
+                    failures = {position: error for position in range(len(batch))}
+                for position, (values, future) in enumerate(batch):
+                    if future.done():  # the caller was cancelled
+                        continue
+                    if position in failures:
+                        future.set_exception(failures[position])
+                    else:
+                        future.set_result(None)
+        finally:
+            self.flusher = None
+
+    async def flush_inserts(self) -> None:
+        """Wait until every insert_record issued so far has been written."""
+        if self.flusher is not None:
+            await asyncio.shield(self.flusher)
+
+    async def insert_records(self, records: Iterable[Dict[str, Any]],
+                             batch_size: int = DEFAULT_BATCH_SIZE) -> List[Tuple[int, Exception]]:
+        return await self.database.run(self.table.insert_records, list(records), batch_size)
+
+    async def delete_record(self, key: Any) -> None:
+        await self.database.run(self.table.delete_record, key)
+
+    async def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        return await self.database.run(self.table.delete_records, criteria, scan=True)
+
+    async def get_record(self, key: Any) -> Dict[str, Any]:
+        return await self.database.run(self.table.get_record, key)
+
+    async def update_record(self, key: Any, values: Dict[str, Any]) -> None:
+        await self.database.run(self.table.update_record, key, values)
+
+    async def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        return await self.database.run(self.table.update_records, criteria, values, scan=True)
+
+    async def query_table(self, criteria: List[SelectionCriteria], **options: Any) -> List[Dict[str, Any]]:
+        return await self.database.run(lambda: self.table.query_table(criteria, **options), scan=True)
+
+    async def explain(self, criteria: List[SelectionCriteria], fields: List[str] = None) -> Dict[str, Any]:
+        return await self.database.run(self.table.explain, criteria, fields, scan=True)
+
+    async def create_index(self, field_to_index: Union[str, List[str]], **options: Any) -> None:
+        await self.database.run(lambda: self.table.create_index(field_to_index, **options), scan=True)
+
+    async def iter_query(self, criteria: List[SelectionCriteria], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         max_chunks: int = 2, **options: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the rows of DBTable.iter_query, read chunk by chunk on a scan thread.
+
+        At most max_chunks chunks are buffered ahead of the consumer. The scan takes the table's read
+        lock only while it reads each batch of rows, so the table can be written to during the iteration.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(max_chunks)
+        stop = threading.Event()
+
+        def put(item: Any) -> None:
+            if not stop.is_set():  # once the consumer is gone nothing takes items off the queue
+                asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def scan() -> None:
+            rows = self.table.iter_query(criteria, **options)
+            try:
+                chunk = []
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) == chunk_size:
+                        put(chunk)
+                        chunk = []
+                        if stop.is_set():
+                            return
+                put(chunk)
+                put(None)
+            except Exception as error:
+                put(error)
+            finally:
+                rows.close()
+
+        async with self.database.pending:
+            scanning = loop.run_in_executor(self.database.scan_executor, scan)
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    for row in chunk:
+                        yield row
+            finally:
+                stop.set()
+                while not chunks.empty():  # make room for a put the scan may be blocked on
+                    chunks.get_nowait()
+                await scanning
@@ -0,0 +1,176 @@
+"""Benchmark the DataBase API at several table sizes and compare runs.
+
+    python benchmark.py run --sizes 1000 100000 --output after.json
+    python benchmark.py compare before.json after.json --threshold 0.1
+"""
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List
+import argparse
+import datetime as dt
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from db import DataBase, DBField, SelectionCriteria
+
+STUDENT_FIELDS = [DBField('ID', int), DBField('First', str), DBField('Last', str), DBField('Birthday', dt.datetime)]
+GRADE_FIELDS = [DBField('GradeID', int), DBField('ID', int), DBField('Grade', int)]
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_OPS = 500
+DEFAULT_QUERIES = 20
+DEFAULT_THRESHOLD = 0.1
+FIRST_NAMES = 1000  # distinct First values, so an equality query returns about n / 1000 rows
+
+
+def student(i: int) -> Dict[str, Any]:
+    return dict(ID=i, First=f'John{i % FIRST_NAMES}', Last=f'Doe{i}',
+                Birthday=dt.datetime(1950, 1, 1) + dt.timedelta(minutes=i))
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def measure(operation: Callable[[Any], Any], arguments: Iterable[Any]) -> Dict[str, float]:
+    """Time operation once per argument and summarize the latencies in milliseconds."""
+    latencies = []
+    start = time.perf_counter()
+    for argument in arguments:
+        operation_start = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - operation_start)
+    elapsed = time.perf_counter() - start
+    return {"ops": len(latencies), "seconds": elapsed, "ops_per_second": len(latencies) / elapsed if elapsed else 0,
+            "p50_ms": percentile(latencies, 0.5) * 1000, "p90_ms": percentile(latencies, 0.9) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000, "max_ms": max(latencies) * 1000}
+
+
+def measure_bulk(operation: Callable[[], Any], rows: int) -> Dict[str, float]:
+    start = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - start
+    return {"rows": rows, "seconds": elapsed, "rows_per_second": rows / elapsed if elapsed else 0}
+
+
+def disk_bytes(root: Path) -> int:
+    return sum(path.stat().st_size for path in root.glob('**/*') if path.is_file())
+
+
+def peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KiB elsewhere
+
+
+def benchmark_size(size: int, ops: int, queries: int, seed: int, root: Path) -> Dict[str, Any]:
+    """Run every scenario against a fresh database of size rows kept in root."""
+    rng = random.Random(seed)
+    db = DataBase(root=root)
+    results = {}
+    students = db.create_table('Students', STUDENT_FIELDS, 'ID')
+    grades = db.create_table('Grades', GRADE_FIELDS, 'GradeID')
+
+    results["bulk_insert"] = measure_bulk(lambda: students.insert_records(student(i) for i in range(1, size + 1)),
+                                          size)
+    grades.insert_records(dict(GradeID=i, ID=rng.randint(1, size), Grade=i % 100) for i in range(1, size + 1))
+    results["insert"] = measure(lambda i: students.insert_record(student(i)), range(size + 1, size + ops + 1))
+    keys = [rng.randint(1, size) for i in range(ops)]
+    results["get"] = measure(students.get_record, keys)
+    results["update"] = measure(lambda key: students.update_record(key, dict(Last='Updated')), keys)
+
+    names = [f'John{rng.randrange(FIRST_NAMES)}' for i in range(queries)]
+    starts = [rng.randint(1, size) for i in range(queries)]
+    equality = [[SelectionCriteria('First', '=', name)] for name in names]
+    ranges = [[SelectionCriteria('Birthday', 'BETWEEN', (student(start)['Birthday'], student(start + 100)['Birthday']))]
+              for start in starts]
+    joins = [[SelectionCriteria('First', '=', name)] for name in names]
+    results["equality_query"] = measure(students.query_table, equality)
+    results["range_query"] = measure(students.query_table, ranges)
+    results["join"] = measure(lambda criteria: db.query_multiple_tables(
+        ['Students', 'Grades'], [criteria, []], ['ID']), joins)
+
+    results["create_hash_index"] = measure_bulk(lambda: students.create_index('First'), size)
+    results["create_ordered_index"] = measure_bulk(lambda: students.create_index('Birthday', 'ordered'), size)
+    grades.create_index('ID')
+    results["indexed_equality_query"] = measure(students.query_table, equality)
+    results["indexed_range_query"] = measure(students.query_table, ranges)
+    results["indexed_join"] = measure(lambda criteria: db.query_multiple_tables(
+        ['Students', 'Grades'], [criteria, []], ['ID']), joins)
+
+    results["delete"] = measure(students.delete_record, sorted(set(keys)))
+    results["disk_bytes"] = disk_bytes(root)
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    for table_name in db.get_tables_names():
+        db.delete_table(table_name)
+    return results
+
+
+def run(sizes: List[int], ops: int, queries: int, seed: int) -> Dict[str, Any]:
+    report = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                       "started": dt.datetime.now().isoformat(timespec='seconds'), "ops": ops,
+                       "queries": queries, "seed": seed},
+              "sizes": {}}
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='db_benchmark_') as work_dir:
+            report["sizes"][str(size)] = benchmark_size(size, ops, queries, seed, Path(work_dir))
+    return report
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[str]:
+    """Return a line per scenario whose throughput fell or whose p99 latency grew by more than threshold."""
+    regressions = []
+    for size, scenarios in new["sizes"].items():
+        for name, result in scenarios.items():
+            before = base["sizes"].get(size, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(before, dict):
+                continue
+            for metric in ("ops_per_second", "rows_per_second"):
+                if before.get(metric) and result[metric] < before[metric] * (1 - threshold):
+                    regressions.append(f'{size} {name}: {metric} {before[metric]:.1f} -> {result[metric]:.1f}')
+            if before.get("p99_ms") and result["p99_ms"] > before["p99_ms"] * (1 + threshold):
+                regressions.append(f'{size} {name}: p99_ms {before["p99_ms"]:.3f} -> {result["p99_ms"]:.3f}')
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks and print or save the JSON report')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    run_parser.add_argument('--ops', type=int, default=DEFAULT_OPS, help='point operations per scenario')
+    run_parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help='queries per scenario')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', type=Path)
+    compare_parser = commands.add_parser('compare', help='flag regressions of a run against a baseline run')
+    compare_parser.add_argument('base', type=Path)
+    compare_parser.add_argument('new', type=Path)
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == 'run':
+        report = json.dumps(run(arguments.sizes, arguments.ops, arguments.queries, arguments.seed), indent=2)
+        if arguments.output:
+            arguments.output.write_text(report)
+        else:
+            print(report)
+        return 0
+
+    regressions = compare(json.loads(arguments.base.read_text()), json.loads(arguments.new.read_text()),
+                          arguments.threshold)
+    for regression in regressions:
+        print(regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
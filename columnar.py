@@ -0,0 +1,454 @@
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import datetime as dt
+import os
+import shutil
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # the columnar engine is optional
+    np = None
+
+from db import QUERY_BATCH_ROWS, DBTable, SelectionCriteria, remove_shelf_files
+from db_api import DB_ROOT
+import dbm_sqlite
+from instrumentation import instrumented
+import predicates
+from record_codec import RecordCodec
+
+INITIAL_CAPACITY = 1024
+MAX_RECENT_KEYS = 1024  # keys inserted since the sorted key arrays were built; past this they are rebuilt
+STRING_LENGTH = struct.Struct('<I')  # before each UTF-8 string of a dictionary file
+COLUMN_TYPES = {int: 'int64', float: 'float64', dt.datetime: 'datetime64[us]', str: 'int32'}  # str is dictionary codes
+
+
+class ColumnStore:
+    """The open state of a columnar table: one memory-mapped array per field, null masks and string dictionaries.
+
+    A primary key is found by binary search in sorted arrays of the live rows' keys and their positions,
+    built from the key column, or in the dict of keys inserted since the arrays were built.
+    """
+
+    def __init__(self, table: 'ColumnarDBTable'):
+        self.table = table
+        self.meta = dbm_sqlite.open_shelf(table.meta_path())
+        self.length = self.meta.get("length", 0)
+        self.capacity = self.meta.get("capacity", INITIAL_CAPACITY)
+        self.live = self.meta.get("live", 0)
+        self.dictionaries = {}
+        self.dictionary_ends = {}  # field -> bytes of its dictionary file holding the saved strings
+        for field in table.fields:
+            if field.type is str:
+                self.dictionaries[field.name], self.dictionary_ends[field.name] = read_dictionary(
+                    table.dictionary_path(field.name), self.meta.get(f'dictionary_length:{field.name}', 0))
+        self.saved_lengths = {field: len(values) for field, values in self.dictionaries.items()}
+        self.codes = {field: {value: code for code, value in enumerate(values)}
+                      for field, values in self.dictionaries.items()}
+        self.columns = {}
+        self.nulls = {}
+        for field in table.fields:
+            self.columns[field.name] = self.open_array(table.column_path(field.name), COLUMN_TYPES[field.type])
+            self.nulls[field.name] = self.open_array(table.null_path(field.name), 'bool')
+        self.valid = self.open_array(table.valid_path(), 'bool')
+        self.build_key_index()
+
+    def build_key_index(self) -> None:
+        positions = np.flatnonzero(self.valid[:self.length])
+        keys = self.columns[self.table.key_field_name][positions]
+        order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_positions = positions[order]
+        self.recent_keys = {}  # key -> position of the rows inserted since
+
+    def find(self, key: Any) -> Optional[int]:
+        """The position of the live row with key, or None."""
+        position = self.recent_keys.get(key)
+        if position is not None and self.valid[position]:
+            return position
+        field = self.table.key_field_name
+        value = self.codes[field].get(key) if field in self.codes else self.table.column_value(field, key)
+        if value is None:  # a string that no row has
+            return None
+        index = int(np.searchsorted(self.sorted_keys, value))
+        while index < len(self.sorted_keys) and self.sorted_keys[index] == value:  # skip deleted rows
+            position = int(self.sorted_positions[index])
+            if self.valid[position]:
+                return position
+            index += 1
+        return None
+
+    def add_key(self, key: Any, position: int) -> None:
+        self.recent_keys[key] = position
+        if len(self.recent_keys) > MAX_RECENT_KEYS:
+            self.build_key_index()
+
+    def open_array(self, path: str, dtype: str):
+        if not os.path.exists(path):
+            return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(self.capacity,))
+        return np.lib.format.open_memmap(path, mode='r+')
+
+    def grow(self, needed: int) -> None:
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        self.capacity = capacity
+        self.columns = {field: self.grow_array(array) for field, array in self.columns.items()}
+        self.nulls = {field: self.grow_array(array) for field, array in self.nulls.items()}
+        self.valid = self.grow_array(self.valid)
+
+    def grow_array(self, array):
+        path = array.filename
+        grown = np.lib.format.open_memmap(path + '.grow', mode='w+', dtype=array.dtype, shape=(self.capacity,))
+        grown[:self.length] = array[:self.length]
+        grown.flush()
+        del array
+        del grown
+        os.replace(path + '.grow', path)
+        return np.lib.format.open_memmap(path, mode='r+')
+
+    def encode(self, field: str, value: Any) -> Any:
+        if field not in self.codes:
+            return np.datetime64(value, 'us') if isinstance(value, dt.datetime) else value
+        code = self.codes[field].get(value)
+        if code is None:
+            code = len(self.dictionaries[field])
+            self.dictionaries[field].append(value)
+            self.codes[field][value] = code
+        return code
+
+    def decode(self, field: str, position: int) -> Any:
+        if self.nulls[field][position]:
+            return None
+        value = self.columns[field][position]
+        if field in self.dictionaries:
+            return self.dictionaries[field][value]
+        return value.astype('datetime64[us]').item() if value.dtype.kind == 'M' else value.item()
+
+    def write_row(self, position: int, row: Dict[str, Any]) -> None:
+        for field, value in row.items():
+            self.nulls[field][position] = value is None
+            if value is not None:
+                self.columns[field][position] = self.encode(field, value)
+
+    def read_row(self, position: int) -> Dict[str, Any]:
+        return {field.name: self.decode(field.name, position) for field in self.table.fields}
+
+    def flush(self) -> None:
+        for array in list(self.columns.values()) + list(self.nulls.values()) + [self.valid]:
+            array.flush()
+        self.meta["length"] = self.length
+        self.meta["capacity"] = self.capacity
+        self.meta["live"] = self.live
+        for field, values in self.dictionaries.items():  # only the strings added since the last flush
+            if len(values) > self.saved_lengths[field]:
+                self.dictionary_ends[field] = write_dictionary(self.table.dictionary_path(field),
+                                                               self.dictionary_ends[field],
+                                                               values[self.saved_lengths[field]:])
+                self.saved_lengths[field] = len(values)
+                self.meta[f'dictionary_length:{field}'] = len(values)
+        self.meta.sync()
+
+    def close(self, flush: bool = True) -> None:
+        if flush:
+            self.flush()
+        self.meta.close()
+        self.columns = self.nulls = self.valid = None
+
+
+def read_dictionary(path: str, length: int) -> Tuple[List[str], int]:
+    """The first length strings of a dictionary file, and the offset just past them."""
+    if not length:
+        return [], 0
+    with open(path, 'rb') as file:
+        data = file.read()
+    values = []
+    offset = 0
+    for i in range(length):
+        size, = STRING_LENGTH.unpack_from(data, offset)
+        offset += STRING_LENGTH.size
+        values.append(data[offset:offset + size].decode('utf-8'))
+        offset += size
+    return values, offset
+
+
+def write_dictionary(path: str, offset: int, values: List[str]) -> int:
+    """Write values at offset of a dictionary file, over anything left there by an unfinished flush. Returns the
+    offset just past them."""
+    data = b''.join(STRING_LENGTH.pack(len(encoded)) + encoded for encoded in (value.encode('utf-8')
+                                                                               for value in values))
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+        file.seek(offset)
+        file.write(data)
+        file.truncate()
+    return offset + len(data)
+
+
+def migrate_columnar_table(root: str, table_name: str, table_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Move a columnar table's string dictionaries from its meta shelf to dictionary files and remove the shelf that
+    mapped its keys to row positions."""
+    columns_path = os.path.join(root, f'{table_name}_columns')
+    if os.path.isdir(columns_path):
+        meta = dbm_sqlite.open_shelf(os.path.join(columns_path, 'meta.db'))
+        try:
+            for field in table_info["fields"]:
+                if f'dictionary:{field.name}' in meta:
+                    values = meta[f'dictionary:{field.name}']
+                    write_dictionary(os.path.join(columns_path, f'{field.name}.dict'), 0, values)
+                    meta[f'dictionary_length:{field.name}'] = len(values)
+                    del meta[f'dictionary:{field.name}']
+        finally:
+            meta.close()
+    remove_shelf_files(os.path.join(root, table_name + '.db'))
+    table_info["dictionary_files"] = True
+    return table_info
+
+
+class ColumnarDBTable(DBTable):
+    """A table stored column by column in NumPy arrays, with every filter evaluated as a vectorized mask.
+
+    Columns are typed (int64, float64, datetime64 for dt.datetime and dictionary codes for str) and
+    memory-mapped from <table>_columns/, with an append-only file of the strings of each str field.
+    The arrays stay mapped between calls until another writer changes the files.
+    """
+
+    def __init__(self, name: str, fields: List[Any], key_field_name: str, *args, root: str = DB_ROOT):
+        if np is None:
+            raise ImportError('the columnar engine requires numpy')
+        if any(field.type not in COLUMN_TYPES for field in fields):
+            raise ValueError
+        super().__init__(name, fields, key_field_name, root=root)
+        self.codec = None  # rows live in the columns
+        self.checker = RecordCodec(fields)  # checks rows the way the row engine's codec does
+        self.store = None  # kept between calls
+
+    def columns_path(self) -> str:
+        return os.path.join(self.root, f'{self.name}_columns')
+
+    def meta_path(self) -> str:
+        return os.path.join(self.columns_path(), 'meta.db')
+
+    def column_path(self, field: str) -> str:
+        return os.path.join(self.columns_path(), f'{field}.npy')
+
+    def null_path(self, field: str) -> str:
+        return os.path.join(self.columns_path(), f'{field}.null.npy')
+
+    def valid_path(self) -> str:
+        return os.path.join(self.columns_path(), 'valid.npy')
+
+    def dictionary_path(self, field: str) -> str:
+        return os.path.join(self.columns_path(), f'{field}.dict')
+
+    def shelf_paths(self) -> List[Tuple[str, bool]]:
+        return [(self.meta_path(), False)]
+
+    def create_files(self) -> None:
+        os.makedirs(self.columns_path(), exist_ok=True)
+        ColumnStore(self).close()
+
+    def remove_files(self) -> None:
+        remove_shelf_files(self.meta_path())
+        shutil.rmtree(self.columns_path(), ignore_errors=True)
+
+    def open(self, flush_policy: Any = None) -> 'ColumnarDBTable':
+        with self.handle_lock:
+            self.open_count += 1
+        return self
+
+    def close(self, force: bool = False) -> None:
+        with self.handle_lock:
+            if not self.open_count and not force:
+                return
+            self.open_count = 0 if force else self.open_count - 1
+            if self.store is not None and force:
+                self.store.close()
+                self.store = None
+            elif self.store is not None and not self.open_count:
+                self.store.flush()
+
+    def flush(self) -> None:
+        with self.handle_lock:
+            if self.store is not None:
+                self.store.flush()
+
+    def files_changed(self) -> None:
+        super().files_changed()
+        with self.handle_lock:
+            if self.store is not None:  # reloaded on next use, without writing back the stale state
+                self.store.close(flush=False)
+                self.store = None
+
+    @contextmanager
+    def column_store(self, write: bool = False) -> Iterator[ColumnStore]:
+        with self.writing() if write else self.lock.reading():
+            with self.handle_lock:
+                if self.store is None:
+                    self.store = ColumnStore(self)
+                store = self.store
+            try:
+                yield store
+            finally:
+                if write and not self.open_count:  # outside a session every write reaches the files
+                    store.flush()
+
+    def count(self) -> int:
+        with self.column_store() as store:
+            return store.live
+
+    def check_types(self, row: Dict[str, Any]) -> None:
+        self.checker.check(row)
+
+    def insert_record(self, values: Dict[str, Any]) -> None:
+        failures = self.insert_records([values])
+        if failures:
+            raise failures[0][1]
+
+    @instrumented('insert_records')
+    def insert_records(self, records: Iterable[Dict[str, Any]], batch_size: int = 1000) -> List[Tuple[int, Exception]]:
+        if batch_size < 1:
+            raise ValueError
+        failures = []
+        with self.column_store(write=True) as store:
+            for position, values in enumerate(records):
+                try:
+                    row = self.new_row(values)
+                    self.check_types(row)
+                    if store.find(row[self.key_field_name]) is not None:  # record already exists
+                        raise ValueError
+                except ValueError as error:
+                    failures.append((position, error))
+                    continue
+                store.grow(store.length + 1)
+                store.write_row(store.length, row)
+                store.valid[store.length] = True
+                store.add_key(row[self.key_field_name], store.length)
+                store.length += 1
+                store.live += 1
+        return failures
+
+    def position(self, store: ColumnStore, key: Any) -> int:
+        position = store.find(key)
+        if position is None:
+            raise ValueError
+        return position
+
+    @instrumented('get_record')
+    def get_record(self, key: Any) -> Dict[str, Any]:
+        with self.column_store() as store:
+            return store.read_row(self.position(store, key))
+
+    @instrumented('delete_record')
+    def delete_record(self, key: Any) -> None:
+        with self.column_store(write=True) as store:
+            position = self.position(store, key)
+            store.valid[position] = False
+            store.live -= 1
+
+    @instrumented('delete_records')
+    def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        with self.column_store(write=True) as store:
+            positions = self.matching_positions(store, criteria)
+            store.valid[positions] = False
+            store.live -= len(positions)
+            return len(positions)
+
+    @instrumented('update_record')
+    def update_record(self, key: Any, values: Dict[str, Any]) -> None:
+        if self.key_field_name in values:  # cannot update the primary key
+            raise ValueError
+        if any(field not in self.field_names() for field in values):
+            raise ValueError
+        self.check_types(values)
+        with self.column_store(write=True) as store:
+            store.write_row(self.position(store, key), values)
+
+    @instrumented('update_records')
+    def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        if self.key_field_name in values:  # cannot update the primary key
+            raise ValueError
+        if any(field not in self.field_names() for field in values):
+            raise ValueError
+        self.check_types(values)
+        with self.column_store(write=True) as store:
+            positions = self.matching_positions(store, criteria)
+            for position in positions:
+                store.write_row(position, values)
+            return len(positions)
+
+    def join_index_field(self, fields: List[str]) -> None:
+        return None
+
+    def create_index(self, field_to_index: str, kind: str = None, include: List[str] = None) -> None:
+        fields = [field_to_index] if isinstance(field_to_index, str) else list(field_to_index)
+        if any(field not in self.field_names() for field in fields + list(include or [])):
+            raise ValueError  # every filter is already a vectorized scan over only the columns it reads
+
+    def iter_matching_rows(self, criteria: List[SelectionCriteria], fields: Iterable[str] = None) \
+            -> Iterator[Dict[str, Any]]:
+        with self.column_store() as store:
+            positions = self.matching_positions(store, criteria)
+        for start in range(0, len(positions), QUERY_BATCH_ROWS):  # the read lock is not held across a yield
+            with self.column_store() as store:
+                rows = [store.read_row(position) for position in positions[start:start + QUERY_BATCH_ROWS]
+                        if store.valid[position]]
+            yield from rows
+
+    def explain(self, criteria: List[SelectionCriteria], fields: List[str] = None) -> Dict[str, Any]:
+        with self.column_store() as store:
+            returned_rows = len(self.matching_positions(store, criteria))
+            return {"plan": "columnar scan", "fields": [criterion.field_name for criterion in criteria],
+                    "estimated_rows": store.live, "actual_rows": store.live, "returned_rows": returned_rows}
+
+    def estimate_rows(self, criteria: List[SelectionCriteria]) -> float:
+        with self.column_store() as store:  # a vectorized count is as cheap as an estimate
+            return len(self.matching_positions(store, criteria))
+
+    def matching_positions(self, store: ColumnStore, criteria: List[SelectionCriteria]):
+        mask = store.valid[:store.length].copy()
+        for criterion in criteria:
+            if criterion.field_name not in self.field_names():
+                raise ValueError
+            mask &= self.criterion_mask(store, criterion)
+        return np.flatnonzero(mask)
+
+    def criterion_mask(self, store: ColumnStore, criterion: SelectionCriteria):
+        field = criterion.field_name
+        operator = predicates.normalize_operator(criterion)
+        nulls = store.nulls[field][:store.length]
+        if operator == predicates.IS_NULL:
+            return nulls.copy()
+        if operator == predicates.IS_NOT_NULL:
+            return ~nulls
+        if field in store.dictionaries:  # evaluate once per distinct string, then map through the codes
+            dictionary = store.dictionaries[field]
+            is_match = predicates.compile_criterion(SelectionCriteria('value', criterion.operator, criterion.value))
+            if not dictionary:
+                return np.zeros(store.length, bool)
+            matching_codes = np.fromiter((is_match({'value': value}) for value in dictionary), bool, len(dictionary))
+            return matching_codes[store.columns[field][:store.length]] & ~nulls
+
+        column = store.columns[field][:store.length]
+        value = criterion.value
+        if operator in predicates.COMPARISONS:
+            return predicates.COMPARISONS[operator](column, self.column_value(field, value)) & ~nulls
+        if operator == predicates.IN:
+            values = [self.column_value(field, item) for item in predicates.in_values(criterion)]
+            return np.isin(column, values) & ~nulls
+        if operator == predicates.BETWEEN:
+            predicates.compile_criterion(criterion)  # validates the (low, high) pair
+            low, high = (self.column_value(field, bound) for bound in value)
+            return (column >= low) & (column <= high) & ~nulls
+        raise ValueError(f'{operator} is only supported on str columns')
+
+    def column_value(self, field: str, value: Any) -> Any:
+        field_type = self.fields[self.field_names().index(field)].type
+        if field_type is dt.datetime:
+            if not isinstance(value, dt.datetime):
+                raise ValueError
+            return np.datetime64(value, 'us')
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError
+        return value
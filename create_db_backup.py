@@ -1,17 +1,19 @@
 from pathlib import Path
+import tempfile
 
 from db import DataBase
-from db_api import DB_ROOT
 from test_db import DB_BACKUP_ROOT, delete_files, create_students_table
 
 
 def create_db_backup() -> Path:
-    DB_BACKUP_ROOT.mkdir(parents=True, exist_ok=True)
-    delete_files(DB_BACKUP_ROOT)
-    db = DataBase()
-    create_students_table(db, 100)
-    for path in DB_ROOT.iterdir():
-        path.rename(DB_BACKUP_ROOT / path.name)
+    """Build the backup in a scratch database, leaving the tables under DB_ROOT alone."""
+    if DB_BACKUP_ROOT.exists():
+        delete_files(DB_BACKUP_ROOT)
+        DB_BACKUP_ROOT.rmdir()
+    with tempfile.TemporaryDirectory() as work_dir:
+        db = DataBase(root=work_dir)
+        create_students_table(db, 100)
+        db.snapshot(DB_BACKUP_ROOT)
     return DB_BACKUP_ROOT
 
 
@@ -1,11 +1,263 @@
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
 from dataclasses_json import dataclass_json
-from typing import Any, Dict, List, Type
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type, Union
+import heapq
+import itertools
+from ordered_index import OrderedIndex, null_last, range_bounds
+from record_cache import DEFAULT_MAX_ENTRIES, RecordCache
+from record_codec import CODEC_VERSION, RecordCodec, RecordShelf
+from locking import TableLock, table_lock
+from parallel_scan import ScanPool
+from instrumentation import Instrumentation, instrumented, open_table_shelf
 import db_api
-import shelve
+import predicates
+import snapshot
+import table_stats
+from wal import WriteAheadLog, abandoned_logs, new_log_path
+import dbm_sqlite
 import os
+import pickle
+import threading
 
 boolean = False
+ROW_PER_KEY_LAYOUT = 2  # catalog "layout" of tables that keep one shelf key per record
+CATALOG_FORMAT = 3  # format of the files under a root, recorded in the catalog file once they are all migrated
+FLUSH_PER_OP = 'per-op'
+ROW_ENGINE = 'row'
+COLUMNAR_ENGINE = 'columnar'
+HASH_INDEX = 'hash'
+ORDERED_INDEX = 'ordered'
+PRIMARY_KEY_PLAN = 'primary key'
+HASH_INDEX_PLAN = 'hash index'
+ORDERED_INDEX_PLAN = 'ordered index'
+COVERING_INDEX_PLAN = 'covering index'  # answered from the index alone
+COMPOSITE_INDEX_PLAN = 'composite index'  # keys from the index, rows from the table
+FULL_SCAN_PLAN = 'full scan'
+ROW_FETCH_COST = 1.2  # reading one row by key through an index, relative to reading one row during a scan
+INDEX_PROBE_COST = 1.0  # reading one posting list or index page
+INDEX_ENTRY_COST = 0.1  # building one row from a covering index entry already read
+FLUSH_ON_EXIT = 'on-exit'
+QUERY_BATCH_ROWS = 1000  # rows read per hold of the read lock while a query is iterated
+
+
+def table_shape(table_info: Dict[str, Any]) -> Tuple:
+    """What a table handle is built from; a handle whose table changed shape in the catalog is rebuilt."""
+    return (table_info.get("engine", ROW_ENGINE), table_info.get("partitions"), table_info.get("generation"),
+            table_info["fields"], table_info["key_field_name"])
+
+
+def catalog_lock(root: str) -> TableLock:
+    return table_lock(os.path.join(root, 'DataBase.lock'))
+
+
+def shelf_key(value: Any) -> str:
+    return repr(value)
+
+
+def partition_name(table_name: str, generation: int, index: int) -> str:
+    return f'{table_name}__{generation}_{index}'
+
+
+def shelf_files(path_file: str) -> List[str]:
+    directory, base = os.path.split(path_file)
+    return [os.path.join(directory, name) for name in os.listdir(directory or '.')
+            if name == base or name.startswith(base + '.') or name == base + '-journal']
+
+
+def remove_shelf_files(path_file: str) -> None:
+    dbm_sqlite.discard(path_file)
+    for path in shelf_files(path_file):
+        os.remove(path)
+
+
+def replace_shelf_files(source_path_file: str, path_file: str) -> None:
+    remove_shelf_files(path_file)
+    for path in shelf_files(source_path_file):
+        os.replace(path, path_file + path[len(source_path_file):])
+
+
+def remove_posting(index_file: dbm_sqlite.Shelf, value_key: str, key: Any) -> None:
+    keys = index_file[value_key]
+    keys.remove(key)
+    if keys:
+        index_file[value_key] = keys
+    else:  # an empty posting list would stay in the file forever
+        del index_file[value_key]
+
+
+def shelf_space(path_file: str, is_hash_index: bool = False) -> Dict[str, int]:
+    """Bytes used by a shelf's files vs. bytes of the values it holds; the rest is dead space and padding."""
+    file_name = dbm_sqlite.open(path_file, 'r')
+    try:
+        values = list(file_name.values())
+    finally:
+        file_name.close()
+    file_bytes = sum(os.path.getsize(path) for path in shelf_files(path_file))
+    live_bytes = sum(len(value) for value in values)
+    empty_entries = sum(not pickle.loads(value) for value in values) if is_hash_index else 0
+    return {"file_bytes": file_bytes, "live_bytes": live_bytes, "dead_bytes": file_bytes - live_bytes,
+            "entries": len(values), "empty_entries": empty_entries}
+
+
+def compact_shelf(path_file: str, is_hash_index: bool = False) -> None:
+    """Rewrite a shelf with only its current values, dropping empty posting lists from hash indexes."""
+    file_name = dbm_sqlite.open(path_file, 'w')
+    try:
+        if is_hash_index:
+            for key, value in list(file_name.items()):
+                if not pickle.loads(value):
+                    del file_name[key]
+        file_name.vacuum()
+    finally:
+        file_name.close()
+
+
+def migrate_table(root: str, table_name: str, table_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Rewrite a table stored as one pickled dict into one shelf key per record, and rebuild its hash indexes."""
+    fields = [field.name for field in table_info["fields"]]
+    key_field_name = table_info["key_field_name"]
+    hash_index = table_info.get("hash_index") or [False for i in range(len(fields))]
+    path_file = os.path.join(root, table_name + '.db')
+    path_new_file = os.path.join(root, table_name + '.migrating.db')
+    postings = [{} for i in range(len(fields))]
+
+    file_name = dbm_sqlite.open_shelf(path_file)
+    new_file = dbm_sqlite.open_shelf(path_new_file, 'n')
+    try:
+        for key, stored_row in file_name.get(table_name, {}).items():
+            row = {field: stored_row.get(field) for field in fields}
+            row[key_field_name] = key
+            new_file[shelf_key(key)] = row
+            for i, field in enumerate(fields):
+                if hash_index[i] and row[field] is not None:
+                    postings[i].setdefault(shelf_key(row[field]), []).append(key)
+    finally:
+        file_name.close()
+        new_file.close()
+    replace_shelf_files(path_new_file, path_file)
+
+    for i, field in enumerate(fields):
+        if hash_index[i]:
+            path_index_file = os.path.join(root, f'{table_name}_{field}_hash_index.db')
+            remove_shelf_files(path_index_file)
+            index_file = dbm_sqlite.open_shelf(path_index_file, 'n')
+            try:
+                index_file.update(postings[i])
+            finally:
+                index_file.close()
+
+    table_info["hash_index"] = hash_index
+    table_info["layout"] = ROW_PER_KEY_LAYOUT
+    return table_info
+
+
+def encode_table(root: str, table_name: str, table_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Rewrite a table's pickled rows with its record codec. A table holding values that do not have their
+    declared types stays pickled."""
+    path_file = os.path.join(root, table_name + '.db')
+    path_new_file = os.path.join(root, table_name + '.encoding.db')
+    codec = RecordCodec(table_info["fields"])
+    table_info["codec"] = CODEC_VERSION
+    if table_info.get("partitions") or not shelf_files(path_file):  # the rows are in the partitions
+        return table_info
+    file_name = dbm_sqlite.open_shelf(path_file, 'r')
+    new_file = RecordShelf(dbm_sqlite.open(path_new_file, 'n'), codec)
+    try:
+        for key, row in file_name.items():
+            codec.check(row)
+            new_file[key] = row
+    except ValueError:
+        table_info["codec"] = None
+    finally:
+        file_name.close()
+        new_file.close()
+    if table_info["codec"] is None:
+        remove_shelf_files(path_new_file)
+    else:
+        replace_shelf_files(path_new_file, path_file)
+    return table_info
+
+
+def add_null_keys(root: str, table_name: str, table_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the keys of the rows whose value is None to a table's ordered indexes, which used to leave them out."""
+    path_file = os.path.join(root, table_name + '.db')
+    ordered_index = table_info.get("ordered_index") or [False for field in table_info["fields"]]
+    ordered_fields = [field.name for i, field in enumerate(table_info["fields"]) if ordered_index[i]]
+    table_info["ordered_nulls"] = True
+    if not ordered_fields or table_info.get("partitions") or not shelf_files(path_file):
+        return table_info
+    null_keys = {field: [] for field in ordered_fields}
+    file_name = RecordShelf(dbm_sqlite.open(path_file, 'r'), RecordCodec(table_info["fields"])) \
+        if table_info.get("codec") == CODEC_VERSION else dbm_sqlite.open_shelf(path_file, 'r')
+    try:
+        for row in file_name.values():
+            for field, keys in null_keys.items():
+                if row.get(field) is None:
+                    keys.append(row[table_info["key_field_name"]])
+    finally:
+        file_name.close()
+    for field, keys in null_keys.items():
+        index_file = dbm_sqlite.open_shelf(os.path.join(root, f'{table_name}_{field}_ordered_index.db'))
+        try:
+            for key in keys:
+                OrderedIndex(index_file).insert(None, key)
+        finally:
+            index_file.close()
+    return table_info
+
+
+def is_migrated(table_info: Dict[str, Any]) -> bool:
+    if table_info.get("engine", ROW_ENGINE) == ROW_ENGINE:
+        return table_info.get("layout") == ROW_PER_KEY_LAYOUT and "codec" in table_info and \
+            table_info.get("ordered_nulls")
+    return table_info.get("layout") == ROW_PER_KEY_LAYOUT and table_info.get("ordered_nulls") and \
+        table_info.get("dictionary_files")
+
+
+def catalog_format(root: str) -> int:
+    """The CATALOG_FORMAT the files under root were migrated to, 0 if never."""
+    path_data_file = os.path.join(root, 'DataBase.db')
+    if not os.path.exists(path_data_file):
+        return 0
+    data_file = dbm_sqlite.open(path_data_file, 'r')
+    try:
+        return data_file.version
+    finally:
+        data_file.close()
+
+
+def migrate_db_files(root: str = db_api.DB_ROOT) -> List[str]:
+    """Convert in place every shelf under root still in dbm.dumb files, then every table that still uses the old
+    layout, pickled rows, ordered indexes without the None values or columnar string dictionaries in its meta shelf.
+    Returns the migrated table names."""
+    for path_file in dbm_sqlite.dumb_shelves(root):
+        dbm_sqlite.convert_dumb(path_file)
+    path_data_file = os.path.join(root, 'DataBase.db')
+    data_file = dbm_sqlite.open_shelf(path_data_file)
+    migrated = []
+    try:
+        for table_name in list(data_file):
+            table_info = data_file[table_name]
+            is_row_table = table_info.get("engine", ROW_ENGINE) == ROW_ENGINE
+            if is_migrated(table_info):
+                continue
+            if table_info.get("layout") != ROW_PER_KEY_LAYOUT:
+                table_info = migrate_table(root, table_name, table_info)
+            if "codec" not in table_info and is_row_table:
+                table_info = encode_table(root, table_name, table_info)
+            if not table_info.get("ordered_nulls"):
+                table_info = add_null_keys(root, table_name, table_info)
+            if not is_row_table and not table_info.get("dictionary_files"):
+                from columnar import migrate_columnar_table
+                table_info = migrate_columnar_table(root, table_name, table_info)
+            data_file[table_name] = table_info
+            migrated.append(table_name)
+        data_file.dict.version = CATALOG_FORMAT
+    finally:
+        data_file.close()
+    return migrated
 
 
 @dataclass_json
@@ -20,356 +272,1492 @@ class SelectionCriteria(db_api.SelectionCriteria):
     pass
 
 
+@dataclass_json
+@dataclass
+class SortKey:
+    field_name: str
+    descending: bool = False
+
+
+class DescendingValue:
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __lt__(self, other: 'DescendingValue') -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: 'DescendingValue') -> bool:
+        return self.value == other.value
+
+
+def sort_key(order_by: List[SortKey]):
+    def key(row: Dict[str, Any]) -> Tuple:  # None sorts last in both directions
+        return tuple((row[sort.field_name] is None,
+                      DescendingValue(row[sort.field_name]) if sort.descending else row[sort.field_name])
+                     for sort in order_by)
+    return key
+
+
 @dataclass_json
 @dataclass
 class DBTable(db_api.DBTable):
-    def __init__(self, name: str, fields: List[DBField], key_field_name: str, hash_index :List[int] = None):
+    def __init__(self, name: str, fields: List[DBField], key_field_name: str, hash_index :List[int] = None,
+                 ordered_index: List[bool] = None, root: str = db_api.DB_ROOT):
         self.name = name
+        self.root = root
         self.fields = fields
         self.key_field_name = key_field_name
         self.hash_index = hash_index if hash_index else [False for i in range(len(fields))]
+        self.ordered_index = ordered_index if ordered_index else [False for i in range(len(fields))]
+        self.covering_indexes = []  # {"fields": [...], "include": [...]}, composite when several fields
+        self.open_files = {}
+        self.open_count = 0
+        self.flush_policy = FLUSH_ON_EXIT
+        self.pending_writes = 0
+        self.stats = None
+        self.stats_delta = table_stats.new_stats()
+        self.wal = None
+        self.scan_pool = None
+        self.instrumentation = None
+        self.cache = RecordCache()
+        self.codec = RecordCodec(fields)  # None for tables whose rows are still pickled
+        self.handle_lock = threading.RLock()  # guards open_count and the files held open, never across a yield
+        self.shelf_users = {}  # id of a held shelf -> [with blocks using it, whether it was closed meanwhile]
+        self.lock = table_lock(self.lock_path())
+        self.lock.add_listener(self)
+        self.is_dropped = False  # set once the table is dropped or repartitioned, the handle is then stale
+        self.catalog_lock = catalog_lock(root)
 
-    def count(self) -> int:
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
+    def open(self, flush_policy: Any = FLUSH_ON_EXIT) -> 'DBTable':
+        """Keep the table and index files open until the matching close().
+
+        flush_policy is FLUSH_PER_OP, FLUSH_ON_EXIT or a number N of writes between flushes.
+        """
+        is_number = isinstance(flush_policy, int) and not isinstance(flush_policy, bool)
+        if flush_policy not in (FLUSH_PER_OP, FLUSH_ON_EXIT) and not (is_number and flush_policy > 0):
+            raise ValueError
+        with self.handle_lock:
+            if not self.open_count:
+                self.flush_policy = flush_policy
+                for path_file, _ in self.shelf_paths():
+                    self.open_files[path_file] = self.open_file(path_file)
+            self.open_count += 1
+        return self
+
+    def close(self, force: bool = False) -> None:
+        with self.handle_lock:
+            if not self.open_count:
+                return
+            self.open_count = 0 if force else self.open_count - 1
+            if not self.open_count:
+                if not force:
+                    self.save_stats()
+                for file_name in self.open_files.values():
+                    self.release_shelf(file_name)
+                self.open_files = {}
+                self.pending_writes = 0
+
+    def flush(self) -> None:
+        with self.handle_lock:
+            for file_name in self.open_files.values():
+                file_name.dict.flush_to_disk()
+            self.save_stats()
+            self.pending_writes = 0
+
+    def sync_files(self) -> None:
+        """Force the table and index files to disk, whether held open or not."""
+        with self.handle_lock:
+            for path_file, _ in self.shelf_paths():
+                if path_file in self.open_files:
+                    self.open_files[path_file].dict.flush_to_disk()
+                elif os.path.exists(path_file):
+                    file_name = dbm_sqlite.open(path_file, 'w')
+                    try:
+                        file_name.flush_to_disk()
+                    finally:
+                        file_name.close()
+
+    def files_changed(self) -> None:
+        """Another writer changed the files: drop the cached rows and statistics and reopen the held files."""
+        self.cache.clear()
+        self.stats = None
+        with self.catalog_lock.reading():
+            data_file = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                table_info = data_file.get(self.name)
+            finally:
+                data_file.close()
+        if table_info is not None:
+            self.hash_index = table_info["hash_index"]
+            self.ordered_index = table_info.get("ordered_index") or [False for field in self.fields]
+            self.covering_indexes = table_info.get("covering_indexes", [])
+        if self.is_replaced(table_info):
+            self.mark_dropped()
+        with self.handle_lock:
+            for path_file in list(self.open_files):
+                self.release_shelf(self.open_files[path_file])
+                self.open_files[path_file] = self.open_file(path_file)
+
+    def is_replaced(self, table_info: Optional[Dict[str, Any]]) -> bool:
+        """Whether the table's catalog entry shows it was dropped or repartitioned since the handle was built."""
+        return table_info is None or "partitions" in table_info
+
+    def mark_dropped(self) -> None:
+        self.is_dropped = True
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """The table's write lock, refused to a stale handle once the writers before it dropped the table.
+
+        The writes to the held shelves are committed before the lock is released, so no other handle finds
+        the files still locked by SQLite; the flush policy only defers forcing them to disk.
+        """
+        self.check_not_dropped()  # known stale already: do not make a dropped partition's lock file again
+        with self.lock.writing(self):
+            self.check_not_dropped()
+            try:
+                yield
+            finally:
+                with self.handle_lock:
+                    for file_name in self.open_files.values():
+                        file_name.sync()
+
+    def check_not_dropped(self) -> None:
+        if self.is_dropped:
+            raise ValueError('the table was dropped or repartitioned, get it from the database again')
+
+    def __enter__(self) -> 'DBTable':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def open_shelf(self, path_file: str) -> Iterator[dbm_sqlite.Shelf]:
+        """The shelf held open while the table is open, else one opened for the with block.
+
+        handle_lock only guards the lookup, so a writer waiting in logged() does not hold up a checkpoint
+        flushing the table. A held shelf closed during the block is closed when the block ends.
+        """
+        with self.handle_lock:
+            if self.open_count and path_file not in self.open_files:
+                self.open_files[path_file] = self.open_file(path_file)
+            file_name = self.open_files.get(path_file)
+            if file_name is not None:
+                self.shelf_users.setdefault(id(file_name), [0, False])[0] += 1
+        if file_name is None:
+            file_name = self.open_file(path_file)
+            try:
+                yield file_name
+            finally:
+                file_name.close()
+            return
         try:
-            count = len(file_name[self.name].keys())
+            yield file_name
         finally:
-            file_name.close()
-        return count
+            with self.handle_lock:
+                users = self.shelf_users[id(file_name)]
+                users[0] -= 1
+                if not users[0]:
+                    del self.shelf_users[id(file_name)]
+                    if users[1]:
+                        file_name.close()
 
-    def insert_record(self, values: Dict[str, Any]) -> None:
+    def release_shelf(self, file_name: dbm_sqlite.Shelf) -> None:
+        """Close a shelf no longer held, now or when the last with block using it ends."""
+        with self.handle_lock:
+            users = self.shelf_users.get(id(file_name))
+            if users is None:
+                file_name.close()
+            else:
+                users[1] = True
+
+    def open_file(self, path_file: str) -> dbm_sqlite.Shelf:
+        codec = self.codec if path_file == self.table_path() else None
+        return open_table_shelf(path_file, self.instrumentation, self.name, codec=codec)
+
+    def close_shelf(self, path_file: str) -> None:
+        with self.handle_lock:
+            if path_file in self.open_files:
+                self.release_shelf(self.open_files.pop(path_file))
+
+    @contextmanager
+    def logged(self, operation: str, *arguments: Any) -> Iterator[None]:
+        """Make the write durable in the write-ahead log (when enabled) before the with block applies it."""
+        if self.wal is None:
+            yield
+            return
+        with self.wal.writing():
+            self.wal.log((self.name, operation) + arguments)
+            yield
+
+    def redo(self, operation: str, *arguments: Any) -> None:
+        """Re-apply a logged write. Safe to run on files that already hold all or part of it."""
+        with self.writing():
+            with self.open():
+                if operation == 'insert':
+                    for row in arguments[0]:
+                        self.redo_row(row[self.key_field_name], None, row)
+                elif operation == 'delete':
+                    key, row = arguments
+                    self.redo_row(key, row, None)
+                elif operation == 'update':
+                    self.redo_row(*arguments)
+                elif operation == 'delete_batch':
+                    for row in arguments[0]:
+                        self.redo_row(row[self.key_field_name], row, None)
+                elif operation == 'update_batch':
+                    for row, updated_row in arguments[0]:
+                        self.redo_row(row[self.key_field_name], row, updated_row)
+
+    def redo_row(self, key: Any, old_row: Optional[Dict[str, Any]], new_row: Optional[Dict[str, Any]]) -> None:
+        with self.open_shelf(self.table_path()) as file_name:
+            if new_row is not None:
+                file_name[shelf_key(key)] = new_row
+            elif shelf_key(key) in file_name:
+                del file_name[shelf_key(key)]
+        self.cache.invalidate(shelf_key(key))
+
+        for i, field in enumerate(self.field_names()):
+            old_value = old_row[field] if old_row else None
+            new_value = new_row[field] if new_row else None
+            if old_value == new_value and old_row and new_row:
+                continue
+            if self.hash_index[i]:
+                with self.open_shelf(self.index_path(field)) as index_file:
+                    if old_value is not None and key in index_file.get(shelf_key(old_value), []):
+                        keys = index_file[shelf_key(old_value)]
+                        keys.remove(key)
+                        index_file[shelf_key(old_value)] = keys
+                    if new_value is not None and key not in index_file.get(shelf_key(new_value), []):
+                        index_file[shelf_key(new_value)] = index_file.get(shelf_key(new_value), []) + [key]
+            if self.ordered_index[i]:
+                with self.open_shelf(self.ordered_index_path(field)) as index_file:
+                    ordered_index = OrderedIndex(index_file)
+                    if old_row and ordered_index.contains(old_value, key):
+                        ordered_index.delete(old_value, key)
+                    if new_row and not ordered_index.contains(new_value, key):
+                        ordered_index.insert(new_value, key)
+        self.update_covering_indexes([(old_row, new_row)])
+
+    def attach(self, wal: Optional[WriteAheadLog], scan_pool: Optional[ScanPool],
+               instrumentation: Optional[Instrumentation] = None) -> None:
+        self.wal = wal
+        self.scan_pool = scan_pool
+        self.instrumentation = instrumentation
+
+    def storage_tables(self) -> List['DBTable']:
+        """The tables that own files and catalog entries: the table itself, or its partitions."""
+        return [self]
+
+    def set_cache(self, max_entries: Optional[int] = DEFAULT_MAX_ENTRIES, max_bytes: Optional[int] = None) -> None:
+        """Bound the record cache by entries and/or bytes; max_entries=0 disables it."""
+        self.cache = RecordCache(max_entries, max_bytes)
+
+    def cache_info(self) -> Dict[str, Any]:
+        return self.cache.info()
+
+    def after_write(self) -> None:
+        if self.wal is not None:
+            self.wal.maybe_checkpoint()
+        if not self.open_count:
+            self.save_stats()
+            return
+        self.pending_writes += 1
+        if self.flush_policy == FLUSH_PER_OP or \
+                (self.flush_policy != FLUSH_ON_EXIT and self.pending_writes >= self.flush_policy):
+            self.flush()
+
+    def catalog_path(self) -> str:
+        return os.path.join(self.root, 'DataBase.db')
+
+    def table_path(self) -> str:
+        return os.path.join(self.root, self.name + '.db')
+
+    def lock_path(self) -> str:
+        return os.path.join(self.root, self.name + '.lock')
+
+    def index_path(self, field: str) -> str:
+        return os.path.join(self.root, f'{self.name}_{field}_hash_index.db')
+
+    def ordered_index_path(self, field: str) -> str:
+        return os.path.join(self.root, f'{self.name}_{field}_ordered_index.db')
+
+    def covering_index_path(self, index: Dict[str, List[str]]) -> str:
+        return os.path.join(self.root, f'{self.name}_{"+".join(index["fields"])}_covering_index.db')
+
+    def shelf_paths(self) -> List[Tuple[str, bool]]:
+        """The table and index shelves, each with whether empty entries can be dropped from it."""
+        return [(self.table_path(), False)] + \
+            [(self.index_path(field), True) for i, field in enumerate(self.field_names()) if self.hash_index[i]] + \
+            [(self.ordered_index_path(field), False) for i, field in enumerate(self.field_names())
+             if self.ordered_index[i]] + \
+            [(self.covering_index_path(index), True) for index in self.covering_indexes]
+
+    def space_report(self) -> Dict[str, Dict[str, int]]:
+        with self.lock.reading():
+            if self.open_count:
+                self.flush()
+            return {path_file: shelf_space(path_file, is_hash_index)
+                    for path_file, is_hash_index in self.shelf_paths()}
+
+    def disk_bytes(self) -> int:
+        return sum(os.path.getsize(path) for path_file, _ in self.shelf_paths() for path in shelf_files(path_file))
+
+    def vacuum(self) -> int:
+        """Rewrite the table and index files compactly. Returns the number of bytes reclaimed."""
+        with self.writing(), self.handle_lock:
+            held = list(self.open_files)
+            for path_file in held:
+                self.close_shelf(path_file)
+            before = self.disk_bytes()
+            for path_file, is_hash_index in self.shelf_paths():
+                compact_shelf(path_file, is_hash_index)
+            after = self.disk_bytes()
+            for path_file in held:
+                self.open_files[path_file] = self.open_file(path_file)
+        return before - after
+
+    def field_names(self) -> List[str]:
+        return [field.name for field in self.fields]
+
+    def create_files(self) -> None:
+        file_name = dbm_sqlite.open_shelf(self.table_path(), 'n')
+        file_name.close()
+
+    def remove_files(self) -> None:
+        remove_shelf_files(self.table_path())
+        for i, field in enumerate(self.field_names()):
+            if self.hash_index[i]:
+                remove_shelf_files(self.index_path(field))
+            if self.ordered_index[i]:
+                remove_shelf_files(self.ordered_index_path(field))
+        for index in self.covering_indexes:
+            remove_shelf_files(self.covering_index_path(index))
+
+    def count(self) -> int:
+        return self.current_stats(refresh=not self.open_count)["row_count"]
+
+    def current_stats(self, refresh: bool = False) -> Dict[str, Any]:
+        if refresh or self.stats is None:
+            self.load_stats()
+        return table_stats.merge(self.stats, self.stats_delta)
+
+    def load_stats(self) -> None:
+        with self.catalog_lock.reading():
+            data_file = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                self.stats = data_file[self.name].get("stats")
+            finally:
+                data_file.close()
+        if self.stats is None:  # catalog written before statistics existed
+            self.analyze()
+
+    def save_stats(self) -> None:
+        if not self.stats_delta["row_count"] and not self.stats_delta["fields"]:
+            return
+        with self.catalog_lock.writing(invalidate=False):  # statistics are read from the file, never cached
+            data_file = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                table_info = data_file[self.name]
+                table_info["stats"] = table_stats.merge(table_info["stats"], self.stats_delta)
+                data_file[self.name] = table_info
+            finally:
+                data_file.close()
+        self.stats = table_info["stats"]
+        self.stats_delta = table_stats.new_stats()
+
+    def analyze(self) -> None:
+        """Recompute the table statistics from scratch, e.g. to shrink min/max after many deletes."""
+        stats = table_stats.new_stats()
+        with self.lock.reading(), self.open_shelf(self.table_path()) as file_name:
+            for row in file_name.values():
+                table_stats.add_row(stats, row)
+        with self.catalog_lock.writing(invalidate=False):
+            data_file = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                table_info = data_file[self.name]
+                table_info["stats"] = stats
+                data_file[self.name] = table_info
+            finally:
+                data_file.close()
+        self.stats = stats
+        self.stats_delta = table_stats.new_stats()
+
+    def statistics(self) -> Dict[str, Any]:
+        stats = self.current_stats()
+        return {"row_count": stats["row_count"], "fields": table_stats.field_summary(stats, self.field_names())}
+
+    def new_row(self, values: Dict[str, Any]) -> Dict[str, Any]:
         has_primary_key = True if values.get(self.key_field_name) else False
         if not has_primary_key:
             raise ValueError
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            is_record_exists = True if file_name[self.name].get(values[self.key_field_name]) else False
+        field_names = self.field_names()
+        if any(field not in field_names for field in values):  # insert unnecessary fields
+            raise ValueError
+        row = {field: values.get(field) for field in field_names}
+        if self.codec is not None:
+            self.codec.check(row)
+        return row
+
+    @instrumented('insert_record')
+    def insert_record(self, values: Dict[str, Any]) -> None:
+        with self.writing():
+            row = self.new_row(values)
+            key = row[self.key_field_name]
+            with self.open_shelf(self.table_path()) as file_name:
+                if shelf_key(key) in file_name:  # record already exists
+                    raise ValueError
+                with self.logged('insert', [row]):
+                    file_name[shelf_key(key)] = row
+                    self.cache.invalidate(shelf_key(key))
+                    self.insert_into_hash_index(row)
+                    self.insert_into_ordered_index(row)
+                    self.update_covering_indexes([(None, row)])
+                table_stats.add_row(self.stats_delta, row)
+            self.after_write()
 
-            if is_record_exists:  # record already exists
+    @instrumented('insert_records')
+    def insert_records(self, records: Iterable[Dict[str, Any]], batch_size: int = 1000) -> List[Tuple[int, Exception]]:
+        """Insert records batch by batch and return (position, error) for every record that was rejected."""
+        with self.writing():
+            if batch_size < 1:
                 raise ValueError
-            file_name[self.name][values[self.key_field_name]] = {}
+            failures = []
+            batch = []
+            for position, values in enumerate(records):
+                try:
+                    batch.append((position, self.new_row(values)))
+                except ValueError as error:
+                    failures.append((position, error))
+                if len(batch) == batch_size:
+                    self.insert_batch(batch, failures)
+                    batch = []
+            if batch:
+                self.insert_batch(batch, failures)
+            return failures
 
-            for dbfield in self.fields:
-                field = dbfield.name
-                if field == self.key_field_name:
+    def insert_batch(self, batch: List[Tuple[int, Dict[str, Any]]], failures: List[Tuple[int, Exception]]) -> None:
+        field_names = self.field_names()
+        postings = {field: {} for i, field in enumerate(field_names) if self.hash_index[i]}
+        ordered_entries = {field: [] for i, field in enumerate(field_names) if self.ordered_index[i]}
+        with self.open_shelf(self.table_path()) as file_name:
+            rows = {}
+            for position, row in batch:
+                key = shelf_key(row[self.key_field_name])
+                if key in file_name or key in rows:  # record already exists
+                    failures.append((position, ValueError()))
                     continue
-                file_name[self.name][values[self.key_field_name]][field] = values[field] if values.get(field) else None
-                values.pop(field)
+                rows[key] = row
+            if not rows:
+                return
 
-            if 1 < len(values):  # insert unnecessary fields
-                self.delete_record(values[self.key_field_name])
-                raise ValueError
-
-            self.insert_into_hash_index(values)
+            with self.logged('insert', list(rows.values())):
+                for key, row in rows.items():
+                    file_name[key] = row
+                    self.cache.invalidate(key)
+                    table_stats.add_row(self.stats_delta, row)
+                    for field, field_postings in postings.items():
+                        if row[field] is not None:
+                            field_postings.setdefault(shelf_key(row[field]), []).append(row[self.key_field_name])
+                    for field, entries in ordered_entries.items():
+                        entries.append((row[field], row[self.key_field_name]))
 
-        finally:
-            file_name.close()
+                for field, field_postings in postings.items():  # update hash_index once per batch
+                    with self.open_shelf(self.index_path(field)) as index_file:
+                        for value_key, keys in field_postings.items():
+                            index_file[value_key] = index_file.get(value_key, []) + keys
+                for field, entries in ordered_entries.items():
+                    with self.open_shelf(self.ordered_index_path(field)) as index_file:
+                        ordered_index = OrderedIndex(index_file)
+                        for value, key in sorted(entries, key=null_last):
+                            ordered_index.insert(value, key)
+                self.update_covering_indexes([(None, row) for row in rows.values()])
+        self.after_write()
 
+    @instrumented('delete_record')
     def delete_record(self, key: Any) -> None:
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            is_key_exist = True if file_name[self.name].get(key) else False
+        with self.writing():
+            with self.open_shelf(self.table_path()) as file_name:
+                row = file_name.get(shelf_key(key))
+                if row is None:
+                    raise ValueError
+                with self.logged('delete', key, row):
+                    self.delete_from_hash_index(row)
+                    self.delete_from_ordered_index(row)
+                    self.update_covering_indexes([(row, None)])
+                    del file_name[shelf_key(key)]
+                    self.cache.invalidate(shelf_key(key))
+                table_stats.add_row(self.stats_delta, {}, -1)
+            self.after_write()
 
-            if not is_key_exist:
-                raise ValueError
+    @instrumented('delete_records')
+    def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        """Delete the matching rows in one pass over the table and one per index. Returns the number deleted."""
+        with self.writing(), self.open():
+            rows = self.rows_to_change(criteria)
+            if not rows:
+                return 0
+            with self.open_shelf(self.table_path()) as file_name:
+                with self.logged('delete_batch', rows):
+                    for row in rows:
+                        del file_name[shelf_key(row[self.key_field_name])]
+                        self.cache.invalidate(shelf_key(row[self.key_field_name]))
+                    self.update_indexes([(row, None) for row in rows])
+            table_stats.add_row(self.stats_delta, {}, -len(rows))
+            self.after_write()
+            return len(rows)
 
-            self.delete_from_hash_index(file_name, key)
-            file_name[self.name].pop(key)
-        finally:
-            file_name.close()
+    def rows_to_change(self, criteria: List[SelectionCriteria]) -> List[Dict[str, Any]]:
+        if any(criterion.field_name not in self.field_names() for criterion in criteria):
+            raise ValueError
+        return list(self.iter_matching_rows(criteria))
 
-    def delete_records(self, criteria: List[SelectionCriteria]) -> None:
-        list_to_delete = self.query_table(criteria)
-        for row in list_to_delete:
-            key = row[self.key_field_name]
-            self.delete_record(key)
+    def update_indexes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) -> None:
+        """Apply (old row, new row) changes to each index in one batch; None is a missing row."""
+        for i, field in enumerate(self.field_names()):
+            if not self.hash_index[i] and not self.ordered_index[i]:
+                continue
+            removed, added = [], []
+            for old_row, new_row in changes:
+                old_value = old_row[field] if old_row is not None else None
+                new_value = new_row[field] if new_row is not None else None
+                if old_value == new_value and old_row is not None and new_row is not None:
+                    continue
+                key = (old_row or new_row)[self.key_field_name]
+                if old_row is not None:  # None values only go in the ordered index
+                    removed.append((old_value, key))
+                if new_row is not None:
+                    added.append((new_value, key))
+            if self.hash_index[i]:
+                postings = {}  # value key -> (keys to remove, keys to add)
+                for value, key in removed:
+                    if value is not None:
+                        postings.setdefault(shelf_key(value), (set(), []))[0].add(key)
+                for value, key in added:
+                    if value is not None:
+                        postings.setdefault(shelf_key(value), (set(), []))[1].append(key)
+                with self.open_shelf(self.index_path(field)) as index_file:
+                    for value_key, (removed_keys, added_keys) in postings.items():
+                        keys = [key for key in index_file.get(value_key, []) if key not in removed_keys] + added_keys
+                        if keys:
+                            index_file[value_key] = keys
+                        elif value_key in index_file:
+                            del index_file[value_key]
+            if self.ordered_index[i]:
+                with self.open_shelf(self.ordered_index_path(field)) as index_file:
+                    ordered_index = OrderedIndex(index_file)
+                    for value, key in sorted(removed, key=null_last):
+                        ordered_index.delete(value, key)
+                    for value, key in sorted(added, key=null_last):
+                        ordered_index.insert(value, key)
+        self.update_covering_indexes(changes)
+
+    def covering_entry(self, index: Dict[str, List[str]], row: Optional[Dict[str, Any]]) \
+            -> Optional[Tuple[str, str, Tuple]]:
+        """(indexed values key, primary key shelf key, (key, *included values)) of row, or None if not indexed."""
+        if row is None or any(row[field] is None for field in index["fields"]):
+            return None
+        return shelf_key(tuple(row[field] for field in index["fields"])), shelf_key(row[self.key_field_name]), \
+            (row[self.key_field_name],) + tuple(row[field] for field in index["include"])
 
+    def update_covering_indexes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]) \
+            -> None:
+        for index in self.covering_indexes:
+            removed, added = {}, {}  # indexed values key -> shelf keys to remove / {shelf key: entry} to add
+            for old_row, new_row in changes:
+                old_entry, new_entry = self.covering_entry(index, old_row), self.covering_entry(index, new_row)
+                if old_entry == new_entry:
+                    continue
+                if old_entry is not None:
+                    removed.setdefault(old_entry[0], []).append(old_entry[1])
+                if new_entry is not None:
+                    added.setdefault(new_entry[0], {})[new_entry[1]] = new_entry[2]
+            if not removed and not added:
+                continue
+            with self.open_shelf(self.covering_index_path(index)) as index_file:
+                for value_key in set(removed) | set(added):
+                    entries = index_file.get(value_key, {})
+                    for key in removed.get(value_key, []):
+                        entries.pop(key, None)
+                    entries.update(added.get(value_key, {}))
+                    if entries:
+                        index_file[value_key] = entries
+                    elif value_key in index_file:
+                        del index_file[value_key]
+
+    @instrumented('get_record')
     def get_record(self, key: Any) -> Dict[str, Any]:
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            is_key_exist = True if file_name[self.name].get(key) else False
-            if not is_key_exist:
+        with self.lock.reading():
+            row = self.cache.get(shelf_key(key))
+            if row is not None:
+                return row
+            with self.open_shelf(self.table_path()) as file_name:
+                row = file_name.get(shelf_key(key))
+            if row is None:
                 raise ValueError
-            row = file_name[self.name][key]
-        finally:
-            file_name.close()
-        row[self.key_field_name] = key
-        return row
+            self.cache.put(shelf_key(key), row)
+            return row
 
+    @instrumented('update_record')
     def update_record(self, key: Any, values: Dict[str, Any]) -> None:
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            is_key_exist = True if file_name[self.name].get(key) else False
-
-            if not is_key_exist:
+        with self.writing():
+            if self.key_field_name in values:  # cannot update the primary key
                 raise ValueError
-            updated_row = {}
-
-            if values.get(self.key_field_name):  # cannot update the primary key
+            field_names = self.field_names()
+            if any(field not in field_names for field in values):  # update unnecessary fields
                 raise ValueError
+            with self.open_shelf(self.table_path()) as file_name:
+                row = file_name.get(shelf_key(key))
+                if row is None:
+                    raise ValueError
+                updated_row = dict(row)
+                updated_row.update(values)
+                if self.codec is not None:
+                    self.codec.check(updated_row)
+                with self.logged('update', key, row, updated_row):
+                    for i, field in enumerate(field_names):
+                        if self.hash_index[i] and row[field] != updated_row[field]:  # update hash_index
+                            self.update_hash_index(field, key, row[field], updated_row[field])
+                        if self.ordered_index[i] and row[field] != updated_row[field]:
+                            self.update_ordered_index(field, key, row[field], updated_row[field])
+                    self.update_covering_indexes([(row, updated_row)])
+                    file_name[shelf_key(key)] = updated_row
+                    self.cache.put(shelf_key(key), updated_row)
+                table_stats.add_row(self.stats_delta, values, 0)
+            self.after_write()
 
-            for dbfield in self.fields:
-                field = dbfield.name
-                if field == self.key_field_name:
-                    continue
+    @instrumented('update_records')
+    def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        """Set values on the matching rows in one pass over the table and one per index. Returns the number updated."""
+        if self.key_field_name in values:  # cannot update the primary key
+            raise ValueError
+        if any(field not in self.field_names() for field in values):
+            raise ValueError
+        if self.codec is not None:
+            self.codec.check(values)
+        with self.writing(), self.open():
+            changes = [(row, dict(row, **values)) for row in self.rows_to_change(criteria)]
+            if not changes:
+                return 0
+            with self.open_shelf(self.table_path()) as file_name:
+                with self.logged('update_batch', changes):
+                    self.update_indexes(changes)
+                    for row, updated_row in changes:
+                        file_name[shelf_key(row[self.key_field_name])] = updated_row
+                        self.cache.put(shelf_key(row[self.key_field_name]), updated_row)
+            table_stats.add_row(self.stats_delta, values, 0)
+            self.after_write()
+            return len(changes)
 
-                if values.get(field):
-                    index = self.fields.index(dbfield)
-                    if self.hash_index[index]:  # update hash_index
-                        self.update_hash_index(file_name, values, key, field)
-                    updated_row[field] = values[field]
-                    values.pop(field)
-                else:
-                    updated_row[field] = file_name[self.name][key][field]
+    @instrumented('query_table')
+    def query_table(self, criteria: List[SelectionCriteria], order_by: List[Union[SortKey, str]] = None,
+                    limit: int = None) -> List[Dict[str, Any]]:
+        return list(self.iter_query(criteria, order_by=order_by, limit=limit))
 
-            if values:  # insert unnecessary fields
-                raise ValueError
-            file_name[self.name][key] = updated_row
+    @instrumented('iter_query')
+    def iter_query(self, criteria: List[SelectionCriteria], fields: List[str] = None, limit: int = None,
+                   order_by: List[Union[SortKey, str]] = None) -> Iterator[Dict[str, Any]]:
+        """Lazily yield the matching rows, projected on fields when given, and stop reading after limit rows.
+
+        order_by is a list of SortKey (or field names for ascending order); None values sort last.
+        The rows are read in batches under the read lock, which is released before they are yielded.
+        """
+        field_names = self.field_names()
+        if any(criterion.field_name not in field_names for criterion in criteria):
+            raise ValueError
+        if fields is not None and any(field not in field_names for field in fields):
+            raise ValueError
+        order_by = [SortKey(sort) if isinstance(sort, str) else sort for sort in order_by or []]
+        if any(sort.field_name not in field_names for sort in order_by):
+            raise ValueError
+        if limit is not None and limit <= 0:
+            return
+
+        needed = None if fields is None else set(fields) | {sort.field_name for sort in order_by}
+        rows = self.iter_ordered_rows(criteria, order_by, limit, needed) if order_by else \
+            self.iter_matching_rows(criteria, needed)
+        for row in self.locked_batches(rows, limit):
+            yield row if fields is None else {field: row[field] for field in fields}
+
+    def locked_batches(self, rows: Iterator[Dict[str, Any]], limit: int = None) -> Iterator[Dict[str, Any]]:
+        """Yield up to limit rows, reading QUERY_BATCH_ROWS of them at a time under the read lock.
+
+        The lock is not held while the caller has the rows, so a paused iteration does not block writers
+        and the caller may write to the table between rows. Writes made meanwhile may or may not be seen.
+        """
+        returned_rows = 0
+        try:
+            while limit is None or returned_rows < limit:
+                size = QUERY_BATCH_ROWS if limit is None else min(QUERY_BATCH_ROWS, limit - returned_rows)
+                with self.lock.reading():
+                    batch = list(itertools.islice(rows, size))
+                yield from batch
+                returned_rows += len(batch)
+                if len(batch) < size:
+                    return
+        finally:
+            rows.close()
+
+    def iter_matching_rows(self, criteria: List[SelectionCriteria], fields: Iterable[str] = None) \
+            -> Iterator[Dict[str, Any]]:
+        """Yield the matching rows; with fields, rows may hold only those fields when an index covers them."""
+        is_match = self.compile_criteria(criteria)
+        plan = self.plan_query(criteria, fields)
+        if self.instrumentation is not None:
+            self.instrumentation.count(self.name, "full_scans" if plan["plan"] == FULL_SCAN_PLAN else "index_lookups")
+        if plan["plan"] == FULL_SCAN_PLAN and self.scan_pool is not None and \
+                plan["estimated_rows"] >= self.scan_pool.min_rows:
+            yield from self.parallel_scan(criteria)
+            return
+        if plan["plan"] == COVERING_INDEX_PLAN:  # never opens the table file
+            yield from self.counted_rows(self.iter_covering_index(plan["index"], criteria), is_match)
+            return
+        with self.open_shelf(self.table_path()) as file_name:
+            if plan["plan"] == FULL_SCAN_PLAN and isinstance(file_name, RecordShelf):
+                # decode only the criteria fields of each record, and the whole record when they match
+                fields = [criterion.field_name for criterion in criteria]
+                yield from self.counted_rows(file_name.raw_values(),
+                                             lambda data: is_match(self.codec.decode(data, fields)), self.codec.decode)
+                return
+            yield from self.counted_rows(self.execute_plan(file_name, plan, criteria), is_match)
+
+    def counted_rows(self, rows: Iterable[Any], is_match: Callable[[Any], bool],
+                     decode: Callable[[Any], Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        examined = returned = 0
+        try:
+            for row in rows:
+                examined += 1
+                if is_match(row):
+                    returned += 1
+                    yield row if decode is None else decode(row)
         finally:
-            file_name.close()
+            if self.instrumentation is not None:
+                self.instrumentation.count(self.name, "rows_examined", examined)
+                self.instrumentation.count(self.name, "rows_returned", returned)
 
-    def query_table(self, criteria: List[SelectionCriteria]) -> List[Dict[str, Any]]:
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
+    def parallel_scan(self, criteria: List[SelectionCriteria]) -> Iterator[Dict[str, Any]]:
+        """Split the keys among the scan workers, which read the table file and filter the rows themselves."""
+        with self.open_shelf(self.table_path()) as file_name:
+            if self.open_count:  # the workers only see what is on disk
+                file_name.sync()
+            keys = list(file_name.keys())
+        returned = 0
         try:
+            for row in self.scan_pool.scan(os.path.abspath(self.table_path()), keys, criteria, self.codec):
+                returned += 1
+                yield row
+        finally:
+            if self.instrumentation is not None:  # the workers examine every row
+                self.instrumentation.count(self.name, "rows_examined", len(keys))
+                self.instrumentation.count(self.name, "rows_returned", returned)
+
+    def iter_ordered_rows(self, criteria: List[SelectionCriteria], order_by: List[SortKey],
+                          limit: Optional[int], fields: Iterable[str] = None) -> Iterator[Dict[str, Any]]:
+        field_names = self.field_names()
+        field = order_by[0].field_name
+        if len(order_by) == 1 and self.ordered_index[field_names.index(field)]:
+            plan = self.plan_query(criteria, fields)
+            if plan["plan"] == FULL_SCAN_PLAN or (plan["plan"] == ORDERED_INDEX_PLAN and plan["fields"] == [field]):
+                yield from self.ordered_rows(field, criteria, order_by[0].descending)  # walk the index in order
+                if range_bounds(criteria, field) is None:  # None never falls in a range
+                    yield from self.iter_null_rows(field, criteria)
+                return
+        if limit is not None:  # keep only the best limit rows in a bounded heap
+            yield from heapq.nsmallest(limit, self.iter_matching_rows(criteria, fields), key=sort_key(order_by))
+        else:
+            yield from sorted(self.iter_matching_rows(criteria, fields), key=sort_key(order_by))
+
+    def plan_query(self, criteria: List[SelectionCriteria], fields: Iterable[str] = None) -> Dict[str, Any]:
+        """Choose between the primary key, the hash, composite and ordered indexes and a full scan by estimated cost.
+
+        fields are the fields the caller needs (None for whole rows); a covering index holding them and
+        every criteria field answers the query by itself.
+        """
+        stats = self.current_stats()
+        row_count = max(stats["row_count"], 0)
+        plans = []
+        if any(criterion.field_name == self.key_field_name and criterion.operator == "=" for criterion in criteria):
+            plans.append({"plan": PRIMARY_KEY_PLAN, "fields": [self.key_field_name], "estimated_rows": 1,
+                          "cost": ROW_FETCH_COST})
+
+        hash_fields = [field for i, field in enumerate(self.field_names()) if self.hash_index[i] and any(
+            criterion.field_name == field and criterion.operator == "=" for criterion in criteria)]
+        if hash_fields:
+            selectivity = 1.0
+            for field in hash_fields:
+                selectivity *= table_stats.equality_rows(stats, field) / row_count if row_count else 0
+            estimated_rows = row_count * selectivity
+            plans.append({"plan": HASH_INDEX_PLAN, "fields": hash_fields, "estimated_rows": estimated_rows,
+                          "cost": estimated_rows * ROW_FETCH_COST + len(hash_fields) * INDEX_PROBE_COST})
+
+        needed = set(self.field_names() if fields is None else fields) | {criterion.field_name for criterion in criteria}
+        for index in self.covering_indexes:
+            if not all(any(criterion.field_name == field and criterion.operator == "=" for criterion in criteria)
+                       for field in index["fields"]):
+                continue
+            selectivity = 1.0
+            for field in index["fields"]:
+                selectivity *= table_stats.equality_rows(stats, field) / row_count if row_count else 0
+            estimated_rows = row_count * selectivity
+            if needed <= set(index["fields"]) | set(index["include"]) | {self.key_field_name}:
+                plans.append({"plan": COVERING_INDEX_PLAN, "fields": index["fields"], "index": index,
+                              "estimated_rows": estimated_rows,
+                              "cost": estimated_rows * INDEX_ENTRY_COST + INDEX_PROBE_COST})
+            else:
+                plans.append({"plan": COMPOSITE_INDEX_PLAN, "fields": index["fields"], "index": index,
+                              "estimated_rows": estimated_rows,
+                              "cost": estimated_rows * ROW_FETCH_COST + INDEX_PROBE_COST})
+
+        for i, field in enumerate(self.field_names()):
+            bounds = range_bounds(criteria, field) if self.ordered_index[i] else None
+            if bounds is not None:
+                estimated_rows = table_stats.range_rows(stats, field, bounds)
+                plans.append({"plan": ORDERED_INDEX_PLAN, "fields": [field], "estimated_rows": estimated_rows,
+                              "cost": estimated_rows * ROW_FETCH_COST + INDEX_PROBE_COST})
+
+        plans.append({"plan": FULL_SCAN_PLAN, "fields": [], "estimated_rows": row_count, "cost": row_count})
+        return min(plans, key=lambda plan: plan["cost"])
+
+    def estimate_rows(self, criteria: List[SelectionCriteria]) -> float:
+        """The rows the criteria are expected to match: the plan's estimate, narrowed by the criteria it does not
+        apply through an index."""
+        stats = self.current_stats()
+        row_count = max(stats["row_count"], 0)
+        plan = self.plan_query(criteria)
+        estimated_rows = plan["estimated_rows"]
+        for criterion in criteria:
+            if criterion.field_name not in plan["fields"] and row_count:
+                estimated_rows *= min(table_stats.criterion_rows(stats, criterion) / row_count, 1.0)
+        return estimated_rows
+
+    def execute_plan(self, file_name, plan: Dict[str, Any], criteria: List[SelectionCriteria]) \
+            -> Iterator[Dict[str, Any]]:
+        if plan["plan"] == PRIMARY_KEY_PLAN:
             for criterion in criteria:  # If the criterion is on the key
                 if criterion.field_name == self.key_field_name and criterion.operator == "=":
-                    return self.query_on_primary_key(file_name, criterion)
-
-            desired_rows, is_query_on_index = self.query_on_index(file_name, criteria)
-            if is_query_on_index:
-                return desired_rows
-
-            desired_rows = []
-            for row in file_name[self.name]:
-                for criterion in criteria:
-                    if criterion.field_name == self.key_field_name:  # if the condition is on the primary key
-                        if self.__is_condition_hold({criterion.field_name:row}, criterion) is False:
-                            break
-                    elif file_name[self.name][row].get(criterion.field_name) is None:  # if this field is'nt exist
-                        raise ValueError
-                    elif self.__is_condition_hold(file_name[self.name][row], criterion) is False:
-                        break
+                    return iter(self.query_on_primary_key(file_name, criterion))
+        if plan["plan"] == COVERING_INDEX_PLAN:
+            return self.iter_covering_index(plan["index"], criteria)
+        if plan["plan"] == HASH_INDEX_PLAN:
+            keys = self.query_on_index(criteria)
+        elif plan["plan"] == COMPOSITE_INDEX_PLAN:
+            keys = [row[self.key_field_name] for row in self.iter_covering_index(plan["index"], criteria)]
+        elif plan["plan"] == ORDERED_INDEX_PLAN:
+            field = plan["fields"][0]
+            keys = self.iter_ordered_index(field, range_bounds(criteria, field))
+        else:
+            return iter(file_name.values())
+        return self.fetch_rows(file_name, keys)
 
-                else:
-                    result = file_name[self.name][row]
-                    result[self.key_field_name] = row
-                    desired_rows.append(result)
-        finally:
-            file_name.close()
-        return desired_rows
+    def fetch_rows(self, file_name, keys: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+        """The rows of keys, skipping the ones deleted since the keys were read."""
+        for key in keys:
+            row = file_name.get(shelf_key(key))
+            if row is not None:
+                yield row
 
-    def create_index(self, field_to_index: str) -> None:
-        if field_to_index == self.key_field_name:  # No need to index the primary key
-            return
-        field_names = [field.name for field in self.fields]
-        index = field_names.index(field_to_index)
-        is_index_exist = True if self.hash_index[index] else False
-        if is_index_exist:
+    def explain(self, criteria: List[SelectionCriteria], fields: List[str] = None) -> Dict[str, Any]:
+        """Return the plan query_table (or iter_query with fields) would use, with its estimated and actual rows
+        read and the rows returned."""
+        with self.lock.reading():
+            field_names = self.field_names()
+            if any(criterion.field_name not in field_names for criterion in criteria):
+                raise ValueError
+            is_match = self.compile_criteria(criteria)
+            plan = self.plan_query(criteria, fields)
+            actual_rows = returned_rows = 0
+            with ExitStack() as stack:
+                file_name = None if plan["plan"] == COVERING_INDEX_PLAN else \
+                    stack.enter_context(self.open_shelf(self.table_path()))
+                for row in self.execute_plan(file_name, plan, criteria):
+                    actual_rows += 1
+                    returned_rows += is_match(row)
+            return {"plan": plan["plan"], "fields": plan["fields"], "estimated_rows": plan["estimated_rows"],
+                    "actual_rows": actual_rows, "returned_rows": returned_rows}
+
+    def join_index_field(self, fields: List[str]) -> Optional[str]:
+        if self.key_field_name in fields:
+            return self.key_field_name
+        for i, field in enumerate(self.field_names()):
+            if self.hash_index[i] and field in fields:
+                return field
+        return None
+
+    @instrumented('create_index')
+    def create_index(self, field_to_index: Union[str, List[str]], kind: str = HASH_INDEX,
+                     include: List[str] = None) -> None:
+        """Index one field (hash or ordered). A list of fields and/or include=[...] makes a covering hash index
+        on the combined values of those fields that also stores the included fields, so equality queries on
+        all of its fields that need only the fields it holds never read the table file."""
+        if include is not None or not isinstance(field_to_index, str):
+            self.create_covering_index([field_to_index] if isinstance(field_to_index, str) else list(field_to_index),
+                                       list(include or []), kind)
             return
-        path_file = os.path.join('db_files', self.name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        path_index_file = os.path.join('db_files', f'{self.name}_{field_to_index}_hash_index.db')
-        index_file = shelve.open(path_index_file, writeback=True)
-        path_data_file = os.path.join('db_files', 'DataBase.db')
-        data_file = shelve.open(path_data_file, writeback=True)
-        try:
-            if not self.is_to_index_field_exist(file_name, field_to_index):
+        with self.writing():
+            if kind not in (HASH_INDEX, ORDERED_INDEX):
+                raise ValueError
+            if field_to_index == self.key_field_name and kind == HASH_INDEX:  # No need to hash the primary key
+                return
+            field_names = self.field_names()
+            if field_to_index not in field_names:
                 raise ValueError
+            index = field_names.index(field_to_index)
+            flags = self.hash_index if kind == HASH_INDEX else self.ordered_index
+            is_index_exist = True if flags[index] else False
+            if is_index_exist:
+                return
 
-            for row in file_name[self.name]:
-                value = file_name[self.name][row][field_to_index]
-                if value is None:
-                    continue
-                if index_file.get(value) is None:
-                    index_file[value] = list()
-                index_file[value].append(row)
+            postings = {}
+            entries = []
+            with self.open_shelf(self.table_path()) as file_name:
+                for row in file_name.values():
+                    value = row[field_to_index]
+                    if kind == ORDERED_INDEX:
+                        entries.append((value, row[self.key_field_name]))
+                    elif value is not None:
+                        postings.setdefault(shelf_key(value), []).append(row[self.key_field_name])
 
-            data_file[self.name]["hash_index"][index] = True
-            self.hash_index[index] = True
-        finally:
-            file_name.close()
-            index_file.close()
+            path_index_file = self.index_path(field_to_index) if kind == HASH_INDEX else \
+                self.ordered_index_path(field_to_index)
+            self.close_shelf(path_index_file)
+            remove_shelf_files(path_index_file)
+            with self.open_shelf(path_index_file) as index_file:
+                if kind == HASH_INDEX:
+                    index_file.update(postings)
+                else:
+                    OrderedIndex(index_file).bulk_load(entries)
+            flags[index] = True
+            self.save_index_flags()
 
-    def __is_condition_hold(self, data: Dict[Any, Any] , criterion: SelectionCriteria) -> bool:
-        if data[criterion.field_name] is None:
-            return False
-        if criterion.operator == "=":
-            return data[criterion.field_name] == criterion.value
-        if criterion.operator == "!=":
-            return data[criterion.field_name] != criterion.value
-        if criterion.operator == "<":
-            return data[criterion.field_name] < criterion.value
-        if criterion.operator == ">":
-            return data[criterion.field_name] > criterion.value
-        if criterion.operator == "<=":
-            return data[criterion.field_name] <= criterion.value
-        if criterion.operator == ">=":
-            return data[criterion.field_name] >= criterion.value
-        return eval(f'{data[criterion.field_name]}{criterion.operator}{criterion.value}')
-
-    def insert_into_hash_index(self, values: Dict[str, Any]):
-        for i in range(len(self.hash_index)):  # update hash_index
-            if self.hash_index[i]:
-                path_index_file = os.path.join('db_files', f'{self.name}_{self.fields[i].name}_hash_index.db')
-                index_file = shelve.open(path_index_file, writeback=True)
+    def create_covering_index(self, fields: List[str], include: List[str], kind: str = HASH_INDEX) -> None:
+        with self.writing():
+            field_names = self.field_names()
+            if kind != HASH_INDEX or not fields or len(set(fields)) != len(fields) or \
+                    any(field not in field_names for field in fields + include):
+                raise ValueError
+            include = [field for field in include if field not in fields and field != self.key_field_name]
+            if any(index["fields"] == fields and index["include"] == include for index in self.covering_indexes):
+                return
+            index = {"fields": fields, "include": include}
+            path_index_file = self.covering_index_path(index)
+            self.covering_indexes = [other for other in self.covering_indexes if other["fields"] != fields]
+            postings = {}
+            with self.open_shelf(self.table_path()) as file_name:
+                for row in file_name.values():
+                    entry = self.covering_entry(index, row)
+                    if entry is not None:
+                        postings.setdefault(entry[0], {})[entry[1]] = entry[2]
+            self.close_shelf(path_index_file)
+            remove_shelf_files(path_index_file)
+            with self.open_shelf(path_index_file) as index_file:
+                index_file.update(postings)
+            self.covering_indexes = self.covering_indexes + [index]
+            self.save_index_flags()
 
-                if values.get(self.fields[i].name):
-                    index_file[values[self.fields[i].name]].append(values[self.key_field_name])
-                index_file.close()
+    def iter_covering_index(self, index: Dict[str, List[str]], criteria: List[SelectionCriteria]) \
+            -> Iterator[Dict[str, Any]]:
+        """The rows in the index entry for the criteria's equality values, holding the key, indexed and included
+        fields only."""
+        values = tuple(next(criterion.value for criterion in criteria
+                            if criterion.field_name == field and criterion.operator == "=") for field in index["fields"])
+        with self.open_shelf(self.covering_index_path(index)) as index_file:
+            entries = index_file.get(shelf_key(values), {})
+        for entry in entries.values():
+            row = dict(zip(index["fields"], values))
+            row[self.key_field_name] = entry[0]
+            row.update(zip(index["include"], entry[1:]))
+            yield row
 
-    def delete_from_hash_index(self, file_name, key):
-        for i in range(len(self.hash_index)):  # update hash_index
-            if self.hash_index[i]:
-                if file_name[self.name][key][self.fields[i].name]:
-                    path_index_file = os.path.join('db_files', f'{self.name}_{self.fields[i].name}_hash_index.db')
-                    index_file = shelve.open(path_index_file, writeback=True)
-                    index_file[file_name[self.name][key][self.fields[i].name]].remove(key)
-                    index_file.close()
-
-    def update_hash_index(self, file_name, values, key, field):
-        path_index_file = os.path.join('db_files', f'{self.name}_{field}_hash_index.db')
-        index_file = shelve.open(path_index_file, writeback=True)
-        index_file[file_name[self.name][key][field]].remove(key)
-        if values[field]:
-            if index_file.get(values[field]) is None:
-                index_file[values[field]] = list()
-            index_file[values[field]].append(key)
-        index_file.close()
+    def save_index_flags(self) -> None:
+        with self.catalog_lock.writing():
+            data_file = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                table_info = data_file[self.name]
+                table_info["hash_index"] = self.hash_index
+                table_info["ordered_index"] = self.ordered_index
+                table_info["covering_indexes"] = self.covering_indexes
+                data_file[self.name] = table_info
+            finally:
+                data_file.close()
 
-    def query_on_primary_key(self, file_name, criterion):
-        if file_name[self.name].get(criterion.value):
-            result = file_name[self.name][criterion.value]
-            result[self.key_field_name] = criterion.value
-            return [result]
-        return []
+    def iter_ordered(self, field: str, criteria: List[SelectionCriteria] = None,
+                     descending: bool = False) -> Iterator[Dict[str, Any]]:
+        """Yield the rows matching criteria in field order, walking the field's ordered index in batches under the
+        read lock."""
+        criteria = criteria if criteria else []
+        field_names = self.field_names()
+        if field not in field_names or not self.ordered_index[field_names.index(field)]:
+            raise ValueError
+        if any(criterion.field_name not in field_names for criterion in criteria):
+            raise ValueError
+        yield from self.locked_batches(self.ordered_rows(field, criteria, descending))
 
-    def query_on_index(self, file_name, criteria):
-        indexes = []
+    def ordered_rows(self, field: str, criteria: List[SelectionCriteria], descending: bool) \
+            -> Iterator[Dict[str, Any]]:
+        is_match = self.compile_criteria(criteria)
+        bounds = range_bounds(criteria, field) or (None, True, None, True)
+        if self.instrumentation is not None:
+            self.instrumentation.count(self.name, "index_lookups")
+        with self.open_shelf(self.table_path()) as file_name:
+            rows = self.fetch_rows(file_name, self.iter_ordered_index(field, bounds, descending))
+            yield from self.counted_rows(rows, is_match)
 
-        for i in range(len(self.hash_index)):
-            if self.hash_index[i]:
-                if indexes:
-                    break
+    def iter_null_rows(self, field: str, criteria: List[SelectionCriteria]) -> Iterator[Dict[str, Any]]:
+        """Yield the rows matching criteria whose field is None, found through the field's ordered index."""
+        is_match = self.compile_criteria(criteria)
+        with self.open_shelf(self.ordered_index_path(field)) as index_file:
+            keys = OrderedIndex(index_file).null_keys()
+        with self.open_shelf(self.table_path()) as file_name:
+            yield from self.counted_rows(self.fetch_rows(file_name, keys), is_match)
 
-                for criterion in criteria:
-                    if self.fields[i].name == criterion.field_name and criterion.operator == "=":
-                        path_index_file = os.path.join('db_files', f'{self.name}_{self.fields[i].name}_hash_index.db')
-                        index_file = shelve.open(path_index_file, writeback=True)
+    def compile_criteria(self, criteria: List[SelectionCriteria]) -> Callable[[Dict[str, Any]], bool]:
+        stats = self.current_stats()
+        return predicates.compile_criteria(criteria, lambda criterion: table_stats.criterion_rows(stats, criterion))
 
-                        if index_file.get(criterion.value):
-                            indexes = index_file[criterion.value]
-                        index_file.close()
+    def insert_into_hash_index(self, row: Dict[str, Any]):
+        for i, field in enumerate(self.field_names()):  # update hash_index
+            if self.hash_index[i] and row[field] is not None:
+                with self.open_shelf(self.index_path(field)) as index_file:
+                    keys = index_file.get(shelf_key(row[field]), [])
+                    keys.append(row[self.key_field_name])
+                    index_file[shelf_key(row[field])] = keys
 
-                        if not indexes:
-                            return [], True
-                        break
+    def delete_from_hash_index(self, row: Dict[str, Any]):
+        for i, field in enumerate(self.field_names()):  # update hash_index
+            if self.hash_index[i] and row[field] is not None:
+                with self.open_shelf(self.index_path(field)) as index_file:
+                    remove_posting(index_file, shelf_key(row[field]), row[self.key_field_name])
 
-        desired_rows = []
-        if indexes:
+    def update_hash_index(self, field, key, old_value, new_value):
+        with self.open_shelf(self.index_path(field)) as index_file:
+            if old_value is not None:
+                remove_posting(index_file, shelf_key(old_value), key)
+            if new_value is not None:
+                keys = index_file.get(shelf_key(new_value), [])
+                keys.append(key)
+                index_file[shelf_key(new_value)] = keys
 
-            for i in indexes:
-                for criterion in criteria:
-                    if self.__is_condition_hold(file_name[self.name][i], criterion) is False:
-                        break
-                else:
-                    result = file_name[self.name][i]
-                    result[self.key_field_name] = i
-                    desired_rows.append(result)
-            return desired_rows, True
-        return desired_rows, False
+    def insert_into_ordered_index(self, row: Dict[str, Any]):
+        for i, field in enumerate(self.field_names()):
+            if self.ordered_index[i]:
+                with self.open_shelf(self.ordered_index_path(field)) as index_file:
+                    OrderedIndex(index_file).insert(row[field], row[self.key_field_name])
+
+    def delete_from_ordered_index(self, row: Dict[str, Any]):
+        for i, field in enumerate(self.field_names()):
+            if self.ordered_index[i]:
+                with self.open_shelf(self.ordered_index_path(field)) as index_file:
+                    OrderedIndex(index_file).delete(row[field], row[self.key_field_name])
 
-    def is_to_index_field_exist(self, file_name, field_to_index):
-        for row in file_name[self.name]:  # just one iteration
-            if file_name[self.name][row].get(field_to_index) is None:
-                return False
-            return True
+    def update_ordered_index(self, field, key, old_value, new_value):
+        with self.open_shelf(self.ordered_index_path(field)) as index_file:
+            ordered_index = OrderedIndex(index_file)
+            ordered_index.delete(old_value, key)
+            ordered_index.insert(new_value, key)
+
+    def query_on_primary_key(self, file_name, criterion):
+        row = self.cache.get(shelf_key(criterion.value))
+        if row is None:
+            row = file_name.get(shelf_key(criterion.value))
+            if row is not None:
+                self.cache.put(shelf_key(criterion.value), row)
+        return [row] if row is not None else []
+
+    def query_on_index(self, criteria) -> Optional[List[Any]]:
+        postings = []
+        for i, field in enumerate(self.field_names()):
+            if not self.hash_index[i]:
+                continue
+            values = set(shelf_key(criterion.value) for criterion in criteria
+                         if field == criterion.field_name and criterion.operator == "=")
+            if values:
+                with self.open_shelf(self.index_path(field)) as index_file:
+                    postings.extend(index_file.get(value, []) for value in values)
+        if not postings:
+            return None
+
+        postings.sort(key=len)  # intersect smallest-first
+        keys = postings[0]
+        for posting in postings[1:]:
+            if not keys:
+                break
+            posting_keys = set(posting)
+            keys = [key for key in keys if key in posting_keys]
+        return keys
+
+    def iter_ordered_index(self, field: str, bounds: Tuple[Any, bool, Any, bool],
+                           descending: bool = False) -> Iterator[Any]:
+        low, include_low, high, include_high = bounds
+        with self.open_shelf(self.ordered_index_path(field)) as index_file:
+            for value, key in OrderedIndex(index_file).range(low, high, include_low, include_high, descending):
+                yield key
 
 
 @dataclass_json
 @dataclass
 class DataBase(db_api.DataBase):
-    db_tables = {}
     # Put here any instance information needed to support the API
 
-    def __init__(self):
-        path_file = os.path.join('db_files', 'DataBase.db')
-        file_name = shelve.open(path_file, writeback=True)
-        for table_name in file_name:
-            DataBase.db_tables[table_name] = DBTable(table_name, file_name[table_name]["fields"], file_name[table_name]["key_field_name"])
+    def __init__(self, wal: bool = False, parallelism: int = 1, instrument: bool = False,
+                 hook: Callable[[Dict[str, Any]], None] = None, root: Union[str, Path] = db_api.DB_ROOT):
+        """Open the database kept in the directory root, creating it if needed.
+
+        Nothing is read up front: a table's catalog entry is read when first needed and cached until another
+        writer changes the catalog, and its handle is built on its first get_table. Only get_tables_names and
+        num_tables read every entry.
+        """
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.catalog_lock = catalog_lock(self.root)
+        self.catalog_lock.add_listener(self)
+        self.catalog = {}  # table name -> catalog entry, None for a name without one
+        self.is_catalog_complete = False  # whether catalog holds every entry
+        self.is_migrated = False
+        self.db_tables = {}  # table name -> handle
+        self.table_shapes = {}  # table name -> table_shape() of the entry its handle was built from
+        self.scan_pool = ScanPool(parallelism) if parallelism > 1 else None
+        self.instrumentation = Instrumentation(hook) if instrument or hook is not None else None
+        self.wal = None
+        if wal:
+            self.recover()
+            self.wal = WriteAheadLog(new_log_path(self.root), flush_tables=self.sync_tables)
+            for table in self.db_tables.values():  # the handles recovery built, before there was a log
+                table.attach(self.wal, self.scan_pool, self.instrumentation)
+
+    def files_changed(self) -> None:
+        self.forget_catalog()
+
+    def forget_catalog(self) -> None:
+        self.catalog = {}
+        self.is_catalog_complete = False
+
+    def catalog_path(self) -> str:
+        return os.path.join(self.root, 'DataBase.db')
 
-    def create_table(self, table_name: str,  fields: List[DBField],  key_field_name: str) -> DBTable:
-        is_table_exist = True if DataBase.db_tables.get(table_name) else False
-        if is_table_exist:
+    def migrate(self) -> None:
+        if not self.is_migrated:
+            if catalog_format(self.root) != CATALOG_FORMAT:  # read without the exclusive lock
+                with self.catalog_lock.writing():
+                    migrate_db_files(self.root)
+            self.is_migrated = True
+
+    def catalog_entry(self, table_name: str) -> Optional[Dict[str, Any]]:
+        """The catalog entry of table_name, or None if it has none; only that entry is read."""
+        if table_name in self.catalog or self.is_catalog_complete:
+            return self.catalog.get(table_name)
+        self.migrate()
+        with self.catalog_lock.reading():
+            file_name = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                table_info = file_name.get(table_name)
+            finally:
+                file_name.close()
+            self.catalog[table_name] = table_info
+        return table_info
+
+    def catalog_entries(self) -> Dict[str, Dict[str, Any]]:
+        """Every catalog entry, by table name."""
+        if not self.is_catalog_complete:
+            self.migrate()
+            with self.catalog_lock.reading():
+                file_name = dbm_sqlite.open_shelf(self.catalog_path())
+                try:
+                    self.catalog = {table_name: file_name[table_name] for table_name in file_name}
+                finally:
+                    file_name.close()
+                self.is_catalog_complete = True
+        return self.catalog
+
+    def load_table(self, table_name: str, table_info: Dict[str, Any]) -> DBTable:
+        arguments = [table_name, table_info["fields"], table_info["key_field_name"],
+                     table_info["hash_index"], table_info.get("ordered_index")]
+        if table_info.get("partitions"):
+            from partitioned import PartitionedDBTable  # imports db, so only imported when used
+            table = PartitionedDBTable(*arguments, table_info["partitions"], table_info["generation"],
+                                       root=self.root)
+        else:
+            table = self.table_class(table_info.get("engine", ROW_ENGINE))(*arguments, root=self.root)
+        table.covering_indexes = table_info.get("covering_indexes", [])
+        for storage in table.storage_tables():
+            storage_info = table_info if storage is table else self.catalog_entry(storage.name)
+            if storage_info.get("codec") != CODEC_VERSION:  # rows are pickled dicts
+                storage.codec = None
+            storage.covering_indexes = storage_info.get("covering_indexes", [])
+        table.attach(self.wal, self.scan_pool, self.instrumentation)
+        if "stats" not in table_info:
+            table.analyze()
+        self.db_tables[table_name] = table
+        self.table_shapes[table_name] = table_shape(table_info)
+        return table
+
+    def recover(self) -> None:
+        """Redo the writes logged since the last checkpoint of every log left by a database that was not closed,
+        then remove those logs."""
+        for log in abandoned_logs(self.root, flush_tables=self.sync_tables):
+            storage_tables = {}
+            recovered = set()
+            for table_name, operation, *arguments in log.records():
+                if table_name not in storage_tables and self.catalog_entry(table_name) is not None:
+                    table = self.get_table(self.catalog_entry(table_name).get("partition_of", table_name))
+                    storage_tables.update((storage.name, storage) for storage in table.storage_tables())
+                if table_name in storage_tables:
+                    storage_tables[table_name].redo(operation, *arguments)
+                    recovered.add(table_name)
+            for table_name in recovered:
+                storage_tables[table_name].analyze()
+            log.close()
+
+    def flush_tables(self) -> None:
+        for table in list(self.db_tables.values()):
+            if table.open_count:
+                table.flush()
+
+    def sync_tables(self) -> None:
+        """Flush the tables and force their files to disk, so a checkpoint can drop the log records they hold."""
+        self.flush_tables()
+        for table in list(self.db_tables.values()):
+            table.sync_files()
+
+    def checkpoint(self) -> None:
+        if self.wal is not None:
+            self.wal.checkpoint()
+
+    def start_checkpointer(self, interval: float = 1.0) -> None:
+        if self.wal is None:
             raise ValueError
-        is_key_field_name_exist = True if key_field_name in [field.name for field in fields] else False
-        if not is_key_field_name_exist:
+        self.wal.start_checkpointer(interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per table operation counts and latency histograms, file opens, bytes read and written, rows examined
+        and returned, and index lookups vs full scans. Empty unless created with instrument=True or a hook."""
+        return self.instrumentation.snapshot() if self.instrumentation is not None else {}
+
+    def reset_stats(self) -> None:
+        if self.instrumentation is not None:
+            self.instrumentation.reset()
+
+    def close(self) -> None:
+        """Stop the scan workers and checkpoint and close the write-ahead log."""
+        if self.scan_pool is not None:
+            self.scan_pool.close()
+        if self.wal is not None:
+            self.wal.close()
+
+    def vacuum(self, table: str = None) -> Dict[str, int]:
+        """Compact the files of one table, or of every table one at a time. Returns the bytes reclaimed per table.
+
+        Each table is locked for writing only while its own files are rewritten.
+        """
+        tables = [self.get_table(table)] if table is not None else self.all_tables()
+        return {storage.name: storage.vacuum() for table in tables for storage in table.storage_tables()}
+
+    def space_report(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """Per table, the file, live and dead bytes and the empty index entries of each of its files."""
+        return {storage.name: storage.space_report() for table in self.all_tables()
+                for storage in table.storage_tables()}
+
+    def all_tables(self) -> List[DBTable]:
+        return [self.get_table(table_name) for table_name in self.get_tables_names()]
+
+    def locked_tables(self) -> List[DBTable]:
+        """Every table and partition, in the order their locks are taken."""
+        tables = []
+        for table in self.all_tables():
+            tables += [table] + [storage for storage in table.storage_tables() if storage is not table]
+        return tables
+
+    def snapshot(self, dest: Union[str, Path], previous: Union[str, Path] = None) -> Dict[str, Any]:
+        """Write a consistent point-in-time copy of the database to the new directory dest.
+
+        Writers wait only while the files are linked or copied: on filesystems with reflinks the copy
+        shares the data blocks until either side changes them. With previous, the path of an earlier
+        snapshot, the files unchanged since then are hardlinked from it instead of copied. Returns
+        the snapshot's manifest.
+        """
+        self.checkpoint()
+        with ExitStack() as stack:
+            for table in self.locked_tables():
+                stack.enter_context(table.lock.reading())
+            self.flush_tables()
+            stack.enter_context(self.catalog_lock.reading())
+            return snapshot.take_snapshot(Path(self.root), Path(dest), previous and Path(previous))
+
+    def restore(self, src: Union[str, Path]) -> None:
+        """Replace the database with the snapshot (or plain copy of the root directory) at src."""
+        with ExitStack() as stack:
+            tables = self.all_tables()
+            for table in self.locked_tables():
+                stack.enter_context(table.lock.writing(table))
+            stack.enter_context(self.catalog_lock.writing())
+            for table in tables:
+                table.close(force=True)
+                for storage in table.storage_tables():
+                    storage.cache.clear()
+            snapshot.restore_snapshot(Path(src), Path(self.root))
+            self.db_tables = {}
+            self.table_shapes = {}
+            self.forget_catalog()
+            self.is_migrated = False  # the snapshot may predate the current file format
+            if self.wal is not None:  # the logged writes belong to the replaced files
+                self.wal.checkpoint()
+
+    def create_table(self, table_name: str,  fields: List[DBField],  key_field_name: str,
+                     engine: str = ROW_ENGINE, partitions: int = None) -> DBTable:
+        """Create a table; partitions=N hash-partitions a row table on its key into N files."""
+        if partitions is not None and (engine != ROW_ENGINE or partitions < 2):
             raise ValueError
+        with self.catalog_lock.writing():
+            is_table_exist = True if self.catalog_entry(table_name) is not None else False
+            if is_table_exist:
+                raise ValueError
+            is_key_field_name_exist = True if key_field_name in [field.name for field in fields] else False
+            if not is_key_field_name_exist:
+                raise ValueError
 
-        path_file = os.path.join('db_files', table_name + '.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            file_name[table_name] = {}
-        finally:
-            file_name.close()
+            if partitions is not None:
+                from partitioned import PartitionedDBTable
+                new_table = PartitionedDBTable(table_name, fields, key_field_name, partitions=partitions,
+                                               root=self.root)
+            else:
+                new_table = self.table_class(engine)(table_name, fields, key_field_name, root=self.root)
+            new_table.attach(self.wal, self.scan_pool, self.instrumentation)
+            new_table.create_files()
+            self.update_data_base_file(table_name, fields, key_field_name, engine, partitions)
+            self.db_tables[table_name] = new_table
+            self.table_shapes[table_name] = table_shape(self.catalog_entry(table_name))
+        return new_table
+
+    @staticmethod
+    def table_class(engine: str) -> Type[DBTable]:
+        if engine == ROW_ENGINE:
+            return DBTable
+        if engine == COLUMNAR_ENGINE:
+            from columnar import ColumnarDBTable  # needs numpy, so only imported when used
+            return ColumnarDBTable
+        raise ValueError
+
+    def update_data_base_file(self, table_name, fields, key_field_name, engine=ROW_ENGINE, partitions=None,
+                              generation=0):
+        with self.catalog_lock.writing():
+            file_name = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                if not len(file_name):  # a new or emptied catalog has nothing to migrate
+                    file_name.dict.version = CATALOG_FORMAT
+                table_info = {
+                    "fields": fields,
+                    "key_field_name": key_field_name,
+                    "hash_index": [False for i in range(len(fields))],
+                    "ordered_index": [False for i in range(len(fields))],
+                    "stats": table_stats.new_stats(),
+                    "engine": engine,
+                    "layout": ROW_PER_KEY_LAYOUT,
+                    "codec": CODEC_VERSION if engine == ROW_ENGINE else None,
+                    "ordered_nulls": True,
+                    "dictionary_files": engine == COLUMNAR_ENGINE
+                }
+                for i in range(partitions or 0):
+                    file_name[partition_name(table_name, generation, i)] = dict(table_info, partition_of=table_name)
+                if partitions:
+                    table_info.update(partitions=partitions, generation=generation)
+                file_name[table_name] = table_info
+            finally:
+                file_name.close()
+                self.forget_catalog()
+
+    def repartition(self, table_name: str, partitions: int) -> DBTable:
+        """Move a row table's rows into a new generation of `partitions` hash partitions and rebuild its indexes.
 
-        self.update_data_base_file(table_name, fields, key_field_name)
-        new_table = DBTable(table_name, fields, key_field_name)
-        DataBase.db_tables[table_name] = new_table
+        Used to split a table that outgrew one file, or to rebalance a partitioned table.
+        """
+        from partitioned import PartitionedDBTable
+        table = self.get_table(table_name)
+        if partitions < 2 or type(table) not in (DBTable, PartitionedDBTable):
+            raise ValueError
+        with table.lock.writing(table):
+            new_table = PartitionedDBTable(table.name, table.fields, table.key_field_name, partitions=partitions,
+                                           generation=getattr(table, 'generation', -1) + 1, root=self.root)
+            new_table.create_files()
+            with new_table.open():  # statistics are only written to the catalog on close
+                failures = new_table.insert_records(table.iter_query([]))
+                if failures:
+                    raise failures[0][1]
+                with self.catalog_lock.writing():
+                    self.update_data_base_file(table.name, table.fields, table.key_field_name,
+                                               partitions=partitions, generation=new_table.generation)
+                    self.remove_catalog_entries(table, keep_table=True)
+            table.close(force=True)
+            table.remove_files()
+            table.cache.clear()
+            table.mark_dropped()
+            for i, field in enumerate(table.field_names()):
+                if table.hash_index[i]:
+                    new_table.create_index(field)
+                if table.ordered_index[i]:
+                    new_table.create_index(field, ORDERED_INDEX)
+            for index in table.covering_indexes:
+                new_table.create_index(index["fields"], include=index["include"])
+            new_table.attach(self.wal, self.scan_pool, self.instrumentation)
+            self.db_tables[table_name] = new_table
+            self.table_shapes[table_name] = table_shape(self.catalog_entry(table_name))
         return new_table
 
-    def update_data_base_file(self, table_name, fields, key_field_name):
-        path_file = os.path.join('db_files', 'DataBase.db')
-        file_name = shelve.open(path_file, writeback=True)
+    def remove_catalog_entries(self, table: DBTable, keep_table: bool = False) -> None:
+        with self.catalog_lock.writing():
+            file_name = dbm_sqlite.open_shelf(self.catalog_path())
+            try:
+                for storage in table.storage_tables():
+                    if storage is not table:
+                        file_name.pop(storage.name, None)
+                if not keep_table:
+                    file_name.pop(table.name, None)
+            finally:
+                file_name.close()
+                self.forget_catalog()
+
+    @contextmanager
+    def session(self, flush_policy: Any = FLUSH_ON_EXIT) -> Iterator['DataBase']:
+        """Keep every table's files open for the duration of the with block."""
+        tables = self.all_tables()
+        opened = []
         try:
-            file_name[table_name] = {}
-            file_name[table_name]["fields"] = fields
-            file_name[table_name]["key_field_name"] = key_field_name
-            file_name[table_name]["hash_index"] = [False for i in range(len(fields))]
+            for table in tables:
+                opened.append(table.open(flush_policy))
+            yield self
         finally:
-            file_name.close()
+            for table in opened:
+                table.close()
 
     def num_tables(self) -> int:
-        return len(DataBase.db_tables)
+        return len(self.get_tables_names())
 
     def get_table(self, table_name: str) -> DBTable:
-        if DataBase.db_tables.get(table_name):
-            return DataBase.db_tables[table_name]
-        raise ValueError
+        """The table's handle, built on first use and rebuilt if another writer replaced the table."""
+        table = self.db_tables.get(table_name)
+        if table is not None and self.catalog.get(table_name) is not None and not table.is_dropped:
+            return table
+        table_info = self.catalog_entry(table_name)
+        if table_info is None or "partition_of" in table_info:
+            self.db_tables.pop(table_name, None)
+            raise ValueError
+        if table is not None and self.table_shapes.get(table_name) == table_shape(table_info):
+            return table
+        return self.load_table(table_name, table_info)
 
     def delete_table(self, table_name: str) -> None:
-        if None == DataBase.db_tables.get(table_name):
-            raise ValueError
-        path_file = os.path.join('db_files', 'DataBase.db')
-        file_name = shelve.open(path_file, writeback=True)
-        try:
-            DataBase.db_tables.pop(table_name)
-            shelve_file = (os.path.join('db_files', table_name + ".db.bak"))
-            os.remove(shelve_file)
-            shelve_file = (os.path.join('db_files', table_name + ".db.dat"))
-            os.remove(shelve_file)
-            shelve_file = (os.path.join('db_files', table_name + ".db.dir"))
-            os.remove(shelve_file)
-            for field in file_name[table_name]["fields"]:
-                if file_name[table_name]["hash_index"][file_name[table_name]["fields"].index(field)]:
-                    shelve_file = (os.path.join('db_files', f'{table_name}_{field.name}_hash_index.db.bak'))
-                    os.remove(shelve_file)
-                    shelve_file = (os.path.join('db_files', f'{table_name}_{field.name}_hash_index.db.dat'))
-                    os.remove(shelve_file)
-                    shelve_file = (os.path.join('db_files', f'{table_name}_{field.name}_hash_index.db.dir'))
-                    os.remove(shelve_file)
-
-            file_name.pop(table_name)
-        finally:
-            file_name.close()
+        table = self.get_table(table_name)
+        with table.lock.writing(table), self.catalog_lock.writing():
+            self.db_tables.pop(table_name, None)
+            self.table_shapes.pop(table_name, None)
+            table.close(force=True)
+            table.cache.clear()
+            table.remove_files()
+            table.mark_dropped()
+            self.remove_catalog_entries(table)
 
     def get_tables_names(self) -> List[Any]:
-        return [table for table in DataBase.db_tables.keys()]
+        return [table_name for table_name, table_info in self.catalog_entries().items()
+                if "partition_of" not in table_info]
 
     def query_multiple_tables(
             self,
@@ -377,6 +1765,57 @@ class DataBase(db_api.DataBase):
             fields_and_values_list: List[List[SelectionCriteria]],
             fields_to_join_by: List[str]
     ) -> List[Dict[str, Any]]:
-        raise NotImplementedError
+        if not tables or len(tables) != len(fields_and_values_list):
+            raise ValueError
+        db_tables = [self.get_table(table_name) for table_name in tables]
+        for table in db_tables:
+            if any(field not in table.field_names() for field in fields_to_join_by):
+                raise ValueError
+        joined_fields = set(db_tables[0].field_names())
+        for table in db_tables[1:]:
+            if (joined_fields & set(table.field_names())) - set(fields_to_join_by):  # would overwrite each other
+                raise ValueError
+            joined_fields |= set(table.field_names())
+
+        joined_rows = db_tables[0].query_table(fields_and_values_list[0])
+        for table, criteria in zip(db_tables[1:], fields_and_values_list[1:]):
+            joined_rows = self.hash_join(joined_rows, table, criteria, fields_to_join_by)
+        return joined_rows
+
+    def hash_join(self, rows: List[Dict[str, Any]], table: DBTable, criteria: List[SelectionCriteria],
+                  fields_to_join_by: List[str]) -> List[Dict[str, Any]]:
+        def join_key(row):
+            return tuple(row[field] for field in fields_to_join_by)
+
+        def build(build_rows):
+            hash_table = {}
+            for row in build_rows:
+                key = join_key(row)
+                if None not in key:  # None never joins
+                    hash_table.setdefault(key, []).append(row)
+            return hash_table
+
+        joined_rows = []
+        with table.open():
+            table_rows = table.estimate_rows(criteria)  # the rows streamed from the table, after its criteria
+            index_field = table.join_index_field(fields_to_join_by)
+            if index_field is not None and len(rows) < table_rows:  # probe the index once per join value
+                position = fields_to_join_by.index(index_field)
+                for key, left_rows in build(rows).items():
+                    probe_criteria = criteria + [SelectionCriteria(index_field, "=", key[position])]
+                    for right_row in table.iter_query(probe_criteria):
+                        if join_key(right_row) == key:
+                            joined_rows.extend({**left_row, **right_row} for left_row in left_rows)
 
+            elif len(rows) <= table_rows:  # build on the filtered rows, stream the table
+                hash_table = build(rows)
+                for right_row in table.iter_query(criteria):
+                    for left_row in hash_table.get(join_key(right_row), []):
+                        joined_rows.append({**left_row, **right_row})
 
+            else:  # build on the table, stream the rows
+                hash_table = build(table.iter_query(criteria))
+                for left_row in rows:
+                    for right_row in hash_table.get(join_key(left_row), []):
+                        joined_rows.append({**left_row, **right_row})
+        return joined_rows
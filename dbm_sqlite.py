@@ -0,0 +1,279 @@
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple, Union
+import dbm.dumb
+import os
+import pickle
+import shelve
+import sqlite3
+import threading
+
+PAGE_ROWS = 1000  # rows read per query while iterating, so no statement stays open between pages
+BUSY_TIMEOUT = 60.0  # seconds; the table locks already serialize writers, this only covers stray readers
+DUMB_SUFFIXES = ('.dat', '.dir', '.bak')
+SYNCHRONOUS = 'OFF'  # commits reach the OS but are not flushed to disk, like the dbm files this replaces
+POOL_SIZE = 64  # idle connections kept for reuse, so reopening a shelf neither connects nor reads its schema again
+
+
+class SqliteDatabase:
+    """A dbm-style mapping of bytes to bytes kept in one SQLite file.
+
+    Unlike dbm.dumb, which parses an index line for every key on each open, opening costs the same
+    whatever the number of keys, and a lookup reads only the B-tree pages on the path to its key.
+    Writes are gathered into one transaction until sync() or close(). The connection is shared by
+    the threads using the object, one call at a time, and goes back to an idle pool on close().
+    """
+
+    def __init__(self, path: Union[str, Path], flag: str = 'c'):
+        if flag not in ('r', 'w', 'c', 'n'):
+            raise ValueError(f'flag must be r, w, c or n, not {flag!r}')
+        self.path = str(path)
+        if flag == 'n':
+            discard(self.path)
+            for suffix in ('', '-journal'):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+        elif flag in ('r', 'w') and not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        self.is_read_only = flag == 'r'
+        self.lock = threading.RLock()
+        self.in_transaction = False
+        self.connection = take_idle(self.path, self.is_read_only)
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute(f'PRAGMA synchronous = {SYNCHRONOUS}')
+            if not self.is_read_only:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS Dict '
+                                        '(key BLOB UNIQUE NOT NULL, value BLOB NOT NULL)')
+        self.inode = os.stat(self.path).st_ino
+
+    def execute(self, statement: str, *parameters: Any) -> sqlite3.Cursor:
+        if self.connection is None:
+            raise ValueError('the database is closed')
+        return self.connection.execute(statement, parameters)
+
+    def write(self, statement: str, *parameters: Any) -> sqlite3.Cursor:
+        if self.is_read_only:
+            raise ValueError('the database was opened read-only')
+        if not self.in_transaction:
+            self.execute('BEGIN IMMEDIATE')
+            self.in_transaction = True
+        return self.execute(statement, *parameters)
+
+    def __getitem__(self, key: Union[str, bytes]) -> bytes:
+        with self.lock:
+            row = self.execute('SELECT value FROM Dict WHERE key = ?', encode_key(key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def get(self, key: Union[str, bytes], default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key: Union[str, bytes], value: bytes) -> None:
+        with self.lock:
+            self.write('INSERT INTO Dict (key, value) VALUES (?, ?) '
+                       'ON CONFLICT (key) DO UPDATE SET value = excluded.value', encode_key(key), value)
+
+    def __delitem__(self, key: Union[str, bytes]) -> None:
+        with self.lock:
+            if not self.write('DELETE FROM Dict WHERE key = ?', encode_key(key)).rowcount:
+                raise KeyError(key)
+
+    def __contains__(self, key: Union[str, bytes]) -> bool:
+        with self.lock:
+            return self.execute('SELECT 1 FROM Dict WHERE key = ?', encode_key(key)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.execute('SELECT COUNT(*) FROM Dict').fetchone()[0]
+
+    def keys(self) -> List[bytes]:
+        with self.lock:
+            return [key for key, in self.execute('SELECT key FROM Dict ORDER BY rowid')]
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.keys())
+
+    def items(self) -> Iterator[Tuple[bytes, bytes]]:
+        """Yield the (key, value) pairs in insertion order, reading PAGE_ROWS of them per query."""
+        last_rowid = 0
+        while True:
+            with self.lock:
+                page = self.execute('SELECT rowid, key, value FROM Dict WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                    last_rowid, PAGE_ROWS).fetchall()
+            for rowid, key, value in page:
+                yield key, value
+            if len(page) < PAGE_ROWS:
+                return
+            last_rowid = page[-1][0]
+
+    def values(self) -> Iterator[bytes]:
+        for key, value in self.items():
+            yield value
+
+    @property
+    def version(self) -> int:
+        """A format version number kept in the file header (SQLite's user_version), 0 until set."""
+        with self.lock:
+            return self.execute('PRAGMA user_version').fetchone()[0]
+
+    @version.setter
+    def version(self, version: int) -> None:
+        with self.lock:
+            self.sync()
+            self.execute(f'PRAGMA user_version = {int(version)}')
+
+    def sync(self) -> None:
+        with self.lock:
+            if self.in_transaction:
+                self.in_transaction = False
+                self.execute('COMMIT')
+
+    def flush_to_disk(self) -> None:
+        """Commit, then rewrite the header in a synchronous transaction, which flushes every page of the file."""
+        with self.lock:
+            self.sync()
+            self.execute('PRAGMA synchronous = FULL')
+            try:
+                self.execute(f'PRAGMA user_version = {self.version}')
+            finally:
+                self.execute(f'PRAGMA synchronous = {SYNCHRONOUS}')
+
+    def vacuum(self) -> None:
+        """Rewrite the file without its free pages."""
+        with self.lock:
+            self.sync()
+            self.execute('VACUUM')
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self.sync()
+            except BaseException:
+                self.connection.close()
+                self.connection = None
+                raise
+            put_idle(self.path, self.is_read_only, self.connection, self.inode)
+            self.connection = None
+
+
+class Shelf(shelve.Shelf):
+    """A shelf over a SqliteDatabase: get() is one lookup, and values() and items() read page by page."""
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value, self._protocol)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.loads(self.dict[key.encode(self.keyencoding)])
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.dict[key.encode(self.keyencoding)] = self.dumps(value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        data = self.dict.get(key.encode(self.keyencoding))
+        return default if data is None else self.loads(data)
+
+    def values(self) -> Iterator[Any]:
+        for data in self.dict.values():
+            yield self.loads(data)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for key, data in self.dict.items():
+            yield key.decode(self.keyencoding), self.loads(data)
+
+
+idle = []  # (absolute path, read only, inode, pid, connection), least recently used first
+idle_guard = threading.Lock()
+
+
+def take_idle(path: str, is_read_only: bool) -> Optional[sqlite3.Connection]:
+    """An idle connection to the file now at path, if any. Connections to a removed or replaced file are closed."""
+    path = os.path.abspath(path)
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        inode = None
+    stale = []
+    connection = None
+    with idle_guard:
+        for entry in reversed(idle):
+            if entry[0] == path and (entry[2] != inode or entry[3] != os.getpid()):
+                stale.append(entry)
+            elif connection is None and entry[:2] == (path, is_read_only):
+                connection = entry[4]
+                idle.remove(entry)
+        for entry in stale:
+            idle.remove(entry)
+    for entry in stale:
+        if entry[3] == os.getpid():  # a forked child leaves the parent's connections alone
+            entry[4].close()
+    return connection
+
+
+def put_idle(path: str, is_read_only: bool, connection: sqlite3.Connection, inode: int) -> None:
+    with idle_guard:
+        idle.append((os.path.abspath(path), is_read_only, inode, os.getpid(), connection))
+        evicted = idle.pop(0) if len(idle) > POOL_SIZE else None
+    if evicted is not None and evicted[3] == os.getpid():
+        evicted[4].close()
+
+
+def discard(path: Union[str, Path]) -> None:
+    """Close the idle connections to path, before its files are removed."""
+    path = os.path.abspath(path)
+    with idle_guard:
+        entries = [entry for entry in idle if entry[0] == path]
+        for entry in entries:
+            idle.remove(entry)
+    for entry in entries:
+        if entry[3] == os.getpid():
+            entry[4].close()
+
+
+def encode_key(key: Union[str, bytes]) -> bytes:
+    return key.encode() if isinstance(key, str) else key
+
+
+def open(path: Union[str, Path], flag: str = 'c') -> SqliteDatabase:
+    return SqliteDatabase(path, flag)
+
+
+def open_shelf(path: Union[str, Path], flag: str = 'c') -> Shelf:
+    return Shelf(SqliteDatabase(path, flag))
+
+
+def is_dumb(path: Union[str, Path]) -> bool:
+    """Whether the shelf at path is still in dbm.dumb files (path.dat and path.dir)."""
+    return os.path.exists(f'{path}.dir') and os.path.exists(f'{path}.dat')
+
+
+def dumb_shelves(root: Union[str, Path]) -> List[str]:
+    """The paths of the dbm.dumb shelves under root, in its subdirectories too."""
+    return sorted(str(path)[:-len('.dir')] for path in Path(root).glob('**/*.dir') if is_dumb(str(path)[:-len('.dir')]))
+
+
+def convert_dumb(path: str) -> None:
+    """Copy the keys and values of the dbm.dumb shelf at path into a SQLite file at path, then remove the dumb files."""
+    path_new_file = path + '-converting'
+    source = dbm.dumb.open(path, 'r')
+    target = SqliteDatabase(path_new_file, 'n')
+    try:
+        for key in source.keys():
+            target[key] = source[key]
+    finally:
+        source.close()
+        target.close()
+        discard(path_new_file)
+    for suffix in DUMB_SUFFIXES:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.replace(path_new_file, path)
@@ -0,0 +1,171 @@
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+import functools
+import inspect
+import threading
+import time
+
+from record_codec import RecordCodec, RecordShelf
+import dbm_sqlite
+
+LATENCY_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000]
+COUNTERS = ["file_opens", "bytes_read", "bytes_written", "rows_examined", "rows_returned", "index_lookups",
+            "full_scans"]
+
+
+class Instrumentation:
+    """Per table call counts, latency histograms and I/O counters, plus an optional hook called after every operation.
+
+    The hook gets a dict with table, operation, seconds and error (None on success).
+    """
+
+    def __init__(self, hook: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.hook = hook
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def table_stats(self, table_name: str) -> Dict[str, Any]:
+        if table_name not in self.tables:
+            self.tables[table_name] = {"operations": {}, **{counter: 0 for counter in COUNTERS}}
+        return self.tables[table_name]
+
+    def count(self, table_name: str, counter: str, amount: int = 1) -> None:
+        with self.lock:
+            self.table_stats(table_name)[counter] += amount
+
+    def record(self, table_name: str, operation: str, seconds: float, error: Optional[Exception] = None) -> None:
+        with self.lock:
+            operations = self.table_stats(table_name)["operations"]
+            stats = operations.setdefault(operation, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                      "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)})
+            milliseconds = seconds * 1000
+            stats["count"] += 1
+            stats["errors"] += error is not None
+            stats["total_ms"] += milliseconds
+            stats["max_ms"] = max(stats["max_ms"], milliseconds)
+            stats["histogram"][bisect_left(LATENCY_BUCKETS_MS, milliseconds)] += 1
+        if self.hook is not None:
+            self.hook({"table": table_name, "operation": operation, "seconds": seconds, "error": error})
+
+    def snapshot(self) -> Dict[str, Any]:
+        """A copy of the statistics, with each histogram keyed by its bucket's upper bound in ms."""
+        bounds = [f'<={bound}' for bound in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}']
+        with self.lock:
+            return {table_name: {**{counter: stats[counter] for counter in COUNTERS},
+                                 "operations": {operation: {**operation_stats, "histogram": dict(
+                                     zip(bounds, operation_stats["histogram"]))}
+                                     for operation, operation_stats in stats["operations"].items()}}
+                    for table_name, stats in self.tables.items()}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.tables = {}
+
+
+def instrumented(operation: str) -> Callable:
+    """Time the decorated table method when its table has instrumentation; otherwise add one attribute check."""
+    def decorator(method: Callable) -> Callable:
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def generator_wrapper(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+                if self.instrumentation is None:
+                    return method(self, *args, **kwargs)
+                return timed_generator(self, operation, method(self, *args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+            if self.instrumentation is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as error:
+                self.instrumentation.record(self.name, operation, time.perf_counter() - start, error)
+                raise
+            self.instrumentation.record(self.name, operation, time.perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+def timed_generator(table: Any, operation: str, rows: Iterator[Any]) -> Iterator[Any]:
+    """Yield from rows and record the time from the first row requested until the iteration ends."""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield from rows
+    except Exception as raised:
+        error = raised
+        raise
+    finally:
+        table.instrumentation.record(table.name, operation, time.perf_counter() - start, error)
+
+
+class CountingDict:
+    """Wraps a SqliteDatabase to count the bytes read from and written to it."""
+
+    def __init__(self, db: Any, instrumentation: Instrumentation, table_name: str):
+        self.db = db
+        self.instrumentation = instrumentation
+        self.table_name = table_name
+
+    def __getitem__(self, key: bytes) -> bytes:
+        value = self.db[key]
+        self.instrumentation.count(self.table_name, "bytes_read", len(value))
+        return value
+
+    def get(self, key: bytes, default: Any = None) -> Any:
+        value = self.db.get(key)
+        if value is None:
+            return default
+        self.instrumentation.count(self.table_name, "bytes_read", len(value))
+        return value
+
+    def __setitem__(self, key: bytes, value: bytes) -> None:
+        self.db[key] = value
+        self.instrumentation.count(self.table_name, "bytes_written", len(value))
+
+    def __delitem__(self, key: bytes) -> None:
+        del self.db[key]
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.db
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.db.keys())
+
+    def __len__(self) -> int:
+        return len(self.db)
+
+    def keys(self):
+        return self.db.keys()
+
+    def items(self) -> Iterator[Tuple[bytes, bytes]]:
+        for key, value in self.db.items():
+            self.instrumentation.count(self.table_name, "bytes_read", len(value))
+            yield key, value
+
+    def values(self) -> Iterator[bytes]:
+        for key, value in self.items():
+            yield value
+
+    def sync(self) -> None:
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def flush_to_disk(self) -> None:
+        self.db.flush_to_disk()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def open_table_shelf(path_file: str, instrumentation: Optional[Instrumentation], table_name: str,
+                     flag: str = 'c', codec: Optional[RecordCodec] = None) -> dbm_sqlite.Shelf:
+    """Open a table or index shelf; with codec its values are rows in the table's record encoding."""
+    db = dbm_sqlite.open(path_file, flag)
+    if instrumentation is not None:
+        instrumentation.count(table_name, "file_opens")
+        db = CountingDict(db, instrumentation, table_name)
+    return dbm_sqlite.Shelf(db) if codec is None else RecordShelf(db, codec)
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+import os
+import struct
+import threading
+import weakref
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on this platform, threads are still serialized
+    fcntl = None
+
+VERSION = struct.Struct('<Q')
+
+
+class TableLock:
+    """A reader/writer lock for one table and its index files, shared by threads and processes.
+
+    In the process, any number of threads may read while writers wait for exclusive access (waiting
+    writers hold off new readers). Both are reentrant per thread and a reader may not upgrade to a
+    writer. Across processes the first reader takes a shared flock on path and a writer an exclusive
+    one. Every write bumps a version counter in the lock file, so a process that sees a different
+    version than it last saw calls files_changed() on its listeners to drop what they cached from the
+    files. Listeners other than the writer are told at once about writes made in this process.
+    A write with invalidate=False changes nothing the listeners cache, and leaves the version alone.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.listeners = {}  # id -> weak reference, tables are dataclasses and so not hashable
+        self.condition = threading.Condition()
+        self.readers = {}  # thread id -> nesting depth
+        self.writer = None
+        self.write_depth = 0
+        self.invalidates = False  # whether the current write changes what the listeners cache
+        self.waiting_writers = 0
+        self.file = None
+        self.pid = None
+        self.version = None
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        thread = threading.get_ident()
+        with self.condition:
+            if self.writer == thread:  # already exclusive
+                nested = True
+            elif thread in self.readers:  # do not wait for writers, they are waiting for us
+                self.readers[thread] += 1
+                nested = False
+            else:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+                self.readers[thread] = 1
+                nested = False
+                if len(self.readers) == 1:
+                    self.lock_file(fcntl.LOCK_SH if fcntl else None)
+        try:
+            yield
+        finally:
+            if not nested:
+                with self.condition:
+                    self.readers[thread] -= 1
+                    if not self.readers[thread]:
+                        del self.readers[thread]
+                        if not self.readers:
+                            self.unlock_file()
+                            self.condition.notify_all()
+
+    @contextmanager
+    def writing(self, source: Any = None, invalidate: bool = True) -> Iterator[None]:
+        thread = threading.get_ident()
+        with self.condition:
+            if thread in self.readers:
+                raise RuntimeError('cannot write to a table while reading it in the same thread')
+            if self.writer != thread:
+                self.waiting_writers += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.condition.wait()
+                finally:
+                    self.waiting_writers -= 1
+                self.writer = thread
+                self.lock_file(fcntl.LOCK_EX if fcntl else None)
+            self.write_depth += 1
+            self.invalidates = self.invalidates or invalidate
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.write_depth -= 1
+                if not self.write_depth:
+                    invalidates, self.invalidates = self.invalidates, False
+                    if invalidates:
+                        self.bump_version()
+                    self.unlock_file()
+                    self.writer = None
+                    self.condition.notify_all()
+                    if invalidates:
+                        self.notify(source)
+
+    def lock_file(self, operation: Optional[int]) -> None:
+        if operation is None:
+            return
+        if self.file is not None and self.pid == os.getpid() and not self.is_current():
+            os.close(self.file)  # the lock file was removed or replaced
+            self.file = None
+        if self.file is None or self.pid != os.getpid():  # a forked child must not share the parent's lock
+            self.file = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self.pid = os.getpid()
+        fcntl.flock(self.file, operation)
+        data = os.pread(self.file, VERSION.size, 0)
+        version = VERSION.unpack(data)[0] if len(data) == VERSION.size else 0
+        if self.version is not None and version != self.version:
+            self.notify()
+        self.version = version
+
+    def is_current(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self.file).st_ino
+        except FileNotFoundError:
+            return False
+
+    def add_listener(self, listener: Any) -> None:
+        key = id(listener)
+        self.listeners[key] = weakref.ref(listener, lambda reference: self.listeners.pop(key, None))
+
+    def notify(self, source: Any = None) -> None:
+        for reference in list(self.listeners.values()):
+            listener = reference()
+            if listener is not None and listener is not source:
+                listener.files_changed()
+
+    def unlock_file(self) -> None:
+        if fcntl is not None and self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def bump_version(self) -> None:
+        if fcntl is not None and self.file is not None:
+            self.version = (self.version or 0) + 1
+            os.pwrite(self.file, VERSION.pack(self.version), 0)
+
+    def close(self) -> None:
+        with self.condition:
+            if self.file is not None and self.pid == os.getpid():
+                os.close(self.file)
+            self.file = None
+
+
+locks = {}  # path -> TableLock, so every table object in the process shares one lock per file
+locks_guard = threading.Lock()
+
+
+def table_lock(path: str) -> TableLock:
+    path = os.path.abspath(path)  # one lock however the path is spelled
+    with locks_guard:
+        if path not in locks:
+            locks[path] = TableLock(path)
+        return locks[path]
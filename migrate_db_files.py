@@ -0,0 +1,9 @@
+from db import migrate_db_files
+from db_api import DB_ROOT
+from test_db import DB_BACKUP_ROOT
+
+
+if __name__ == '__main__':
+    for root in (DB_ROOT, DB_BACKUP_ROOT):
+        if root.exists():
+            print(root, migrate_db_files(root))
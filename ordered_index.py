@@ -0,0 +1,222 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Iterator, List, Optional, Tuple
+import shelve
+
+PAGE_SIZE = 256
+NULL_PREFIX = 'null:'  # one shelf entry per key whose value is None, named after the key
+
+
+def entry_value(entry: Tuple[Any, Any]) -> Any:
+    return entry[0]
+
+
+class OrderedIndex:
+    """A sorted (value, key) index kept in a shelf as a directory of page lower bounds plus small sorted pages.
+
+    A lookup reads the directory and then only the pages that hold the requested range, so a range
+    query costs O(log n + k) comparisons and touches O(k / PAGE_SIZE) pages. Keys whose value is None
+    are kept apart, one entry each, since None does not compare with the values.
+    """
+
+    def __init__(self, index_file: shelve.Shelf):
+        self.index_file = index_file
+
+    def directory(self) -> List[Tuple[Tuple[Any, Any], int]]:
+        return self.index_file.get("directory", [])
+
+    def read_page(self, page_id: int) -> List[Tuple[Any, Any]]:
+        return self.index_file[f'page:{page_id}']
+
+    def write_page(self, page_id: int, page: List[Tuple[Any, Any]]) -> None:
+        self.index_file[f'page:{page_id}'] = page
+
+    def find_page(self, directory, entry: Tuple[Any, Any]) -> int:
+        return max(bisect_right(directory, entry, key=lambda page: page[0]) - 1, 0)
+
+    def bulk_load(self, entries: List[Tuple[Any, Any]]) -> None:
+        for value, key in entries:
+            if value is None:
+                self.index_file[null_entry(key)] = key
+        entries = sorted(entry for entry in entries if entry[0] is not None)
+        directory = []
+        for page_id, start in enumerate(range(0, len(entries), PAGE_SIZE)):
+            page = entries[start:start + PAGE_SIZE]
+            self.write_page(page_id, page)
+            directory.append((page[0], page_id))
+        self.index_file["directory"] = directory
+        self.index_file["next_page_id"] = len(directory)
+
+    def insert(self, value: Any, key: Any) -> None:
+        if value is None:
+            self.index_file[null_entry(key)] = key
+            return
+        entry = (value, key)
+        directory = self.directory()
+        if not directory:
+            self.write_page(0, [entry])
+            self.index_file["directory"] = [(entry, 0)]
+            self.index_file["next_page_id"] = 1
+            return
+
+        position = self.find_page(directory, entry)
+        low, page_id = directory[position]
+        page = self.read_page(page_id)
+        insort(page, entry)
+        if len(page) <= PAGE_SIZE:
+            self.write_page(page_id, page)
+            if entry < low:
+                directory[position] = (entry, page_id)
+                self.index_file["directory"] = directory
+            return
+
+        new_page_id = self.index_file["next_page_id"]  # split a full page in two
+        middle = len(page) // 2
+        self.write_page(page_id, page[:middle])
+        self.write_page(new_page_id, page[middle:])
+        directory[position] = (page[0], page_id)
+        directory.insert(position + 1, (page[middle], new_page_id))
+        self.index_file["directory"] = directory
+        self.index_file["next_page_id"] = new_page_id + 1
+
+    def delete(self, value: Any, key: Any) -> None:
+        if value is None:
+            if null_entry(key) not in self.index_file:
+                raise ValueError
+            del self.index_file[null_entry(key)]
+            return
+        entry = (value, key)
+        directory = self.directory()
+        position = self.find_page(directory, entry)
+        low, page_id = directory[position]
+        page = self.read_page(page_id)
+        index = bisect_left(page, entry)
+        if index == len(page) or page[index] != entry:
+            raise ValueError
+        page.pop(index)
+        if not page and len(directory) > 1:
+            del self.index_file[f'page:{page_id}']
+            directory.pop(position)
+            self.index_file["directory"] = directory
+            return
+        self.write_page(page_id, page)
+        if page and page[0] != low:
+            directory[position] = (page[0], page_id)
+            self.index_file["directory"] = directory
+
+    def contains(self, value: Any, key: Any) -> bool:
+        if value is None:
+            return null_entry(key) in self.index_file
+        entry = (value, key)
+        directory = self.directory()
+        if not directory:
+            return False
+        page = self.read_page(directory[self.find_page(directory, entry)][1])
+        index = bisect_left(page, entry)
+        return index < len(page) and page[index] == entry
+
+    def range(self, low: Any = None, high: Any = None, include_low: bool = True, include_high: bool = True,
+              descending: bool = False) -> Iterator[Tuple[Any, Any]]:
+        """Yield the (value, key) entries with low <(=) value <(=) high in index order; None means unbounded.
+
+        The directory is read again after each page and the walk goes on past that page's last entry, so
+        pages split or removed while the caller holds the walk paused are neither skipped nor read twice.
+        """
+        if descending:
+            yield from self.range_descending(low, high, include_low, include_high)
+            return
+        last = None  # the last entry of the pages walked so far
+        while True:
+            directory = self.directory()
+            if last is not None:
+                position = self.find_page(directory, last)
+            elif low is not None:
+                position = max(bisect_left(directory, low, key=lambda page: page[0][0]) - 1, 0)
+            else:
+                position = 0
+            for low_entry, page_id in directory[position:]:
+                if high is not None and (low_entry[0] > high or (low_entry[0] == high and not include_high)):
+                    return
+                page = self.read_page(page_id)
+                if last is not None:
+                    start = bisect_right(page, last)
+                elif low is not None:
+                    start = (bisect_left if include_low else bisect_right)(page, low, key=entry_value)
+                else:
+                    start = 0
+                if start == len(page):
+                    continue
+                for entry in page[start:]:
+                    if high is not None and (entry[0] > high or (entry[0] == high and not include_high)):
+                        return
+                    yield entry
+                last = page[-1]
+                break
+            else:
+                return
+
+    def range_descending(self, low: Any, high: Any, include_low: bool, include_high: bool) \
+            -> Iterator[Tuple[Any, Any]]:
+        first = None  # the first entry of the pages walked so far
+        while True:
+            directory = self.directory()
+            if first is not None:
+                position = bisect_left(directory, first, key=lambda page: page[0])
+            elif high is not None:
+                position = bisect_right(directory, high, key=lambda page: page[0][0])
+            else:
+                position = len(directory)
+            for low_entry, page_id in reversed(directory[:position]):
+                page = self.read_page(page_id)
+                if first is not None:
+                    end = bisect_left(page, first)
+                elif high is not None:
+                    end = (bisect_right if include_high else bisect_left)(page, high, key=entry_value)
+                else:
+                    end = len(page)
+                if not end:
+                    continue
+                for entry in reversed(page[:end]):
+                    if low is not None and (entry[0] < low or (entry[0] == low and not include_low)):
+                        return
+                    yield entry
+                first = page[0]
+                break
+            else:
+                return
+
+    def null_keys(self) -> List[Any]:
+        """The keys whose value is None."""
+        return [self.index_file[name] for name in list(self.index_file.keys()) if name.startswith(NULL_PREFIX)]
+
+    def count(self) -> int:
+        return sum(len(self.read_page(page_id)) for low, page_id in self.directory())
+
+
+def null_entry(key: Any) -> str:
+    return NULL_PREFIX + repr(key)
+
+
+def null_last(entry: Tuple[Any, Any]) -> Tuple:
+    """Sort key for (value, key) entries that may have None values."""
+    return entry[0] is None, entry
+
+
+def range_bounds(criteria, field: str) -> Optional[Tuple[Any, bool, Any, bool]]:
+    """Fold the comparison criteria on field into (low, include_low, high, include_high), or None if there are none."""
+    low, include_low, high, include_high = None, True, None, True
+    found = False
+    for criterion in criteria:
+        operator = str(criterion.operator).upper()
+        if criterion.field_name != field or operator not in ("=", "<", "<=", ">", ">=", "BETWEEN"):
+            continue
+        found = True
+        lower, upper = criterion.value if operator == "BETWEEN" else (criterion.value, criterion.value)
+        if operator in ("=", ">", ">=", "BETWEEN"):
+            inclusive = operator != ">"
+            if low is None or lower > low or (lower == low and not inclusive):
+                low, include_low = lower, inclusive
+        if operator in ("=", "<", "<=", "BETWEEN"):
+            inclusive = operator != "<"
+            if high is None or upper < high or (upper == high and not inclusive):
+                high, include_high = upper, inclusive
+    return (low, include_low, high, include_high) if found else None
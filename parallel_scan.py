@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List
+import multiprocessing
+
+import dbm_sqlite
+import predicates
+
+PARALLEL_SCAN_MIN_ROWS = 20000  # below this a scan is cheaper than shipping the work to other processes
+
+
+def scan_chunk(path_file: str, keys: List[str], criteria: List[Any], codec: Any = None) -> List[Dict[str, Any]]:
+    """Read the rows of keys straight from the table file and return the ones matching criteria.
+
+    With the table's record codec only the criteria fields are decoded until a row matches. Keys deleted
+    since they were listed are skipped, as the workers read without the table's lock.
+    """
+    is_match = predicates.compile_criteria(criteria)
+    file_name = dbm_sqlite.open_shelf(path_file, 'r')
+    try:
+        if codec is None:
+            rows = (file_name.get(key) for key in keys)
+            return [row for row in rows if row is not None and is_match(row)]
+        fields = [criterion.field_name for criterion in criteria]
+        records = (file_name.dict.get(key.encode(file_name.keyencoding)) for key in keys)
+        return [codec.decode(data) for data in records if data is not None and is_match(codec.decode(data, fields))]
+    finally:
+        file_name.close()
+
+
+class ScanPool:
+    """A lazily started process pool that evaluates a full scan over slices of a table's keys.
+
+    Each worker opens the table file itself, so only the keys go out and only the matching rows
+    come back. Slices are yielded in key order as soon as each one is done.
+    """
+
+    def __init__(self, processes: int, min_rows: int = PARALLEL_SCAN_MIN_ROWS):
+        if processes < 2:
+            raise ValueError
+        self.processes = processes
+        self.min_rows = min_rows
+        self.executor = None
+
+    def scan(self, path_file: str, keys: List[str], criteria: List[Any], codec: Any = None) -> Iterator[Dict[str, Any]]:
+        if self.executor is None:  # spawned workers do not inherit the locks and threads of this process
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        size = max(-(-len(keys) // self.processes), 1)
+        futures = [self.executor.submit(scan_chunk, path_file, keys[start:start + size], criteria, codec)
+                   for start in range(0, len(keys), size)]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,252 @@
+from contextlib import ExitStack, contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import heapq
+import os
+
+from db import DBField, DBTable, FLUSH_ON_EXIT, HASH_INDEX, SelectionCriteria, partition_name
+from db_api import DB_ROOT
+from instrumentation import instrumented
+from locking import TableLock
+import table_stats
+
+
+class PartitionLock:
+    """A partition's lock, which first takes the partitioned table's read lock. A repartition or drop holds the
+    table's write lock, so it waits for the partitions' readers and writers and they wait for it."""
+
+    def __init__(self, table_lock: TableLock, lock: TableLock):
+        self.table_lock = table_lock
+        self.lock = lock
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.lock, name)
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        with self.table_lock.reading(), self.lock.reading():
+            yield
+
+    @contextmanager
+    def writing(self, source: Any = None) -> Iterator[None]:
+        with self.table_lock.reading(), self.lock.writing(source):
+            yield
+
+
+class PartitionedTableLock:
+    """A partitioned table's lock, whose read lock also takes every partition's, so a fan-out never sees a
+    partition write half done."""
+
+    def __init__(self, lock: TableLock, partitions: List[DBTable]):
+        self.lock = lock
+        self.partitions = partitions
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.lock, name)
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        with ExitStack() as stack:
+            stack.enter_context(self.lock.reading())
+            for partition in self.partitions:
+                stack.enter_context(partition.lock.reading())
+            yield
+
+    def writing(self, source: Any = None):
+        return self.lock.writing(source)
+
+
+class PartitionedDBTable(DBTable):
+    """A table hash-partitioned on its primary key into row tables with their own files and local indexes.
+
+    Point operations touch only the partition that owns the key, while scans, queries and count()
+    fan out to every partition. Each partition is a catalog entry of its own marked partition_of,
+    and a repartition writes a new generation of partitions next to the old one.
+    """
+
+    def __init__(self, name: str, fields: List[DBField], key_field_name: str, hash_index: List[bool] = None,
+                 ordered_index: List[bool] = None, partitions: int = 2, generation: int = 0, root: str = DB_ROOT):
+        if partitions < 2:
+            raise ValueError
+        super().__init__(name, fields, key_field_name, hash_index, ordered_index, root)
+        self.generation = generation
+        self.partitions = [DBTable(partition_name(name, generation, i), fields, key_field_name,
+                                   list(self.hash_index), list(self.ordered_index), root) for i in range(partitions)]
+        for partition in self.partitions:
+            partition.lock = PartitionLock(self.lock, partition.lock)
+        self.lock = PartitionedTableLock(self.lock, self.partitions)
+
+    def partition_index(self, key: Any) -> int:
+        return table_stats.value_hash(key) % len(self.partitions)
+
+    def partition(self, key: Any) -> DBTable:
+        return self.partitions[self.partition_index(key)]
+
+    def target_partitions(self, criteria: List[SelectionCriteria]) -> List[DBTable]:
+        """The partition owning the key when criteria pin the primary key, else every partition."""
+        for criterion in criteria:
+            if criterion.field_name == self.key_field_name and criterion.operator == "=":
+                return [self.partition(criterion.value)]
+        return self.partitions
+
+    def storage_tables(self) -> List[DBTable]:
+        return list(self.partitions)
+
+    def is_replaced(self, table_info: Optional[Dict[str, Any]]) -> bool:
+        return table_info is None or table_info.get("generation") != self.generation
+
+    def mark_dropped(self) -> None:
+        super().mark_dropped()
+        for partition in self.partitions:
+            partition.mark_dropped()
+
+    def attach(self, wal: Any, scan_pool: Any, instrumentation: Any = None) -> None:
+        super().attach(wal, scan_pool, instrumentation)
+        for partition in self.partitions:
+            partition.attach(wal, scan_pool, instrumentation)
+
+    def set_cache(self, *args: Any, **kwargs: Any) -> None:
+        for partition in self.partitions:
+            partition.set_cache(*args, **kwargs)
+
+    def cache_info(self) -> Dict[str, Any]:
+        infos = [partition.cache_info() for partition in self.partitions]
+        return {name: sum(info[name] for info in infos) if infos[0][name] is not None else None
+                for name in infos[0]}
+
+    def create_files(self) -> None:
+        for partition in self.partitions:
+            partition.create_files()
+
+    def remove_files(self) -> None:
+        """Remove the partitions' files, their lock files too since no later generation uses those names."""
+        for partition in self.partitions:
+            partition.remove_files()
+            if os.path.exists(partition.lock_path()):
+                os.remove(partition.lock_path())
+            partition.lock.close()
+
+    def open(self, flush_policy: Any = FLUSH_ON_EXIT) -> 'PartitionedDBTable':
+        for partition in self.partitions:
+            partition.open(flush_policy)
+        self.open_count += 1
+        return self
+
+    def close(self, force: bool = False) -> None:
+        if not self.open_count:
+            return
+        self.open_count = 0 if force else self.open_count - 1
+        for partition in self.partitions:
+            partition.close(force)
+
+    def flush(self) -> None:
+        for partition in self.partitions:
+            partition.flush()
+
+    def sync_files(self) -> None:
+        for partition in self.partitions:
+            partition.sync_files()
+
+    def count(self) -> int:
+        with self.lock.reading():
+            return sum(partition.count() for partition in self.partitions)
+
+    def current_stats(self, refresh: bool = False) -> Dict[str, Any]:
+        stats = table_stats.new_stats()
+        for partition in self.partitions:
+            stats = table_stats.merge(stats, partition.current_stats(refresh))
+        return stats
+
+    def analyze(self) -> None:
+        for partition in self.partitions:
+            partition.analyze()
+
+    @instrumented('insert_record')
+    def insert_record(self, values: Dict[str, Any]) -> None:
+        row = self.new_row(values)
+        self.partition(row[self.key_field_name]).insert_record(values)
+
+    @instrumented('insert_records')
+    def insert_records(self, records: Iterable[Dict[str, Any]], batch_size: int = 1000) -> List[Tuple[int, Exception]]:
+        if batch_size < 1:
+            raise ValueError
+        failures = []
+        routed = {}  # partition index -> [(position, values)]
+        pending = 0
+        for position, values in enumerate(records):
+            try:
+                row = self.new_row(values)
+            except ValueError as error:
+                failures.append((position, error))
+                continue
+            routed.setdefault(self.partition_index(row[self.key_field_name]), []).append((position, values))
+            pending += 1
+            if pending == batch_size:
+                self.insert_routed(routed, failures)
+                routed, pending = {}, 0
+        self.insert_routed(routed, failures)
+        return sorted(failures, key=lambda failure: failure[0])
+
+    def insert_routed(self, routed: Dict[int, List[Tuple[int, Dict[str, Any]]]],
+                      failures: List[Tuple[int, Exception]]) -> None:
+        for index, batch in routed.items():
+            positions = [position for position, values in batch]
+            for position, error in self.partitions[index].insert_records(values for position, values in batch):
+                failures.append((positions[position], error))
+
+    @instrumented('delete_record')
+    def delete_record(self, key: Any) -> None:
+        self.partition(key).delete_record(key)
+
+    @instrumented('delete_records')
+    def delete_records(self, criteria: List[SelectionCriteria]) -> int:
+        if any(criterion.field_name not in self.field_names() for criterion in criteria):
+            raise ValueError
+        return sum(partition.delete_records(criteria) for partition in self.target_partitions(criteria))
+
+    @instrumented('update_records')
+    def update_records(self, criteria: List[SelectionCriteria], values: Dict[str, Any]) -> int:
+        if any(criterion.field_name not in self.field_names() for criterion in criteria):
+            raise ValueError
+        return sum(partition.update_records(criteria, values) for partition in self.target_partitions(criteria))
+
+    @instrumented('get_record')
+    def get_record(self, key: Any) -> Dict[str, Any]:
+        return self.partition(key).get_record(key)
+
+    @instrumented('update_record')
+    def update_record(self, key: Any, values: Dict[str, Any]) -> None:
+        self.partition(key).update_record(key, values)
+
+    def iter_matching_rows(self, criteria: List[SelectionCriteria], fields: Iterable[str] = None) \
+            -> Iterator[Dict[str, Any]]:
+        for partition in self.target_partitions(criteria):
+            yield from partition.iter_matching_rows(criteria, fields)
+
+    def ordered_rows(self, field: str, criteria: List[SelectionCriteria], descending: bool) \
+            -> Iterator[Dict[str, Any]]:
+        """Merge the partitions' ordered index walks into one stream in field order."""
+        yield from heapq.merge(*(partition.iter_ordered(field, criteria, descending) for partition in self.partitions),
+                               key=lambda row: row[field], reverse=descending)
+
+    def iter_null_rows(self, field: str, criteria: List[SelectionCriteria]) -> Iterator[Dict[str, Any]]:
+        for partition in self.partitions:
+            yield from partition.iter_null_rows(field, criteria)
+
+    def explain(self, criteria: List[SelectionCriteria], fields: List[str] = None) -> Dict[str, Any]:
+        with self.lock.reading():
+            explains = [partition.explain(criteria, fields) for partition in self.target_partitions(criteria)]
+        return {"plan": explains[0]["plan"], "fields": explains[0]["fields"],
+                "estimated_rows": sum(explain["estimated_rows"] for explain in explains),
+                "actual_rows": sum(explain["actual_rows"] for explain in explains),
+                "returned_rows": sum(explain["returned_rows"] for explain in explains),
+                "partitions": len(explains)}
+
+    @instrumented('create_index')
+    def create_index(self, field_to_index: Union[str, List[str]], kind: str = HASH_INDEX,
+                     include: List[str] = None) -> None:
+        for partition in self.partitions:
+            partition.create_index(field_to_index, kind, include)
+        self.hash_index = list(self.partitions[0].hash_index)
+        self.ordered_index = list(self.partitions[0].ordered_index)
+        self.covering_indexes = list(self.partitions[0].covering_indexes)
+        self.save_index_flags()
@@ -0,0 +1,86 @@
+from typing import Any, Callable, Dict, List
+import operator
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge
+}
+IN = 'IN'
+BETWEEN = 'BETWEEN'
+IS_NULL = 'IS NULL'
+IS_NOT_NULL = 'IS NOT NULL'
+LIKE = 'LIKE'
+OPERATORS = set(COMPARISONS) | {IN, BETWEEN, IS_NULL, IS_NOT_NULL, LIKE}
+
+Predicate = Callable[[Dict[str, Any]], bool]
+
+
+def normalize_operator(criterion) -> str:
+    name = ' '.join(str(criterion.operator).split()).upper()
+    if name not in OPERATORS:
+        raise ValueError(f'unsupported operator {criterion.operator!r} on {criterion.field_name}, '
+                         f'expected one of {sorted(OPERATORS)}')
+    return name
+
+
+def in_values(criterion) -> tuple:
+    """The values of an IN criterion as a tuple, stored back on the criterion so a generator is read only once."""
+    if not isinstance(criterion.value, tuple):
+        criterion.value = tuple(criterion.value)
+    return criterion.value
+
+
+def compile_criterion(criterion) -> Predicate:
+    field = criterion.field_name
+    value = criterion.value
+    name = normalize_operator(criterion)
+
+    if name in COMPARISONS:
+        compare = COMPARISONS[name]
+        return lambda row: row[field] is not None and compare(row[field], value)
+    if name == IS_NULL:
+        return lambda row: row[field] is None
+    if name == IS_NOT_NULL:
+        return lambda row: row[field] is not None
+    if name == IN:
+        values = in_values(criterion)
+        try:
+            values = frozenset(values)
+        except TypeError:  # unhashable values are compared one by one
+            pass
+        return lambda row: row[field] is not None and row[field] in values
+    if name == BETWEEN:
+        if not isinstance(value, (tuple, list)) or len(value) != 2:
+            raise ValueError(f'BETWEEN on {field} expects a (low, high) pair')
+        low, high = value
+        return lambda row: row[field] is not None and low <= row[field] <= high
+
+    if not isinstance(value, str) or '_' in value or '%' in value[:-1]:  # LIKE
+        raise ValueError(f'LIKE on {field} supports only prefix patterns such as "abc%"')
+    if not value.endswith('%'):
+        return lambda row: row[field] == value
+    prefix = value[:-1]
+    return lambda row: isinstance(row[field], str) and row[field].startswith(prefix)
+
+
+def compile_criteria(criteria: List[Any], estimate: Callable[[Any], float] = None) -> Predicate:
+    """Compile criteria once into a single row predicate that checks the most selective criterion first."""
+    compiled = [(criterion, compile_criterion(criterion)) for criterion in criteria]
+    if estimate is not None:
+        compiled.sort(key=lambda pair: estimate(pair[0]))
+    predicates = [predicate for criterion, predicate in compiled]
+    if not predicates:
+        return lambda row: True
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def predicate(row: Dict[str, Any]) -> bool:
+        for condition in predicates:
+            if not condition(row):
+                return False
+        return True
+    return predicate
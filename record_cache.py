@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import pickle
+import threading
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class RecordCache:
+    """A bounded LRU cache of rows by primary key, limited by entry count and/or pickled size in bytes.
+
+    Rows are copied on the way in and on the way out, so callers can never mutate a cached row.
+    """
+
+    def __init__(self, max_entries: Optional[int] = DEFAULT_MAX_ENTRIES, max_bytes: Optional[int] = None):
+        if (max_entries is not None and max_entries < 0) or (max_bytes is not None and max_bytes < 0):
+            raise ValueError
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.rows = OrderedDict()  # shelf key -> (row, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.rows.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, key: str, row: Dict[str, Any]) -> None:
+        size = len(pickle.dumps(row)) if self.max_bytes is not None else 0
+        with self.lock:
+            self.discard(key)
+            if self.max_entries == 0 or (self.max_bytes is not None and size > self.max_bytes):
+                return
+            self.rows[key] = (dict(row), size)
+            self.bytes += size
+            while (self.max_entries is not None and len(self.rows) > self.max_entries) or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.bytes -= self.rows.popitem(last=False)[1][1]  # evict the least recently used row
+
+    def invalidate(self, key: str) -> None:
+        with self.lock:
+            self.discard(key)
+
+    def discard(self, key: str) -> None:
+        entry = self.rows.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.rows.clear()
+            self.bytes = 0
+
+    def info(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.rows), "bytes": self.bytes,
+                    "max_entries": self.max_entries, "max_bytes": self.max_bytes}
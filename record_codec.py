@@ -0,0 +1,116 @@
+from typing import Any, Dict, Iterator, List
+import datetime as dt
+import pickle
+import struct
+
+import dbm_sqlite
+
+CODEC_VERSION = 1  # first byte of every encoded record, and the catalog "codec" of tables that use it
+FIXED_FORMATS = {int: 'q', float: 'd', dt.datetime: 'q'}
+LENGTH = struct.Struct('<I')
+EPOCH = dt.datetime.min
+MICROSECOND = dt.timedelta(microseconds=1)
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+class RecordCodec:
+    """Packs a row into bytes according to its table's fields instead of pickling a dict of field names.
+
+    A record is the codec version, a null bitmap, the int, float and datetime fields at fixed offsets,
+    then each other non-null field as a length and its bytes (UTF-8 for str, pickle for any other
+    type). decode(data, fields) reads only the requested fields.
+    """
+
+    def __init__(self, fields: List[Any]):
+        self.fields = list(fields)
+        self.names = [field.name for field in self.fields]
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self.null_bytes = (len(self.fields) + 7) // 8
+        self.fixed = [i for i, field in enumerate(self.fields) if field.type in FIXED_FORMATS]
+        self.variable = [i for i, field in enumerate(self.fields) if field.type not in FIXED_FORMATS]
+        self.fixed_struct = struct.Struct('<' + ''.join(FIXED_FORMATS[self.fields[i].type] for i in self.fixed))
+        self.fixed_start = 1 + self.null_bytes
+        self.variable_start = self.fixed_start + self.fixed_struct.size
+
+    def __reduce__(self):  # rebuilt from the fields when sent to scan workers
+        return RecordCodec, (self.fields,)
+
+    def check(self, row: Dict[str, Any]) -> None:
+        """Raise ValueError unless every non-null value has its field's declared type."""
+        for field in self.fields:
+            value = row.get(field.name)
+            if value is None:
+                continue
+            accepted = (int, float) if field.type is float else field.type
+            if not isinstance(value, accepted) or (isinstance(value, bool) and field.type is not bool):
+                raise ValueError(f'{field.name} expects {field.type.__name__}, got {type(value).__name__}')
+            if field.type is int and not INT64_MIN <= value <= INT64_MAX:
+                raise ValueError(f'{field.name} does not fit in 64 bits')
+            if field.type is dt.datetime and value.tzinfo is not None:
+                raise ValueError(f'{field.name} expects a naive datetime')
+
+    def encode(self, row: Dict[str, Any]) -> bytes:
+        nulls = 0
+        fixed_values = []
+        for i in self.fixed:
+            value = row[self.names[i]]
+            if value is None:
+                nulls |= 1 << i
+                fixed_values.append(0)
+            elif self.fields[i].type is dt.datetime:
+                fixed_values.append((value - EPOCH) // MICROSECOND)
+            else:
+                fixed_values.append(value)
+        parts = []
+        for i in self.variable:
+            value = row[self.names[i]]
+            if value is None:
+                nulls |= 1 << i
+                continue
+            payload = value.encode('utf-8') if self.fields[i].type is str else pickle.dumps(value)
+            parts += [LENGTH.pack(len(payload)), payload]
+        header = bytes([CODEC_VERSION]) + nulls.to_bytes(self.null_bytes, 'little')
+        return b''.join([header, self.fixed_struct.pack(*fixed_values)] + parts)
+
+    def decode(self, data: bytes, fields: List[str] = None) -> Dict[str, Any]:
+        if data[0] != CODEC_VERSION:
+            raise ValueError(f'unknown record codec version {data[0]}')
+        wanted = range(len(self.fields)) if fields is None else sorted({self.positions[field] for field in fields})
+        wanted_set = set(wanted)
+        nulls = int.from_bytes(data[1:self.fixed_start], 'little')
+        values = [None] * len(self.fields)
+        if self.fixed and any(i in wanted_set for i in self.fixed):
+            for i, value in zip(self.fixed, self.fixed_struct.unpack_from(data, self.fixed_start)):
+                if i in wanted_set and not nulls >> i & 1:
+                    values[i] = EPOCH + value * MICROSECOND if self.fields[i].type is dt.datetime else value
+        last = max(wanted_set & set(self.variable), default=-1)
+        position = self.variable_start
+        for i in self.variable:
+            if i > last:
+                break
+            if nulls >> i & 1:
+                continue
+            length, = LENGTH.unpack_from(data, position)
+            position += LENGTH.size
+            if i in wanted_set:
+                payload = data[position:position + length]
+                values[i] = payload.decode('utf-8') if self.fields[i].type is str else pickle.loads(payload)
+            position += length
+        return {self.names[i]: values[i] for i in wanted}
+
+
+class RecordShelf(dbm_sqlite.Shelf):
+    """A shelf of table rows stored with the table's record codec instead of pickle."""
+
+    def __init__(self, dict: Any, codec: RecordCodec):
+        super().__init__(dict)
+        self.codec = codec
+
+    def loads(self, data: bytes) -> Dict[str, Any]:
+        return self.codec.decode(data)
+
+    def dumps(self, row: Dict[str, Any]) -> bytes:
+        return self.codec.encode(row)
+
+    def raw_values(self) -> Iterator[bytes]:
+        return self.dict.values()
@@ -0,0 +1,83 @@
+from pathlib import Path
+from typing import Any, Dict, Optional
+import datetime as dt
+import json
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST = 'snapshot.json'
+SKIPPED_SUFFIXES = ('.lock',)  # per process lock state, never part of a snapshot
+SKIPPED_FILES = ('wal*.log',)  # write-ahead logs: a snapshot is taken right after a checkpoint
+FICLONE = 0x40049409  # reflink ioctl on Linux filesystems with copy-on-write extents (btrfs, xfs)
+
+
+def copy_file(source: Path, destination: Path) -> None:
+    """Copy source to destination as a reflink when the filesystem supports it, else byte by byte."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if fcntl is not None:
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                shutil.copystat(source, destination)
+                return
+            except OSError:
+                pass
+    shutil.copy2(source, destination)
+
+
+def database_files(root: Path) -> Dict[str, Path]:
+    return {path.relative_to(root).as_posix(): path for path in sorted(root.glob('**/*'))
+            if path.is_file() and not path.name.endswith(SKIPPED_SUFFIXES) and not any(path.match(pattern) for pattern in SKIPPED_FILES)
+            and path.name != MANIFEST}
+
+
+def read_manifest(snapshot: Path) -> Dict[str, Any]:
+    manifest_path = Path(snapshot) / MANIFEST
+    return json.loads(manifest_path.read_text()) if manifest_path.exists() else {"files": {}}
+
+
+def take_snapshot(root: Path, destination: Path, previous: Optional[Path] = None) -> Dict[str, Any]:
+    """Copy every database file under root into destination, which must not exist yet.
+
+    Files unchanged since the previous snapshot (same size and mtime) are hardlinked from it, since
+    snapshot files are never written again. The rest are reflinked or copied. The caller makes sure
+    no writes happen meanwhile.
+    """
+    root, destination = Path(root), Path(destination)
+    destination.mkdir(parents=True)
+    previous_files = read_manifest(previous)["files"] if previous is not None else {}
+    files = {}
+    linked = 0
+    for name, path in database_files(root).items():
+        status = path.stat()
+        files[name] = {"size": status.st_size, "mtime_ns": status.st_mtime_ns}
+        target = destination / name
+        if previous_files.get(name) == files[name]:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(Path(previous) / name, target)
+                linked += 1
+                continue
+            except OSError:  # previous is on another filesystem (EXDEV), or it does not support hardlinks
+                pass
+        copy_file(path, target)
+    manifest = {"created": dt.datetime.now().isoformat(), "previous": str(previous) if previous else None,
+                "files": files, "linked": linked, "copied": len(files) - linked}
+    (destination / MANIFEST).write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def restore_snapshot(source: Path, root: Path) -> None:
+    """Replace the database files under root with the files of the snapshot (or plain copy) at source."""
+    source, root = Path(source), Path(root)
+    if not source.is_dir():
+        raise ValueError
+    for path in database_files(root).values():
+        path.unlink()
+    for name, path in database_files(source).items():
+        copy_file(path, root / name)
@@ -0,0 +1,115 @@
+from hashlib import blake2b
+from heapq import nsmallest
+from typing import Any, Dict, List, Optional, Tuple
+
+from ordered_index import range_bounds
+from predicates import in_values
+
+SKETCH_SIZE = 64  # number of smallest value hashes kept per field for distinct estimates
+HASH_RANGE = 2 ** 64
+DEFAULT_RANGE_FRACTION = 1 / 3  # used when the field's values cannot be interpolated (e.g. str)
+OPERATOR_FRACTIONS = {"IS NULL": 0.05, "LIKE": 0.1, "!=": 0.9, "IS NOT NULL": 0.95}
+
+
+def new_stats() -> Dict[str, Any]:
+    return {"row_count": 0, "fields": {}}
+
+
+def value_hash(value: Any) -> int:
+    return int.from_bytes(blake2b(repr(value).encode(), digest_size=8).digest(), 'big')
+
+
+def add_row(stats: Dict[str, Any], row: Dict[str, Any], row_count: int = 1) -> None:
+    """Count row into stats (row_count=0 for the new values of an updated row)."""
+    stats["row_count"] += row_count
+    for field, value in row.items():
+        if value is None:
+            continue
+        field_stats = stats["fields"].setdefault(field, {"min": value, "max": value, "sketch": []})
+        try:
+            field_stats["min"] = min(field_stats["min"], value)
+            field_stats["max"] = max(field_stats["max"], value)
+        except TypeError:  # values of mixed types have no order
+            pass
+        hashed = value_hash(value)
+        sketch = field_stats["sketch"]
+        if hashed not in sketch and (len(sketch) < SKETCH_SIZE or hashed < sketch[-1]):
+            sketch.append(hashed)
+            sketch.sort()
+            del sketch[SKETCH_SIZE:]
+
+
+def merge(stats: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    merged = {"row_count": stats["row_count"] + delta["row_count"], "fields": dict(stats["fields"])}
+    for field, delta_stats in delta["fields"].items():
+        field_stats = merged["fields"].get(field)
+        if field_stats is None:
+            merged["fields"][field] = delta_stats
+            continue
+        merged_stats = {"min": field_stats["min"], "max": field_stats["max"],
+                        "sketch": nsmallest(SKETCH_SIZE, set(field_stats["sketch"]) | set(delta_stats["sketch"]))}
+        try:
+            merged_stats["min"] = min(field_stats["min"], delta_stats["min"])
+            merged_stats["max"] = max(field_stats["max"], delta_stats["max"])
+        except TypeError:
+            pass
+        merged["fields"][field] = merged_stats
+    return merged
+
+
+def distinct_values(stats: Dict[str, Any], field: str) -> float:
+    """K-minimum-values estimate of the number of distinct values of field (exact below SKETCH_SIZE)."""
+    field_stats = stats["fields"].get(field)
+    if field_stats is None:
+        return 1
+    sketch = field_stats["sketch"]
+    if len(sketch) < SKETCH_SIZE:
+        return max(len(sketch), 1)
+    return min((SKETCH_SIZE - 1) * HASH_RANGE / (sketch[-1] + 1), max(stats["row_count"], 1))
+
+
+def equality_rows(stats: Dict[str, Any], field: str) -> float:
+    return max(stats["row_count"], 0) / distinct_values(stats, field)
+
+
+def range_rows(stats: Dict[str, Any], field: str, bounds: Tuple[Any, bool, Any, bool]) -> float:
+    """Estimate the rows in bounds by interpolating between the field's min and max."""
+    low, include_low, high, include_high = bounds
+    row_count = max(stats["row_count"], 0)
+    if low is not None and low == high:
+        return equality_rows(stats, field)
+    field_stats = stats["fields"].get(field)
+    if field_stats is None:
+        return 0
+    minimum, maximum = field_stats["min"], field_stats["max"]
+    try:
+        start = minimum if low is None else max(low, minimum)
+        end = maximum if high is None else min(high, maximum)
+        if end < start:
+            return 0
+        if minimum == maximum:
+            return row_count
+        return row_count * ((end - start) / (maximum - minimum))
+    except TypeError:
+        return row_count * DEFAULT_RANGE_FRACTION
+
+
+def field_summary(stats: Dict[str, Any], fields: List[str]) -> Dict[str, Dict[str, Optional[Any]]]:
+    summary = {}
+    for field in fields:
+        field_stats = stats["fields"].get(field, {})
+        summary[field] = {"min": field_stats.get("min"), "max": field_stats.get("max"),
+                          "distinct": distinct_values(stats, field) if field_stats else 0}
+    return summary
+
+
+def criterion_rows(stats: Dict[str, Any], criterion) -> float:
+    """Estimate how many rows satisfy criterion alone."""
+    operator = ' '.join(str(criterion.operator).split()).upper()
+    if operator == "=":
+        return equality_rows(stats, criterion.field_name)
+    if operator == "IN":
+        return equality_rows(stats, criterion.field_name) * len(in_values(criterion))
+    if operator in ("<", "<=", ">", ">=", "BETWEEN"):
+        return range_rows(stats, criterion.field_name, range_bounds([criterion], criterion.field_name))
+    return max(stats["row_count"], 0) * OPERATOR_FRACTIONS.get(operator, 1)
@@ -1,4 +1,10 @@
+import asyncio
+import contextlib
 import datetime as dt
+import multiprocessing
+import pickle
+import shelve
+import threading
 import time
 from functools import partial
 from pathlib import Path
@@ -6,8 +12,14 @@ from typing import Generator
 
 import pytest
 
-from db import DataBase
+from async_db import AsyncDataBase
+from benchmark import compare
+from db import DataBase, SortKey
 from db_api import DBField, SelectionCriteria, DB_ROOT, DBTable
+import dbm_sqlite
+from ordered_index import OrderedIndex
+from record_codec import CODEC_VERSION
+from wal import WriteAheadLog
 
 DB_BACKUP_ROOT = DB_ROOT.parent / (DB_ROOT.name + '_backup')
 STUDENT_FIELDS = [DBField('ID', int), DBField('First', str),
@@ -142,6 +154,687 @@ def test_performance(new_db: DataBase) -> None:
     assert delete_stop - delete_start < 20
 
 
+def test_per_op_cost(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+
+    def per_op_seconds(first: int) -> float:  # best of 3 rounds of insert, get and update outside a session
+        rounds = []
+        for start in range(first, first + 60, 20):
+            round_start = time.perf_counter()
+            for i in range(start, start + 20):
+                add_student(students, i)
+                students.cache.clear()
+                students.get_record(1_000_000 + i)
+                students.update_record(1_000_000 + i, dict(First='Jane'))
+            rounds.append((time.perf_counter() - round_start) / 20)
+        return min(rounds)
+
+    small = per_op_seconds(0)
+    students.insert_records(dict(ID=2_000_000 + i, First=f'John{i}', Last=f'Doe{i}') for i in range(20000))
+    catalog = new_db.catalog_entries()
+    large = per_op_seconds(100)
+    assert students.count() == 20120
+    assert new_db.catalog is catalog  # saving the statistics of each write leaves the cached catalog alone
+    assert large < 3 * small  # opening the table file must not read an index of every key
+
+
+def test_insert_records(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=2)
+    students.create_index('Last')
+    records = [dict(ID=1_000_000 + i, First=f'John{i}', Last=f'Doe{i % 3}') for i in range(1, 10)]
+    records.append(dict(ID=1_000_020, Age=20))
+    records.append(dict(ID=1_000_009, First='Again'))
+    failures = students.insert_records(records, batch_size=4)
+    assert [position for position, error in failures] == [0, 9, 10]
+    assert all(isinstance(error, ValueError) for position, error in failures)
+    assert students.count() == 10
+    assert students.get_record(1_000_009)['First'] == 'John9'
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Doe0')])) == 4
+
+
+def test_session(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.create_index('First')
+    with new_db.session(flush_policy=10):
+        for i in range(50):
+            add_student(students, i)
+        assert students.open_count == 1
+        students.update_record(1_000_007, dict(First='Jane'))
+        assert len(students.query_table([SelectionCriteria('First', '=', 'Jane')])) == 1
+    assert students.open_files == {}
+    assert DataBase().get_table('Students').count() == 50
+    with new_db.session():  # each write is committed before the write lock goes to another handle
+        add_student(students, 50)
+        other = DataBase().get_table('Students')
+        add_student(other, 51)
+        assert students.count() == 52
+    with students.open(), pytest.raises(ValueError):
+        add_student(students, 1)
+    assert students.open_count == 0
+    with pytest.raises(ValueError):
+        students.open(flush_policy='sometimes')
+
+
+def test_migrate_old_layout(new_db: DataBase) -> None:
+    data_file = shelve.open(str(DB_ROOT / 'DataBase.db'))
+    data_file['Students'] = dict(fields=STUDENT_FIELDS, key_field_name='ID')
+    data_file.close()
+    table_file = shelve.open(str(DB_ROOT / 'Students.db'))
+    table_file['Students'] = {1_000_000 + i: dict(First=f'John{i}', Last=f'Doe{i}', Birthday=dt.datetime(2000, 2, 1))
+                              for i in range(10)}
+    table_file.close()
+
+    students = DataBase().get_table('Students')
+    assert students.count() == 10
+    assert students.get_record(1_000_003)['First'] == 'John3'
+    add_student(students, 10)
+    assert students.count() == 11
+
+
+def test_query_multiple_tables(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=10)
+    grades = new_db.create_table('Grades', [DBField('GradeID', int), DBField('ID', int),
+                                            DBField('Course', str), DBField('Grade', int)], 'GradeID')
+    for i in range(20):
+        grades.insert_record(dict(GradeID=i + 1, ID=1_000_000 + i % 5, Course=f'Course{i % 2}', Grade=50 + i))
+
+    def join(first_criteria, grades_criteria):
+        return new_db.query_multiple_tables(['Students', 'Grades'], [first_criteria, grades_criteria], ['ID'])
+
+    results = join([SelectionCriteria('ID', '<', 1_000_002)], [SelectionCriteria('Course', '=', 'Course0')])
+    assert sorted((row['ID'], row['GradeID']) for row in results) == \
+           [(1_000_000, 1), (1_000_000, 11), (1_000_001, 7), (1_000_001, 17)]
+    assert all(row['First'] == f'John{row["ID"] - 1_000_000}' for row in results)
+    assert len(join([], [])) == 20
+
+    grades.create_index('ID')
+    assert len(join([SelectionCriteria('First', '=', 'John3')], [])) == 4
+    assert join([SelectionCriteria('First', '=', 'John7')], []) == []
+    assert len(new_db.query_multiple_tables(['Grades', 'Students'], [[], []], ['ID'])) == 20
+    with pytest.raises(ValueError):
+        join([], [SelectionCriteria('First', '=', 'John3')])
+
+    assert grades.estimate_rows([SelectionCriteria('Course', '=', 'Course0')]) < grades.count()
+    new_db.create_table('Teachers', [DBField('ID', int), DBField('First', str)], 'ID')
+    with pytest.raises(ValueError):  # both have First, which is not joined on
+        new_db.query_multiple_tables(['Students', 'Teachers'], [[], []], ['ID'])
+
+
+def test_ordered_index(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=300)
+    students.create_index('Birthday', kind='ordered')
+    students.create_index('ID', kind='ordered')
+    students.update_record(1_000_010, dict(Birthday=dt.datetime(2020, 1, 1)))
+    students.delete_records([SelectionCriteria('ID', '>=', 1_000_290)])
+    add_student(students, 300, Birthday=dt.datetime(1990, 1, 1))
+    assert students.count() == 291
+
+    since = dt.datetime(2000, 2, 1) + dt.timedelta(days=280)
+    results = students.query_table([SelectionCriteria('Birthday', '>', since)])
+    assert sorted(row['ID'] for row in results) == [1_000_010] + list(range(1_000_281, 1_000_290))
+    results = students.query_table([SelectionCriteria('ID', '<', 1_000_003), SelectionCriteria('ID', '!=', 1_000_001)])
+    assert sorted(row['ID'] for row in results) == [1_000_000, 1_000_002]
+
+    birthdays = [row['Birthday'] for row in students.iter_ordered('Birthday', descending=True)]
+    assert birthdays == sorted(birthdays, reverse=True) and len(birthdays) == 291
+    assert birthdays[0] == dt.datetime(2020, 1, 1) and birthdays[-1] == dt.datetime(1990, 1, 1)
+    assert DataBase().get_table('Students').ordered_index == [True, False, False, True]
+    with pytest.raises(ValueError):
+        students.create_index('Birthday', kind='bitmap')
+
+    index_file = dbm_sqlite.open_shelf(DB_ROOT / 'walk.db')
+    index = OrderedIndex(index_file)
+    index.bulk_load([(i * 2, i) for i in range(600)])
+    for descending in (False, True):  # pages split while a walk is paused are neither skipped nor read twice
+        walk = index.range(descending=descending)
+        entries = [next(walk) for i in range(10)]
+        for i in range(600):
+            index.insert(i * 2 + 1, (descending + 1) * 1000 + i)
+        entries += list(walk)
+        assert entries == sorted(entries, reverse=descending)
+        assert [key for value, key in entries if value % 2 == 0] == sorted(range(600), reverse=descending)
+    index_file.close()
+
+
+def test_index_intersection(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 2}', Last=f'Doe{i % 25}') for i in range(100))
+    students.create_index('First')
+    students.create_index('Last')
+    criteria = [SelectionCriteria('First', '=', 'John1'), SelectionCriteria('Last', '=', 'Doe3')]
+    assert sorted(students.query_on_index(criteria)) == [1_000_003, 1_000_053]
+    assert sorted(row['ID'] for row in students.query_table(criteria)) == [1_000_003, 1_000_053]
+    assert students.query_table(criteria + [SelectionCriteria('Last', '=', 'Doe4')]) == []
+    assert students.query_on_index([SelectionCriteria('First', '=', 'Jane')]) == []
+
+
+def test_explain(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 100}', Last='Doe',
+                                 Birthday=dt.datetime(2000, 1, 1) + dt.timedelta(days=i)) for i in range(1000))
+    students.create_index('First')
+    students.create_index('Last')
+    students.create_index('Birthday', kind='ordered')
+    assert students.count() == 1000
+    assert 50 < students.statistics()['fields']['First']['distinct'] < 200
+
+    plan = students.explain([SelectionCriteria('ID', '=', 1_000_005), SelectionCriteria('Last', '=', 'Doe')])
+    assert plan['plan'] == 'primary key' and plan['actual_rows'] == 1
+    plan = students.explain([SelectionCriteria('First', '=', 'John7'), SelectionCriteria('Last', '=', 'Doe')])
+    assert plan['plan'] == 'hash index' and plan['actual_rows'] == 10 and 5 < plan['estimated_rows'] < 20
+    plan = students.explain([SelectionCriteria('Birthday', '<', dt.datetime(2000, 1, 11))])
+    assert plan['plan'] == 'ordered index' and plan['actual_rows'] == plan['returned_rows'] == 10
+    plan = students.explain([SelectionCriteria('Birthday', '>', dt.datetime(2000, 1, 11))])
+    assert plan['plan'] == 'full scan' and plan['actual_rows'] == 1000 and plan['returned_rows'] == 989
+
+    students.delete_records([SelectionCriteria('First', '=', 'John7')])
+    assert DataBase().get_table('Students').count() == 990
+
+
+def test_iter_query(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=50)
+    rows = students.iter_query([SelectionCriteria('ID', '>=', 1_000_010)], fields=['ID', 'Last'], limit=5)
+    first = next(rows)
+    assert set(first) == {'ID', 'Last'} and first['ID'] >= 1_000_010
+    assert len(list(rows)) == 4
+    assert list(students.iter_query([], limit=0)) == []
+    assert len(list(students.iter_query([SelectionCriteria('First', '!=', 'John0')]))) == 49
+    with pytest.raises(ValueError):
+        list(students.iter_query([], fields=['Age']))
+    for row in students.iter_query([SelectionCriteria('ID', '<', 1_000_005)]):  # the read lock is not held here
+        students.update_record(row['ID'], dict(Last='Read'))
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Read')])) == 5
+
+
+def test_order_by(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=40)
+    students.update_record(1_000_003, dict(Birthday=None))
+    students.update_record(1_000_005, dict(Last='Doe6'))
+    by_birthday = students.query_table([SelectionCriteria('ID', '<', 1_000_010)], order_by=['Birthday'], limit=3)
+    assert [row['ID'] for row in by_birthday] == [1_000_000, 1_000_001, 1_000_002]
+    latest = students.query_table([], order_by=[SortKey('Birthday', descending=True)], limit=2)
+    assert [row['ID'] for row in latest] == [1_000_039, 1_000_038]
+
+    order_by = [SortKey('Last', descending=True), SortKey('ID')]
+    rows = students.query_table([SelectionCriteria('ID', '<', 1_000_010)], order_by=order_by)
+    assert [row['ID'] for row in rows][:4] == [1_000_009, 1_000_008, 1_000_007, 1_000_005]
+
+    students.create_index('Birthday', kind='ordered')
+    rows = list(students.iter_query([SelectionCriteria('ID', '<', 1_000_005)], fields=['ID'], order_by=['Birthday']))
+    assert rows == [dict(ID=1_000_000), dict(ID=1_000_001), dict(ID=1_000_002), dict(ID=1_000_004),
+                    dict(ID=1_000_003)]
+    students.update_record(1_000_039, dict(Birthday=None))
+    latest = students.query_table([], order_by=[SortKey('Birthday', descending=True)])
+    assert latest[0]['ID'] == 1_000_038 and {row['ID'] for row in latest[-2:]} == {1_000_003, 1_000_039}
+    instrumented = DataBase(instrument=True).get_table('Students')
+    rows = instrumented.query_table([SelectionCriteria('ID', '=', 1_000_030)], order_by=['Birthday'], limit=1)
+    assert [row['ID'] for row in rows] == [1_000_030]
+    assert instrumented.instrumentation.snapshot()['Students']['rows_examined'] == 1  # the key, not the index walk
+    with pytest.raises(ValueError):
+        students.query_table([], order_by=['Age'])
+
+
+def test_operators(new_db: DataBase) -> None:
+    students = create_students_table(new_db, num_students=20)
+    students.update_record(1_000_004, dict(Last=None))
+
+    def ids(*criteria):
+        return sorted(row['ID'] - 1_000_000 for row in students.query_table(list(criteria)))
+
+    assert ids(SelectionCriteria('ID', 'in', [1_000_001, 1_000_003, 2_000_000])) == [1, 3]
+    birthday = SelectionCriteria('Birthday', '<', dt.datetime(2001, 1, 1))
+    assert ids(SelectionCriteria('ID', 'IN', (1_000_000 + i for i in (2, 5))), birthday) == [2, 5]  # read once
+    assert ids(SelectionCriteria('ID', 'BETWEEN', (1_000_005, 1_000_007))) == [5, 6, 7]
+    assert ids(SelectionCriteria('Last', 'IS NULL', None)) == [4]
+    assert len(ids(SelectionCriteria('Last', 'is not null', None))) == 19
+    assert ids(SelectionCriteria('First', 'LIKE', 'John1%'), SelectionCriteria('ID', '<', 1_000_012)) == [1, 10, 11]
+    assert ids(SelectionCriteria('First', 'LIKE', 'John7')) == [7]
+    with pytest.raises(ValueError):
+        students.query_table([SelectionCriteria('ID', '==', 1_000_001)])
+    with pytest.raises(ValueError):
+        students.query_table([SelectionCriteria('First', 'LIKE', '%ohn')])
+    with pytest.raises(ValueError):
+        students.query_table([SelectionCriteria('ID', 'BETWEEN', 1_000_001)])
+
+
+def test_columnar_table(new_db: DataBase) -> None:
+    pytest.importorskip('numpy')
+    students = new_db.create_table('Students', STUDENT_FIELDS, 'ID', engine='columnar')
+    students.insert_records(dict(ID=1_000_000 + i, First=f'John{i}', Last=None if i % 100 == 0 else f'Doe{i % 7}',
+                                 Birthday=dt.datetime(2000, 2, 1) + dt.timedelta(days=i)) for i in range(1500))
+    students.update_record(1_000_007, dict(First='Jane'))
+    students.delete_record(1_000_001)
+    students.delete_records([SelectionCriteria('Birthday', '>=', dt.datetime(2000, 2, 1) + dt.timedelta(days=1400))])
+    with pytest.raises(ValueError):
+        add_student(students, 7)
+    with pytest.raises(ValueError):
+        add_student(students, 2000, First=7)
+    with pytest.raises(ValueError):  # checked like the row engine: no int64 overflow, naive datetimes only
+        add_student(students, 2000, ID=2 ** 63)
+    with pytest.raises(ValueError):
+        add_student(students, 2000, Birthday=dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc))
+
+    students = DataBase().get_table('Students')
+    assert students.count() == 1399
+    assert students.get_record(1_000_007) == dict(ID=1_000_007, First='Jane', Last='Doe0',
+                                                  Birthday=dt.datetime(2000, 2, 8))
+    assert len(students.query_table([SelectionCriteria('Last', '=', 'Doe3'),
+                                     SelectionCriteria('ID', '<', 1_000_100)])) == 14
+    assert len(students.query_table([SelectionCriteria('Last', 'IS NULL', None)])) == 14
+    assert len(students.query_table([SelectionCriteria('First', 'LIKE', 'John13%')])) == 111
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('ID', 'IN', [1_000_001, 1_000_002])])] == \
+           [1_000_002]
+    assert len(students.query_table([SelectionCriteria('ID', 'IN', iter([1_000_001, 1_000_002]))])) == 1
+    oldest = students.query_table([SelectionCriteria('Last', '!=', 'Doe0')], order_by=['Birthday'], limit=2)
+    assert [row['ID'] for row in oldest] == [1_000_002, 1_000_003]
+
+    cached = new_db.get_table('Students')  # its columns stay loaded from before the writes below
+    assert cached.count() == 1399
+    add_student(students, 1)
+    students.insert_records(dict(ID=2_000_000 + i, First=f'Ann{i % 5}') for i in range(1100))
+    assert cached.count() == 2500
+    assert cached.get_record(1_000_001)['Last'] == 'Doe1'
+    assert cached.get_record(2_001_099)['First'] == 'Ann4'
+    with pytest.raises(ValueError):
+        cached.get_record(1_001_400)
+    assert len(DataBase().get_table('Students').query_table([SelectionCriteria('First', '=', 'Ann4')])) == 220
+
+
+def test_wal_recovery(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 3)
+    students.create_index('First')
+    students.create_index('Birthday', kind='ordered')
+    db = DataBase(wal=True)
+    students = db.get_table('Students')
+    add_student(students, 3)
+    students.update_record(1_000_000, dict(First='Jane'))
+    assert Path(db.wal.path).stat().st_size > 0
+    DataBase(wal=True).checkpoint()  # another database neither truncates nor recovers this one's log
+    assert Path(db.wal.path).stat().st_size > 0
+    db.checkpoint()
+    assert Path(db.wal.path).stat().st_size == 0
+
+    # a crash after logging: one write already applied, two never applied, then a torn record
+    log = WriteAheadLog(str(DB_ROOT / 'wal-crashed.log'))
+    log.log(('Students', 'insert', [students.get_record(1_000_003)]))
+    old_row = students.get_record(1_000_001)
+    log.log(('Students', 'update', 1_000_001, old_row, dict(old_row, First='Jane', Birthday=dt.datetime(1999, 1, 1))))
+    log.log(('Students', 'delete', 1_000_002, students.get_record(1_000_002)))
+    log.file.write(b'\x40\x00\x00\x00\x01')
+    log.file.close()
+
+    recovered = DataBase(wal=True)
+    students = recovered.get_table('Students')
+    assert students.count() == 3
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('First', '=', 'Jane')])] == \
+           [1_000_000, 1_000_001]
+    assert [row['ID'] for row in students.query_table([SelectionCriteria('Birthday', '<', dt.datetime(2000, 1, 1))])] == \
+           [1_000_001]
+    assert students.query_table([SelectionCriteria('First', '=', 'John2')]) == []
+    assert not (DB_ROOT / 'wal-crashed.log').exists()
+    add_student(students, 4)  # the handle built by the recovery logs its writes too
+    assert Path(recovered.wal.path).stat().st_size > 0
+    recovered.close()
+    db.close()
+    assert not Path(db.wal.path).exists()
+
+
+def test_record_cache(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 10)
+    students.set_cache(max_entries=2)
+    record = students.get_record(1_000_001)
+    record['First'] = 'Changed'
+    assert students.get_record(1_000_001)['First'] == 'John1'
+    assert students.query_table([SelectionCriteria('ID', '=', 1_000_001)])[0]['First'] == 'John1'
+    students.get_record(1_000_002)
+    students.get_record(1_000_003)  # evicts 1_000_001
+    assert students.cache_info() == dict(hits=2, misses=3, entries=2, bytes=0, max_entries=2, max_bytes=None)
+    students.update_record(1_000_003, dict(First='Jane'))
+    assert students.get_record(1_000_003)['First'] == 'Jane'
+    students.delete_records([SelectionCriteria('ID', '>=', 1_000_002)])
+    with pytest.raises(ValueError):
+        students.get_record(1_000_003)
+    add_student(students, 3, First='Joe')
+    assert students.get_record(1_000_003)['First'] == 'Joe'
+    students.set_cache(max_entries=None, max_bytes=1)
+    students.get_record(1_000_001)
+    assert students.cache_info()['entries'] == 0
+
+
+def add_students(first: int, count: int) -> None:
+    students = DataBase().get_table('Students')
+    for i in range(first, first + count):
+        add_student(students, i, First=f'John{i % 3}')
+        assert students.get_record(1_000_000 + i)['ID'] == 1_000_000 + i
+
+
+def test_concurrent_writers(new_db: DataBase) -> None:
+    students = create_students_table(new_db)
+    students.create_index('First')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=add_students, args=(i * 40, 40)) for i in range(2)]
+    threads = [threading.Thread(target=add_students, args=(80 + i * 40, 40)) for i in range(2)]
+    for worker in processes + threads:
+        worker.start()
+    for worker in processes + threads:
+        worker.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+    students = DataBase().get_table('Students')
+    assert students.count() == 160
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John1')])) == 53
+    assert len(students.query_table([SelectionCriteria('Last', '!=', 'x')])) == 160
+    with students.lock.reading(), pytest.raises(RuntimeError):
+        students.delete_record(1_000_000)
+
+
+def test_async_database(new_db: DataBase) -> None:
+    async def run() -> None:
+        async with AsyncDataBase(new_db, max_pending=50) as db:
+            students = await db.create_table('Students', STUDENT_FIELDS, 'ID')
+            await asyncio.gather(*(students.insert_record(dict(ID=1_000_000 + i, First=f'John{i % 3}'))
+                                   for i in range(200)))
+            with pytest.raises(ValueError):
+                await students.insert_record(dict(ID=1_000_000))
+            assert await students.count() == 200
+            assert (await students.get_record(1_000_001))['First'] == 'John1'
+            assert await db.num_tables() == 1 and await db.get_tables_names() == ['Students']
+            assert await db.get_table('Students') is students
+
+            rows = [row async for row in students.iter_query([SelectionCriteria('First', '=', 'John2')],
+                                                              chunk_size=7, max_chunks=1)]
+            assert len(rows) == 66
+            async with contextlib.aclosing(students.iter_query([], chunk_size=1, max_chunks=1)) as rows:
+                async for row in rows:
+                    break
+            await students.update_record(1_000_001, dict(First='Jane'))  # the scan released the table
+            assert len(await students.query_table([SelectionCriteria('First', '=', 'Jane')])) == 1
+
+            insert = asyncio.ensure_future(students.insert_record(dict(ID=2_000_000)))
+            insert.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await insert
+            await students.flush_inserts()
+            assert await students.count() == 200
+
+    asyncio.run(run())
+
+
+def test_parallel_scan(new_db: DataBase) -> None:
+    create_students_table(new_db).insert_records(dict(ID=1_000_000 + i, First=f'John{i % 3}') for i in range(300))
+    db = DataBase(parallelism=2)
+    db.scan_pool.min_rows = 100
+    students = db.get_table('Students')
+    try:
+        rows = students.query_table([SelectionCriteria('First', '=', 'John2')])
+        assert [row['ID'] for row in rows] == [1_000_000 + i for i in range(2, 300, 3)]
+        students.delete_records([SelectionCriteria('ID', '<', 1_000_150)])
+        assert len(students.query_table([SelectionCriteria('First', 'LIKE', 'John%')])) == 150
+        with students.open_shelf(students.table_path()) as file_name:
+            keys = list(file_name.keys())
+        students.delete_record(1_000_299)  # deleted after the scan listed the keys
+        rows = db.scan_pool.scan(str(DB_ROOT / 'Students.db'), keys, [SelectionCriteria('First', '=', 'John2')],
+                                 students.codec)
+        assert [row['ID'] for row in rows] == [1_000_000 + i for i in range(152, 299, 3)]
+    finally:
+        db.close()
+
+
+def test_partitioned_table(new_db: DataBase) -> None:
+    students = new_db.create_table('Students', STUDENT_FIELDS, 'ID', partitions=4)
+    students.create_index('First')
+    students.create_index('Birthday', kind='ordered')
+    students.create_index('Last', include=['First'])
+    assert students.insert_records(dict(ID=1_000_000 + i, First=f'John{i % 3}', Last=f'Doe{i}',
+                                        Birthday=dt.datetime(2000, 2, 1) + dt.timedelta(days=i))
+                                   for i in range(100)) == []
+    with pytest.raises(ValueError):
+        add_student(students, 7)
+    students.update_record(1_000_007, dict(First='Jane'))
+    students.delete_record(1_000_008)
+    assert len(list(DB_ROOT.glob('Students__0_*.db*'))) > 4
+    assert students.count() == 99
+    assert students.explain([SelectionCriteria('ID', '=', 1_000_007)])["partitions"] == 1
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John1')])) == 32
+    youngest = students.query_table([], order_by=[SortKey('Birthday', descending=True)], limit=3)
+    assert [row['ID'] for row in youngest] == [1_000_099, 1_000_098, 1_000_097]
+    with students.lock.writing():  # held by a repartition: partition writes wait for it
+        writer = threading.Thread(target=add_student, args=(students, 150))
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+    writer.join()
+    students.delete_record(1_000_150)
+
+    stale = [students, DataBase().get_table('Students')]
+    students = new_db.repartition('Students', 3)
+    assert not list(DB_ROOT.glob('Students__0_*'))  # lock files included
+    for table in stale:
+        with pytest.raises(ValueError):
+            add_student(table, 200)
+    assert not list(DB_ROOT.glob('Students__0_*'))  # nor made again by the stale handles
+    assert new_db.get_table('Students') is students
+    students = DataBase().get_table('Students')
+    assert len(students.partitions) == 3
+    assert students.count() == 99
+    assert students.get_record(1_000_007)['First'] == 'Jane'
+    assert students.explain([SelectionCriteria('First', '=', 'John1')])["plan"] == 'hash index'
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John1')])) == 32
+    assert students.covering_indexes == [dict(fields=['Last'], include=['First'])]
+    assert students.explain([SelectionCriteria('Last', '=', 'Doe1')], ['First'])["plan"] == 'covering index'
+    assert students.query_table([SelectionCriteria('Birthday', '<', dt.datetime(2000, 2, 3))],
+                                order_by=['Birthday']) == [students.get_record(1_000_000),
+                                                           students.get_record(1_000_001)]
+    assert new_db.get_tables_names() == ['Students']
+
+
+def test_benchmark_compare() -> None:
+    base = {"sizes": {"1000": {"get": {"ops_per_second": 100.0, "p99_ms": 2.0}, "disk_bytes": 10}}}
+    assert compare(base, base, 0.1) == []
+    slower = {"sizes": {"1000": {"get": {"ops_per_second": 80.0, "p99_ms": 3.0}, "disk_bytes": 10}}}
+    assert compare(base, slower, 0.1) == ['1000 get: ops_per_second 100.0 -> 80.0', '1000 get: p99_ms 2.000 -> 3.000']
+
+
+def test_instrumentation(new_db: DataBase) -> None:
+    create_students_table(new_db, 20)
+    events = []
+    db = DataBase(hook=events.append)
+    students = db.get_table('Students')
+    students.get_record(1_000_003)
+    with pytest.raises(ValueError):
+        students.get_record(2_000_000)
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John7')])) == 1
+    students.create_index('First')
+    assert len(students.query_table([SelectionCriteria('First', '=', 'John7')])) == 1
+    students.update_record(1_000_007, dict(Last='Smith'))
+
+    stats = db.stats()['Students']
+    assert stats['operations']['get_record']['count'] == 2
+    assert stats['operations']['get_record']['errors'] == 1
+    assert sum(stats['operations']['query_table']['histogram'].values()) == 2
+    assert stats['full_scans'] == 1 and stats['index_lookups'] == 1
+    assert stats['rows_examined'] == 21 and stats['rows_returned'] == 2
+    assert stats['file_opens'] > 0 and stats['bytes_read'] > 0 and stats['bytes_written'] > 0
+    assert [event['operation'] for event in events][-3:] == ['iter_query', 'query_table', 'update_record']
+    db.reset_stats()
+    assert db.stats() == {} and DataBase().stats() == {}
+
+
+def test_snapshot(new_db: DataBase, tmp_path: Path) -> None:
+    students = create_students_table(new_db, 10)
+    grades = new_db.create_table('Grades', [DBField('GradeID', int), DBField('Grade', int)], 'GradeID')
+    grades.insert_record(dict(GradeID=1, Grade=90))
+    new_db.snapshot(tmp_path / 'first')
+    add_student(students, 10)
+    manifest = new_db.snapshot(tmp_path / 'second', previous=tmp_path / 'first')
+    assert manifest['linked'] > 0 and manifest['copied'] > 0
+    grades_file = 'Grades.db'
+    assert (tmp_path / 'first' / grades_file).stat().st_ino == (tmp_path / 'second' / grades_file).stat().st_ino
+    assert not any(path.name.endswith('.lock') for path in (tmp_path / 'first').iterdir())
+
+    def cross_device_link(source: Path, target: Path) -> None:
+        raise OSError(18, 'Invalid cross-device link')  # EXDEV
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr('snapshot.os.link', cross_device_link)
+        manifest = new_db.snapshot(tmp_path / 'third', previous=tmp_path / 'second')
+    assert manifest['linked'] == 0
+    assert (tmp_path / 'third' / grades_file).read_bytes() == (tmp_path / 'second' / grades_file).read_bytes()
+
+    students.delete_record(1_000_001)
+    new_db.delete_table('Grades')
+    new_db.restore(tmp_path / 'first')
+    assert sorted(new_db.get_tables_names()) == ['Grades', 'Students']
+    assert new_db.get_table('Students').count() == 10
+    assert new_db.get_table('Students').get_record(1_000_001)['First'] == 'John1'
+    assert DataBase().get_table('Grades').get_record(1)['Grade'] == 90
+    new_db.restore(tmp_path / 'second')
+    assert new_db.get_table('Students').count() == 11
+
+
+def test_vacuum(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 50)
+    students.create_index('First')
+    for i in range(50):
+        students.update_record(1_000_000 + i, dict(First=f'Jane{i}', Last='X' * 1000))
+    students.delete_records([SelectionCriteria('ID', '>=', 1_000_025)])
+    report = new_db.space_report()['Students']
+    index_report = report[students.index_path('First')]
+    assert index_report['entries'] == 25 and index_report['empty_entries'] == 0
+    table_report = report[students.table_path()]
+    assert table_report['entries'] == 25 and table_report['dead_bytes'] > table_report['live_bytes']
+
+    assert new_db.vacuum()['Students'] > 0
+    vacuumed_report = new_db.space_report()['Students'][students.table_path()]
+    assert vacuumed_report['live_bytes'] == table_report['live_bytes']
+    assert vacuumed_report['dead_bytes'] < table_report['dead_bytes'] / 2
+    assert students.count() == 25
+    assert students.get_record(1_000_003)['First'] == 'Jane3'
+    assert len(students.query_table([SelectionCriteria('First', '=', 'Jane7')])) == 1
+    with new_db.session():
+        students.insert_record(dict(ID=1, First='Jane7', Last='Y', Birthday=dt.datetime(2000, 1, 1)))
+        assert new_db.vacuum('Students')['Students'] >= 0
+        assert len(students.query_table([SelectionCriteria('First', '=', 'Jane7')])) == 2
+
+
+def test_record_codec(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 5)
+    codec = students.codec
+    row = students.get_record(1_000_002)
+    data = codec.encode(dict(row, Last=None))
+    assert len(data) < len(pickle.dumps(row))
+    assert codec.decode(data) == dict(row, Last=None)
+    assert codec.decode(data, ['Birthday', 'First']) == {'First': 'John2', 'Birthday': row['Birthday']}
+    with pytest.raises(ValueError):
+        students.insert_record(dict(ID=1, First=7))
+    with pytest.raises(ValueError):
+        students.update_record(1_000_002, dict(Birthday='2000-01-01'))
+    with pytest.raises(ValueError):
+        students.insert_record(dict(ID=2 ** 64))
+    assert students.count() == 5 and students.get_record(1_000_002) == row
+    with dbm_sqlite.open_shelf(DB_ROOT / 'DataBase.db') as catalog:
+        assert catalog['Students']['codec'] == CODEC_VERSION
+        table_info = catalog['Students']
+        del table_info['codec']  # pretend it predates the codec, with a row that breaks its schema
+        catalog['Students'] = table_info
+        catalog.dict.version = 1
+    with dbm_sqlite.open_shelf(DB_ROOT / 'Students.db') as table_file:
+        for key in list(table_file):
+            table_file[key] = codec.decode(table_file.dict[key.encode()])
+        table_file[repr(1)] = dict(ID=1, First=7, Last='Doe', Birthday=None)
+    students = DataBase().get_table('Students')
+    assert students.codec is None and students.get_record(1)['First'] == 7
+    students.delete_record(1)
+    with dbm_sqlite.open_shelf(DB_ROOT / 'DataBase.db') as catalog:
+        table_info = catalog['Students']
+        del table_info['codec']
+        catalog['Students'] = table_info
+        catalog.dict.version = 1
+    students = DataBase().get_table('Students')
+    assert students.codec is not None and students.get_record(1_000_002) == row
+
+
+def test_bulk_update_delete(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 40)
+    students.create_index('First')
+    students.create_index('Birthday', 'ordered')
+    assert students.update_records([SelectionCriteria('ID', '<', 1_000_010)], dict(First='Bulk', Last=None)) == 10
+    assert students.update_records([SelectionCriteria('ID', '<', 0)], dict(First='None')) == 0
+    with pytest.raises(ValueError):
+        students.update_records([], dict(First=3))
+    assert len(students.query_table([SelectionCriteria('First', '=', 'Bulk')])) == 10
+    assert students.query_table([SelectionCriteria('First', '=', 'John3')]) == []
+    assert students.get_record(1_000_004)['Last'] is None
+
+    birthday = dt.datetime(2000, 2, 1) + dt.timedelta(days=20)
+    assert students.delete_records([SelectionCriteria('Birthday', '>=', birthday)]) == 20
+    assert students.delete_records([SelectionCriteria('First', '=', 'Bulk')]) == 10
+    assert students.count() == 10
+    assert students.query_table([SelectionCriteria('First', '=', 'Bulk')]) == []
+    assert [row['ID'] for row in students.query_table([], order_by=['Birthday'])] == list(range(1_000_010, 1_000_020))
+    report = new_db.space_report()['Students'][students.index_path('First')]
+    assert report['entries'] == 10 and report['empty_entries'] == 0
+
+
+def test_database_roots(tmp_path: Path) -> None:
+    first, second = DataBase(root=tmp_path / 'first'), DataBase(root=tmp_path / 'second')
+    create_students_table(first, 3)
+    second.create_table('Grades', [DBField('GradeID', int), DBField('Grade', int)], 'GradeID')
+    first.get_table('Students').create_index('First')
+    assert first.get_tables_names() == ['Students'] and second.get_tables_names() == ['Grades']
+    assert (tmp_path / 'first' / 'Students.db').exists() and not (tmp_path / 'second' / 'Students.db').exists()
+
+    reopened = DataBase(root=tmp_path / 'first')
+    assert reopened.db_tables == {} and reopened.catalog == {}
+    students = reopened.get_table('Students')
+    assert students.hash_index == [False, True, False, False]
+    assert reopened.get_table('Students') is students
+    assert students.query_table([SelectionCriteria('First', '=', 'John1')])[0]['ID'] == 1_000_001
+    first.delete_table('Students')
+    with pytest.raises(ValueError):
+        reopened.get_table('Students')
+    create_students_table(first, 5)
+    assert reopened.get_table('Students').count() == 5
+    first.create_table('Grades', [DBField('GradeID', int), DBField('Grade', int)], 'GradeID')
+    cold = DataBase(root=tmp_path / 'first')
+    cold.get_table('Students')
+    assert list(cold.catalog) == ['Students']  # only the entry of the table asked for is read
+    assert cold.num_tables() == 2
+
+
+def test_covering_index(new_db: DataBase) -> None:
+    students = create_students_table(new_db, 30)
+    students.create_index('First', include=['Last'])
+    students.create_index(['First', 'Birthday'])
+    first = [SelectionCriteria('First', '=', 'John4')]
+    assert students.explain(first, ['ID', 'Last'])['plan'] == 'covering index'
+    assert students.explain(first)['plan'] == 'composite index'
+    birthday = dt.datetime(2000, 2, 1) + dt.timedelta(days=4)
+    assert students.explain(first + [SelectionCriteria('Birthday', '=', birthday)], ['ID'])['fields'] == \
+        ['First', 'Birthday']
+
+    table_file = DB_ROOT / 'Students.db'
+    table_file.rename(DB_ROOT / 'moved.db')  # prove the table file is never read
+    try:
+        assert list(students.iter_query(first, ['ID', 'Last'])) == [{'ID': 1_000_004, 'Last': 'Doe4'}]
+        assert list(students.iter_query(first + [SelectionCriteria('Birthday', '=', birthday)], ['ID'])) == \
+            [{'ID': 1_000_004}]
+        assert not table_file.exists()
+    finally:
+        (DB_ROOT / 'moved.db').rename(table_file)
+
+    students.update_record(1_000_004, dict(Last='Smith'))
+    students.update_records([SelectionCriteria('ID', '=', 1_000_005)], dict(First='John4'))
+    add_student(students, 40, First='John4')
+    students.delete_record(1_000_040)
+    assert sorted(students.iter_query(first, ['ID', 'Last']), key=lambda row: row['ID']) == \
+        [{'ID': 1_000_004, 'Last': 'Smith'}, {'ID': 1_000_005, 'Last': 'Doe5'}]
+    assert students.query_table(first, order_by=['ID'])[1]['Birthday'] == birthday + dt.timedelta(days=1)
+    students.delete_records(first)
+    assert list(students.iter_query(first, ['Last'])) == []
+    assert DataBase().get_table('Students').covering_indexes == students.covering_indexes
+
+
 def test_bad_key(new_db: DataBase) -> None:
     with pytest.raises(ValueError):
         _ = new_db.create_table('Students', STUDENT_FIELDS, 'BAD_KEY')
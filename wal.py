@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+import itertools
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+RECORD_HEADER = struct.Struct('<II')  # payload length, crc32 of the payload
+CHECKPOINT_BYTES = 4 * 1024 * 1024
+LOG_PATTERN = 'wal*.log'
+log_numbers = itertools.count()
+
+
+class WriteAheadLog:
+    """An append-only redo log of table writes with group commit.
+
+    Every write is logged and made durable before it touches the table and index files. Writers that
+    commit while an fsync is in flight wait for the next one, so concurrent writers share fsyncs.
+    A checkpoint flushes every table to disk and truncates the log, so recovery only has to redo the
+    writes logged since the last checkpoint. A torn record at the tail was never applied and is dropped.
+
+    Each open database has a log of its own, locked for as long as it is open, since a checkpoint can
+    only vouch for the writes of the tables it flushed. A log nobody holds was left by a database that
+    was not closed, and is redone and removed by the next one opened on the same root.
+    """
+
+    def __init__(self, path: str, checkpoint_bytes: int = CHECKPOINT_BYTES,
+                 flush_tables: Callable[[], None] = None, wait: bool = True):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        self.flush_tables = flush_tables
+        self.file = open(path, 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                self.file.close()
+                raise
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.next_lsn = 1
+        self.durable_lsn = 0
+        self.is_flushing = False
+        self.state = threading.Condition()
+        self.active_writers = 0
+        self.is_checkpointing = False
+        self.checkpointer = None
+        self.stop_checkpointer = threading.Event()
+
+    def append(self, record: Tuple[Any, ...]) -> int:
+        payload = pickle.dumps(record)
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            lsn = self.next_lsn
+            self.next_lsn += 1
+        return lsn
+
+    def commit(self, lsn: int) -> None:
+        """Return once record lsn is on disk, sharing one fsync among every writer waiting at the same time."""
+        with self.lock:
+            while self.durable_lsn < lsn:
+                if self.is_flushing:  # a leader is already syncing, wait for its result
+                    self.flushed.wait()
+                    continue
+                self.is_flushing = True
+                target = self.next_lsn - 1
+                self.file.flush()
+                self.lock.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.lock.acquire()
+                    self.is_flushing = False
+                self.durable_lsn = max(self.durable_lsn, target)
+                self.flushed.notify_all()
+
+    def log(self, record: Tuple[Any, ...]) -> None:
+        self.commit(self.append(record))
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """Hold off checkpoints from logging a write until it has been applied to the table files."""
+        with self.state:
+            while self.is_checkpointing:
+                self.state.wait()
+            self.active_writers += 1
+        try:
+            yield
+        finally:
+            with self.state:
+                self.active_writers -= 1
+                self.state.notify_all()
+
+    def size(self) -> int:
+        with self.lock:
+            return self.file.tell()
+
+    def maybe_checkpoint(self) -> None:
+        if self.size() >= self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        with self.state:
+            while self.is_checkpointing:
+                self.state.wait()
+            self.is_checkpointing = True
+            while self.active_writers:
+                self.state.wait()
+        try:
+            if self.flush_tables is not None:
+                self.flush_tables()
+            with self.lock:
+                self.file.truncate(0)
+                self.file.seek(0)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        finally:
+            with self.state:
+                self.is_checkpointing = False
+                self.state.notify_all()
+
+    def records(self) -> Iterator[Tuple[Any, ...]]:
+        """Yield the logged records in order, stopping at the first torn or corrupt one."""
+        with open(self.path, 'rb') as log_file:
+            data = log_file.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, position)
+            payload = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield pickle.loads(payload)
+            position += RECORD_HEADER.size + length
+
+    def start_checkpointer(self, interval: float) -> None:
+        if self.checkpointer is not None:
+            return
+        self.stop_checkpointer.clear()
+        self.checkpointer = threading.Thread(target=self.run_checkpointer, args=(interval,), daemon=True)
+        self.checkpointer.start()
+
+    def run_checkpointer(self, interval: float) -> None:
+        while not self.stop_checkpointer.wait(interval):
+            if self.size():
+                self.checkpoint()
+
+    def close(self, checkpointer_timeout: Optional[float] = None) -> None:
+        if self.checkpointer is not None:
+            self.stop_checkpointer.set()
+            self.checkpointer.join(checkpointer_timeout)
+            self.checkpointer = None
+        self.checkpoint()
+        os.remove(self.path)  # while still locked, so no other database takes it for an abandoned log
+        self.file.close()
+
+
+def new_log_path(root: str) -> str:
+    return os.path.join(root, f'wal-{os.getpid()}-{next(log_numbers)}.log')
+
+
+def abandoned_logs(root: str, flush_tables: Callable[[], None] = None) -> List[WriteAheadLog]:
+    """The logs under root that no open database holds, each now locked by the caller."""
+    logs = []
+    for path in sorted(Path(root).glob(LOG_PATTERN)):
+        try:
+            logs.append(WriteAheadLog(str(path), flush_tables=flush_tables, wait=False))
+        except (BlockingIOError, FileNotFoundError):  # in use, or just removed by its database
+            continue
+        if not os.path.exists(path):  # removed by its database while the lock was being taken
+            logs.pop().file.close()
+    return logs